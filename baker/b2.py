@@ -1,25 +1,125 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-"""Utilities to handle BackBlaze B2 via command-line"""
+"""Utilities to handle BackBlaze B2
+
+Operations are run natively, with b2sdk (see :py:mod:`baker.b2api`), if it is
+installed.  Set the environment variable ``BAKER_B2_BACKEND=cli`` to fork the
+``b2`` command-line tool for each operation instead.
+"""
 
 import os
 import json
 import copy
-import shutil
+import time
+import asyncio
+import datetime
 import tempfile
+import threading
+import subprocess
+import collections
 import logging
 
 logger = logging.getLogger(__name__)
 
-from .utils import run_cmdline
+from .utils import run_cmdline_async, which, tool_version
+from .utils import state_path, read_state, write_state
+
+
+BucketEntry = collections.namedtuple(
+    "BucketEntry", ["name", "size", "upload_time", "id", "action"]
+)
+"""A file (version) or folder on a bucket, see :py:func:`iter_bucket_contents`
+
+For folders, ``size`` is zero, ``action`` is ``folder`` and both
+``upload_time`` and ``id`` are ``None``.  Upload times are naive UTC
+:py:class:`datetime.datetime` objects.
+"""
+
+
+_native = None
+"""Cached result of :py:func:`native`"""
+
+
+_AUTHORIZATION_LIFETIME = 23 * 3600
+"""For how long, in seconds, an authorization is reused (tokens last 24h)"""
+
+
+_authorizations = {}
+"""Times of the authorizations done by this process, see :py:func:`authorize`"""
 
 
-B2_BIN = shutil.which("b2")
-logger.debug("Using b2 from `%s'", B2_BIN)
+_buckets = None
+"""Bucket listing cached by :py:func:`list_buckets`"""
 
 
-def run_b2(args, mask=None):
+calls = collections.Counter()
+"""Number of B2 operations run by this process, by operation name"""
+
+
+_calls_lock = threading.Lock()
+
+
+def _count(operation):
+    """Counts a B2 operation (e.g. ``list-buckets``) on :py:data:`calls`"""
+
+    with _calls_lock:
+        calls[operation.replace("_", "-")] += 1
+
+
+def native():
+    """Tells if B2 operations run natively, with b2sdk
+
+    The backend is chosen on the first call, from the environment variable
+    ``BAKER_B2_BACKEND`` (``sdk``, the default, or ``cli``).  If b2sdk cannot
+    be imported, then we fallback to the command-line tool.
+    """
+
+    global _native
+
+    if _native is None:
+        backend = os.environ.get("BAKER_B2_BACKEND", "sdk")
+        if backend not in ("sdk", "cli"):
+            raise RuntimeError(
+                "BAKER_B2_BACKEND must be either `sdk' or `cli', not `%s'"
+                % backend
+            )
+        _native = False
+        if backend == "sdk":
+            try:
+                from . import b2api  # noqa: F401
+
+                _native = True
+            except ImportError as e:
+                logger.warning(
+                    "Cannot use b2sdk (%s) - using the `b2' command-line "
+                    "tool instead",
+                    e,
+                )
+    return _native
+
+
+async def _run_native(name, *args):
+    """Runs a function of :py:mod:`baker.b2api` on a separate thread"""
+
+    from . import b2api
+
+    logger.debug("Running `%s' with b2sdk", name)
+    _count(name)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, getattr(b2api, name), *args)
+
+
+def _to_output(text, output):
+    """Writes text to an output buffer, if one is set, and returns either"""
+
+    if output is None:
+        return text
+    output.write(text)
+    return output
+
+
+def run_b2(args, mask=None, output=None):
     """Runs the b2 binary with the provided arguments
 
 
@@ -32,6 +132,9 @@ def run_b2(args, mask=None):
         asterisks.  This may be imoprtant to avoid passwords or keys to be shown
         on the screen or sent via email.
 
+      output (OutputBuffer, Optional): If set, stream the output of b2 into
+        this buffer, which is returned instead of a string
+
 
     Returns:
 
@@ -39,17 +142,34 @@ def run_b2(args, mask=None):
 
     """
 
-    if not B2_BIN:
+    return asyncio.run(run_b2_async(args, mask, output))
+
+
+async def run_b2_async(args, mask=None, output=None):
+    """Asynchronous version of :py:func:`run_b2`"""
+
+    b2_bin = which("b2")
+    if not b2_bin:
         raise RuntimeError(
             "The executable `b2' must be available on your ${PATH}"
         )
-    return run_cmdline([B2_BIN] + args, mask=mask)
+    _count(args[0])
+    return await run_cmdline_async([b2_bin] + args, mask=mask, output=output)
 
 
-def version():
-    """Returns the result of ``b2 version``"""
+def version(cache=None):
+    """Returns the version of the B2 backend in use
+
+    For the command-line tool, this is the (cached) result of ``b2 version``
+    (see :py:func:`baker.utils.tool_version`).
+    """
 
-    return run_b2(["version"])
+    if native():
+        from . import b2api
+
+        return "b2sdk version %s" % b2api.VERSION
+
+    return tool_version("b2", cache=cache)
 
 
 def get_account_info():
@@ -66,8 +186,17 @@ def get_account_info():
 
     """
 
+    return asyncio.run(get_account_info_async())
+
+
+async def get_account_info_async():
+    """Asynchronous version of :py:func:`get_account_info`"""
+
+    if native():
+        return await _run_native("get_account_info")
+
     try:
-        return json.loads(run_b2(["get-account-info"]))
+        return json.loads(await run_b2_async(["get-account-info"]))
     except RuntimeError:
         return None
 
@@ -75,10 +204,24 @@ def get_account_info():
 def clear_account():
     """Logs off, removes the authorization file kept locally and all credentials"""
 
-    return run_b2(["clear-account"])
+    return asyncio.run(clear_account_async())
+
+
+async def clear_account_async():
+    """Asynchronous version of :py:func:`clear_account`"""
+
+    global _buckets
+
+    _authorizations.clear()
+    _buckets = None
 
+    if native():
+        return await _run_native("clear_account")
 
-def authorize_account(account_id, key):
+    return await run_b2_async(["clear-account"])
+
+
+def authorize_account(account_id, key, output=None):
     """Runs the authorization procedure for the b2 cmdline tool
 
 
@@ -89,16 +232,102 @@ def authorize_account(account_id, key):
       key (str): The BackBlaze B2 key to use to run the command. This key must
         have access to the specified bucket.
 
+      output (OutputBuffer, Optional): If set, stream the output of b2 into
+        this buffer, which is returned instead of a string
+
+    """
+
+    return asyncio.run(authorize_account_async(account_id, key, output))
+
+
+async def authorize_account_async(account_id, key, output=None):
+    """Asynchronous version of :py:func:`authorize_account`"""
+
+    if native():
+        out = await _run_native("authorize_account", account_id, key)
+        return _to_output(out, output)
+
+    return await run_b2_async(
+        ["authorize-account", account_id, key], mask=2, output=output
+    )
+
+
+def _authorization_state(account_id, key):
+    """Returns the path of the state file recording an authorization
+
+    Authorizations are kept by b2 on a single file, per user, so we also keep
+    them on the default cache location, independently of ``--cache``.
+    """
+
+    return state_path(None, "b2-authorizations", account_id + "\n" + key)
+
+
+def authorize(account_id, key, output=None):
+    """Authorizes the account, unless a recent authorization can be reused
+
+    Authorizations (and their authentication token) are kept by b2 on its
+    account information file, which is shared by both backends.  The time of
+    each authorization is recorded on a state file, so that the token is
+    reused for up to :py:data:`_AUTHORIZATION_LIFETIME` seconds, across runs
+    and repositories, as long as the account information on file is still
+    for the same key.
+
+
+    Parameters:
+
+      account_id (str): The BackBlaze B2 account identifier
+
+      key (str): The BackBlaze B2 key to use
+
+      output (OutputBuffer, Optional): If set, stream the output of b2 into
+        this buffer
+
+
+    Returns:
+
+      bool: ``True`` if the account had to be authorized, ``False`` if the
+      existing authorization was reused
+
     """
 
-    return run_b2(["authorize-account", account_id, key], mask=2)
+    return asyncio.run(authorize_async(account_id, key, output))
+
+
+async def authorize_async(account_id, key, output=None):
+    """Asynchronous version of :py:func:`authorize`"""
+
+    now = time.time()
+    path = _authorization_state(account_id, key)
+
+    last = _authorizations.get((account_id, key))
+    if last is None:  # first use on this process, checks the files
+        last = read_state(path, {}).get("time")
+        if last is not None:
+            info = await get_account_info_async()
+            if not info or info.get("applicationKeyId") != account_id:
+                last = None
+
+    if last is not None and (now - last) < _AUTHORIZATION_LIFETIME:
+        logger.debug(
+            "Reusing B2 authorization for `%s' from %s",
+            account_id,
+            time.ctime(last),
+        )
+        _authorizations[(account_id, key)] = last
+        return False
+
+    await authorize_account_async(account_id, key, output=output)
+    _authorizations[(account_id, key)] = now
+    write_state(path, dict(time=now))
+    return True
 
 
 def sync(bucket, path):
     """Synchronizes contents of the given path to the bucket
 
     This function is primarily for tests as it **destructively** syncs local
-    folder contents to the remote bucket
+    folder contents to the remote bucket.  It always uses the command-line
+    tool.
 
 
     Parameters:
@@ -109,29 +338,49 @@ def sync(bucket, path):
 
     """
 
-    return run_b2(
+    return asyncio.run(sync_async(bucket, path))
+
+
+async def sync_async(bucket, path):
+    """Asynchronous version of :py:func:`sync`"""
+
+    return await run_b2_async(
         ["sync", "--allowEmptySource", "--delete", path, "b2://%s" % bucket]
     )
 
 
-def empty_bucket(name):
+def empty_bucket(name, jobs=16):
     """Empties the contents of a BackBlaze B2 bucket
 
-    Follows the following implementation advice: https://help.backblaze.com/hc/en-us/articles/225556127-How-Can-I-Easily-Delete-All-Files-in-a-Bucket-
+    With b2sdk, all file versions are listed page by page, and deleted
+    concurrently (see :py:func:`baker.b2api.empty_bucket`).  With the
+    command-line tool, follows the following implementation advice: https://help.backblaze.com/hc/en-us/articles/225556127-How-Can-I-Easily-Delete-All-Files-in-a-Bucket-
 
 
     Parameters:
 
       name (str): The name of the bucket to remove contents from
 
+      jobs (int, Optional): The number of deletions to run in parallel (only
+        used with b2sdk)
+
 
     """
 
+    return asyncio.run(empty_bucket_async(name, jobs))
+
+
+async def empty_bucket_async(name, jobs=16):
+    """Asynchronous version of :py:func:`empty_bucket`"""
+
+    if native():
+        return await _run_native("empty_bucket", name, jobs)
+
     with tempfile.TemporaryDirectory() as d:
-        return sync(name, d)  # remove all contents
+        return await sync_async(name, d)  # remove all contents
 
 
-def get_bucket(name):
+def get_bucket(name, show_size=True):
     """Returns information about a BackBlaze B2 bucket
 
 
@@ -139,6 +388,10 @@ def get_bucket(name):
 
       name (str): The name of the bucket to remove
 
+      show_size (bool, Optional): If set, also compute the number of file
+        versions (``fileCount``) and their total size (``totalSize``).  This
+        requires listing all file versions on the bucket.
+
 
     Returns:
 
@@ -146,8 +399,20 @@ def get_bucket(name):
 
     """
 
+    return asyncio.run(get_bucket_async(name, show_size))
+
+
+async def get_bucket_async(name, show_size=True):
+    """Asynchronous version of :py:func:`get_bucket`"""
+
+    if native():
+        return await _run_native("get_bucket", name, show_size)
+
     # --showSize will include the size in version 1.1.0+
-    return json.loads(run_b2(["get-bucket", "--showSize", name]))
+    args = ["get-bucket", name]
+    if show_size:
+        args.insert(1, "--showSize")
+    return json.loads(await run_b2_async(args))
 
 
 def remove_bucket(name):
@@ -163,18 +428,31 @@ def remove_bucket(name):
 
     Returns:
 
-      dict: With the JSON contents returned by the ``get-bucket`` command. The
-      snippet contains the deleted bucket information.
+      dict: With the JSON contents returned by the ``get-bucket`` command
+      (without sizes). The snippet contains the deleted bucket information.
 
     """
 
-    empty_bucket(name)
-    retval = get_bucket(name)
-    assert not run_b2(["delete-bucket", name])  # returns empty string
+    return asyncio.run(remove_bucket_async(name))
+
+
+async def remove_bucket_async(name):
+    """Asynchronous version of :py:func:`remove_bucket`"""
+
+    global _buckets
+
+    retval = await get_bucket_async(name, show_size=False)
+    await empty_bucket_async(name)
+    _buckets = None
+    if native():
+        await _run_native("delete_bucket", name)
+        return retval
+    out = await run_b2_async(["delete-bucket", name])
+    assert not out  # returns empty string
     return retval
 
 
-def create_bucket(name, tp="allPrivate"):
+def create_bucket(name, tp="allPrivate", output=None):
     """Creates a new (private) bucket
 
 
@@ -185,8 +463,21 @@ def create_bucket(name, tp="allPrivate"):
         values are described at
         https://www.backblaze.com/b2/docs/b2_create_bucket.html
 
+      output (OutputBuffer, Optional): If set, stream the output of b2 into
+        this buffer, which is returned instead of a string
+
     """
 
+    return asyncio.run(create_bucket_async(name, tp, output))
+
+
+async def create_bucket_async(name, tp="allPrivate", output=None):
+    """Asynchronous version of :py:func:`create_bucket`"""
+
+    global _buckets
+
+    _buckets = None  # the new bucket is not on the cached listing
+
     # from: https://www.backblaze.com/b2/docs/lifecycle_rules.html
     # check the end of the page for set recipes: here, we delete all
     # files deleted by restic after a one day period. According to this thread:
@@ -202,20 +493,33 @@ def create_bucket(name, tp="allPrivate"):
         }
     ]
 
-    return run_b2(
+    if native():
+        out = await _run_native("create_bucket", name, tp, lifecycle_rules)
+        return _to_output(out, output)
+
+    return await run_b2_async(
         [
             "create-bucket",
             "--lifecycleRules",
             json.dumps(lifecycle_rules),
             name,
             tp,
-        ]
+        ],
+        output=output,
     )
 
 
-def list_buckets():
+def list_buckets(refresh=False):
     """List all available buckets
 
+    The listing is cached for the duration of the process, and discarded when
+    buckets are created or removed through this module.
+
+
+    Parameters:
+
+      refresh (bool, Optional): If set, then ignore the cached listing
+
 
     Returns:
 
@@ -226,12 +530,26 @@ def list_buckets():
 
     """
 
-    out = run_b2(["list-buckets"])
-    if out.endswith("\n"):
-        out = out[:-1]
-    objects = out.split("\n")
-    objects = [k.split() for k in objects if k.strip()]
-    return dict([(k[-1], k[:-1]) for k in objects])
+    return asyncio.run(list_buckets_async(refresh))
+
+
+async def list_buckets_async(refresh=False):
+    """Asynchronous version of :py:func:`list_buckets`"""
+
+    global _buckets
+
+    if _buckets is None or refresh:
+        if native():
+            _buckets = await _run_native("list_buckets")
+        else:
+            out = await run_b2_async(["list-buckets"])
+            if out.endswith("\n"):
+                out = out[:-1]
+            objects = out.split("\n")
+            objects = [k.split() for k in objects if k.strip()]
+            _buckets = dict([(k[-1], k[:-1]) for k in objects])
+
+    return copy.deepcopy(_buckets)
 
 
 def bucket_contents(name, folder=None):
@@ -251,13 +569,106 @@ def bucket_contents(name, folder=None):
 
     """
 
-    args = ["ls", name]
+    return asyncio.run(bucket_contents_async(name, folder))
+
+
+async def bucket_contents_async(name, folder=None):
+    """Asynchronous version of :py:func:`bucket_contents`
+
+    With the ``b2`` command-line tool, entries are read from
+    :py:func:`iter_bucket_contents` on a separate thread, so that only their
+    names are kept in memory.
+    """
+
+    if native():
+        return await _run_native("bucket_contents", name, folder)
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        None, lambda: [k.name for k in iter_bucket_contents(name, folder)]
+    )
+
+
+def _parse_ls_entry(line):
+    """Parses one line of the output of ``b2 ls --long``"""
+
+    file_id, action, date, time, size, name = line.rstrip("\n").split(None, 5)
+    if file_id == "-":
+        return BucketEntry(name, 0, None, None, "folder")
+    return BucketEntry(
+        name,
+        int(size),
+        datetime.datetime.strptime(date + " " + time, "%Y-%m-%d %H:%M:%S"),
+        file_id,
+        action,
+    )
+
+
+def iter_bucket_contents(name, folder=None, recursive=False, versions=False):
+    """Iterates over bucket contents, fetching entries lazily
+
+    Contrary to :py:func:`bucket_contents`, entries are yielded as soon as
+    they are received, page by page, so that arbitrarily large buckets can be
+    processed in constant memory.
+
+
+    Parameters:
+
+      name (str): The name of the bucket to list
+      folder (str, Optional): Sub-folder (prefix) within the bucket to list
+      recursive (bool, Optional): If set, list contents of sub-folders instead
+        of yielding folder entries
+      versions (bool, Optional): If set, list all file versions (including
+        hidden ones), instead of the latest version of each file only
+
+
+    Yields:
+
+      BucketEntry: Files and folders on the bucket, sorted by name
+
+    """
+
+    _count("ls")
+
+    if native():
+        from . import b2api
+
+        yield from b2api.iter_bucket_contents(
+            name, folder, recursive, versions
+        )
+        return
+
+    b2_bin = which("b2")
+    if not b2_bin:
+        raise RuntimeError(
+            "The executable `b2' must be available on your ${PATH}"
+        )
+    cmd = [b2_bin, "ls", "--long"]
+    if recursive:
+        cmd.append("--recursive")
+    if versions:
+        cmd.append("--versions")
+    cmd.append(name)
     if folder:
-        args += [folder]
-    out = run_b2(args)
-    if out.endswith("\n"):
-        out = out[:-1]
-    return out.split("\n")
+        cmd.append(folder)
+
+    with tempfile.TemporaryFile("w+t") as errors, subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=errors, text=True
+    ) as process:
+        try:
+            for line in process.stdout:
+                if line.strip():
+                    yield _parse_ls_entry(line)
+        except GeneratorExit:  # the caller stopped iterating
+            process.kill()
+            raise
+        if process.wait() != 0:
+            errors.seek(0)
+            logger.error("Command output is:\n%s", errors.read())
+            raise RuntimeError(
+                "command `%s' exited with error state (%d)"
+                % (" ".join(cmd), process.returncode)
+            )
 
 
 def setup(b2_id=None, b2_key=None):
@@ -291,10 +702,9 @@ def setup(b2_id=None, b2_key=None):
 
     B2_AUTH_FILE = os.path.expanduser("~/.b2_auth")
 
-    # 1. Values passed as parameters: re-authorized on provided tokens
+    # 1. Values passed as parameters: (re-)authorized on provided tokens
     if b2_id and b2_key:
-        clear_account()
-        authorize_account(b2_id, b2_key)
+        authorize(b2_id, b2_key)
 
     b2_info = get_account_info()
 
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""BackBlaze B2 operations implemented natively, on top of b2sdk
+
+All functions share a single :py:class:`b2sdk.v2.B2Api` instance, and
+therefore its pool of HTTP connections.  Authorization information is kept
+on the same SQLite file as the one used by the ``b2`` command-line tool, so
+both backends of :py:mod:`baker.b2` can be used interchangeably.
+
+Functions here are blocking, and return the same values as their
+command-line counterparts on :py:mod:`baker.b2`.
+"""
+
+import time
+import datetime
+import threading
+import concurrent.futures
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+import b2sdk.v2
+import b2sdk.version
+
+from .b2 import BucketEntry
+from .reporter import human_time
+
+
+VERSION = b2sdk.version.VERSION
+"""The version of b2sdk in use"""
+
+
+_TRANSIENT = (
+    b2sdk.v2.exception.TooManyRequests,
+    b2sdk.v2.exception.ServiceError,
+)
+"""Errors (HTTP 429 and 5xx) after which requests are retried"""
+
+
+_api = None
+_api_lock = threading.Lock()
+
+
+def api():
+    """Returns the shared B2 API object, creating it on the first call"""
+
+    global _api
+
+    with _api_lock:
+        if _api is None:
+            info = b2sdk.v2.SqliteAccountInfo()
+            _api = b2sdk.v2.B2Api(info, cache=b2sdk.v2.AuthInfoCache(info))
+            logger.debug(
+                "Using b2sdk %s (account info at `%s')", VERSION, info.filename
+            )
+        return _api
+
+
+def get_account_info():
+    """Returns the current account information, or ``None``"""
+
+    info = api().account_info
+    try:
+        return dict(
+            accountId=info.get_account_id(),
+            accountFilePath=getattr(info, "filename", None),
+            allowed=info.get_allowed(),
+            applicationKeyId=info.get_application_key_id(),
+            applicationKey=info.get_application_key(),
+            isMasterKey=info.is_master_key(),
+            accountAuthToken=info.get_account_auth_token(),
+            apiUrl=info.get_api_url(),
+            downloadUrl=info.get_download_url(),
+            s3endpoint=info.get_s3_api_url(),
+        )
+    except b2sdk.v2.exception.MissingAccountData:
+        return None
+
+
+def clear_account():
+    """Removes authorization information kept locally"""
+
+    api().account_info.clear()
+
+
+def authorize_account(account_id, key):
+    """Authorizes the account, returns a message to be logged"""
+
+    api().authorize_account("production", account_id, key)
+    return "Using %s\n" % b2sdk.v2.REALM_URLS["production"]
+
+
+def iter_bucket_contents(
+    name, folder=None, recursive=False, versions=False, page_size=1000
+):
+    """Yields :py:class:`baker.b2.BucketEntry` for files on a bucket
+
+    Results are fetched lazily, ``page_size`` entries at a time.
+    """
+
+    bucket = api().get_bucket_by_name(name)
+    for version, folder_name in bucket.ls(
+        folder or "",
+        latest_only=not versions,
+        recursive=recursive,
+        fetch_count=page_size,
+    ):
+        if folder_name is not None:
+            yield BucketEntry(folder_name, 0, None, None, "folder")
+            continue
+        yield BucketEntry(
+            version.file_name,
+            version.size,
+            datetime.datetime.utcfromtimestamp(
+                version.upload_timestamp / 1000
+            ),
+            version.id_,
+            version.action,
+        )
+
+
+def get_bucket(name, show_size=True):
+    """Returns information about a bucket, optionally with its total size"""
+
+    retval = api().get_bucket_by_name(name).as_dict()
+    if not show_size:
+        return retval
+    retval["fileCount"] = 0
+    retval["totalSize"] = 0
+    for entry in iter_bucket_contents(name, recursive=True, versions=True):
+        retval["fileCount"] += 1
+        retval["totalSize"] += entry.size
+    return retval
+
+
+def _delete_version(b2_api, entry, retries, backoff):
+    """Deletes a file version, retrying on transient errors"""
+
+    for attempt in range(retries + 1):
+        try:
+            b2_api.delete_file_version(entry.id, entry.name)
+            return
+        except _TRANSIENT as e:
+            if attempt == retries:
+                raise
+            delay = backoff * (2**attempt)
+            logger.warning(
+                "Could not delete `%s' (%s) - retrying in %s",
+                entry.name,
+                e,
+                human_time(delay),
+            )
+            time.sleep(delay)
+
+
+def empty_bucket(name, jobs=16, retries=5, backoff=1.0):
+    """Removes all file versions from a bucket
+
+    File versions are listed page by page and deleted by a pool of ``jobs``
+    threads.  At most ``4 * jobs`` deletions are pending at any time, so
+    memory use does not depend on the number of files.  Deletions failing
+    with a transient error (see :py:data:`_TRANSIENT`) are retried up to
+    ``retries`` times, with exponential backoff starting at ``backoff``
+    seconds.  Returns the number of deleted file versions.
+    """
+
+    b2_api = api()
+    start = time.time()
+    count = 0
+    pending = set()
+
+    def _collect(done):
+        for future in done:
+            future.result()  # re-raises errors
+        return len(done)
+
+    with concurrent.futures.ThreadPoolExecutor(max(1, jobs)) as executor:
+        try:
+            for entry in iter_bucket_contents(
+                name, recursive=True, versions=True
+            ):
+                if len(pending) >= 4 * jobs:
+                    done, pending = concurrent.futures.wait(
+                        pending,
+                        return_when=concurrent.futures.FIRST_COMPLETED,
+                    )
+                    count += _collect(done)
+                pending.add(
+                    executor.submit(
+                        _delete_version, b2_api, entry, retries, backoff
+                    )
+                )
+            done, pending = concurrent.futures.wait(pending)
+            count += _collect(done)
+        except BaseException:
+            for future in pending:
+                future.cancel()
+            raise
+
+    elapsed = time.time() - start
+    logger.info(
+        "Deleted %d file versions from bucket `%s' in %s (%.1f files/s)",
+        count,
+        name,
+        human_time(elapsed),
+        count / elapsed if elapsed else 0.0,
+    )
+    return count
+
+
+def delete_bucket(name):
+    """Deletes an (empty) bucket"""
+
+    b2_api = api()
+    b2_api.delete_bucket(b2_api.get_bucket_by_name(name))
+
+
+def create_bucket(name, tp, lifecycle_rules):
+    """Creates a bucket, returns its identifier"""
+
+    bucket = api().create_bucket(name, tp, lifecycle_rules=lifecycle_rules)
+    return bucket.id_ + "\n"
+
+
+def list_buckets():
+    """Returns a dictionary mapping bucket names to their id and type"""
+
+    return dict((k.name, [k.id_, k.type_]) for k in api().list_buckets())
+
+
+def bucket_contents(name, folder=None):
+    """Lists file and folder names on a bucket (not recursively)"""
+
+    return [k.name for k in iter_bucket_contents(name, folder)]
@@ -9,13 +9,21 @@ Usage: %(prog)s [-v...] init [--b2-account-id=<id>] [--b2-account-key=<key>]
                 <password> <config> [<config> ...]
        %(prog)s [-v...] update [--b2-account-id=<id>] [--b2-account-key=<key>]
                 [--hostname=<name>] [--cache=<dir>] [--keep=<kept>]
-                [--max-recoveries=<int>] [--force-recovery]
+                [--max-recoveries=<int>] [--force-recovery] [--jobs=<n>]
+                [--skip-unchanged] [--verify-data=<n>]
+                [--prune-every=<days>] [--prune-after=<size>]
+                [--max-unused=<limit>] [--max-repack=<size>]
                 [--email=<cond> --email-receiver=<name> [--email-receiver=<name> ...] --email-sender=<name> --email-username=<user> --email-password=<pwd> [--email-server=<host>] [--email-port=<port>]]
-                [--run-daily-at=<hour>] <password> <config> [<config> ...]
+                [--run-daily-at=<hour> | --schedule=<cron>] [--jitter=<seconds>]
+                [--overlap=<policy>] [--metrics-port=<port>]
+                [--metrics-file=<path>] <password> <config> [<config> ...]
        %(prog)s [-v...] check [--b2-account-id=<id>] [--b2-account-key=<key>]
-                [--hostname=<name>] [--cache=<dir>] [--alarm=<seconds>]
+                [--hostname=<name>] [--cache=<dir>] [--alarm=<seconds>] [--jobs=<n>]
+                [--size-every=<days>]
                 [--email=<cond> --email-receiver=<name> [--email-receiver=<name> ...] --email-sender=<name> --email-username=<user> --email-password=<pwd> [--email-server=<host>] [--email-port=<port>]]
-                [--run-daily-at=<hour>] <password> <config> [<config> ...]
+                [--run-daily-at=<hour> | --schedule=<cron>] [--jitter=<seconds>]
+                [--overlap=<policy>] [--metrics-port=<port>]
+                [--metrics-file=<path>] <password> <config> [<config> ...]
        %(prog)s [-v...] init <file>
        %(prog)s [-v...] update <file>
        %(prog)s [-v...] check <file>
@@ -42,8 +50,8 @@ Commands:
   check    Continuously monitor your (remote) restic repository. Use this
            command to check and inform you whether your repository is not being
            updated as you'd like. You can run this command in one of two modes:
-           continuously if you pass the --run-daily-at flag, or for a single
-           check/report if that is not set.
+           continuously if you pass the --run-daily-at or --schedule flags, or
+           for a single check/report if those are not set.
 
 
 Arguments:
@@ -68,8 +76,10 @@ Options:
                                used multiple times
   -a, --alarm=<seconds>        Set the check condition so that an alarm is
                                issued if the latest snapshot on the repository
-                               is older than this number of seconds. A value of
-                               zero disables the alarm [default: 0]
+                               (or the last back-up skipped because of
+                               unchanged contents, if later) is older than
+                               this number of seconds. A value of zero
+                               disables the alarm [default: 0]
   -b, --b2-account-id=<id>     The BackBlaze B2 account identifier. Must be
                                set if ``config`` uses a BackBlaze bucket as
                                repository. Optionally, set the environment
@@ -91,11 +101,23 @@ Options:
                                pipe '|' symbol which indicate the number of
                                snapshots to keep for 'last', 'hourly', 'daily',
                                'weekly', 'monthly' and 'yearly' clean-ups. A
-                               value of zero disables that option. Notice we
+                               value of zero disables that option. Unless a
+                               pruning policy is set (see --prune-every), we
                                always prune the restic repository
                                [default: 0|0|7|8|12|2]
   -d, --run-daily-at=<hour>    Runs the back-up job daily at the specified
-                               time
+                               time. Several times may be separated by commas
+                               (e.g. "1:00,13:00")
+  -C, --schedule=<cron>        Runs the job following a cron expression, with
+                               5 fields: minute, hour, day of month, month and
+                               day of week (e.g. "30 */6 * * 1-5"). Several
+                               expressions may be separated by semi-colons
+  -J, --jitter=<seconds>       Delays each scheduled run by a random amount of
+                               time, up to this many seconds [default: 0]
+  -O, --overlap=<policy>       What to do if a scheduled run is due while the
+                               previous one is still running: "skip" it,
+                               "queue" it, or "coalesce" all pending runs
+                               into one [default: skip]
   -o, --overwrite              During initialization of a new restic
                                repository, overwrites contents of an existing
                                directory in case any exist. Use this option
@@ -128,6 +150,53 @@ Options:
   -R, --force-recovery         If set, then does not attempt an update of the
                                repository and starts with a recovery
                                immediately
+  -j, --jobs=<n>               The maximum number of repositories to update
+                               (or queries to run, while checking) in
+                               parallel. Repositories are independent, so
+                               network-bound transfers can overlap
+                               [default: 1]
+  -U, --skip-unchanged         If set, then skips the back-up (and the
+                               forget and check steps) of directories whose
+                               contents did not change since their last
+                               back-up. Changes are detected locally, from
+                               the metadata of all files in each directory.
+                               Check alarms count skipped back-ups as recent
+                               ones, if run with the same cache and hostname
+  -D, --verify-data=<n>        If greater than zero, then reads and verifies
+                               one out of <n> slices of the data stored on
+                               each repository at every update, so that all
+                               data is verified every <n> updates (days, if
+                               running daily). Use zero to only check the
+                               repository metadata [default: 0]
+  -E, --prune-every=<days>     If greater than zero, then only prune each
+                               repository if it was not pruned for this many
+                               days (or if --prune-after triggers). Forgetting
+                               old snapshots still happens at every update
+                               [default: 0]
+  -A, --prune-after=<size>     If greater than zero, then also prune a
+                               repository once this much data (in bytes, or
+                               with a K, M, G or T suffix) was added to it
+                               since its last prune [default: 0]
+  -X, --max-unused=<limit>     Unused space to tolerate on a repository while
+                               pruning, as a percentage (e.g. "5%%") or size
+                               (e.g. "10G"). If not set, use restic's default
+  -Y, --max-repack=<size>      Maximum amount of data to repack on each prune
+                               (e.g. "2G"), to bound its duration. If not set,
+                               repack all that is required
+  -Z, --size-every=<days>      Sizes of B2 repositories are only computed
+                               (which requires listing, and paying for, all
+                               files on the bucket) if the last computation
+                               is older than this many days. In-between, they
+                               are estimated from the data added by each
+                               update. Use zero to always compute them
+                               [default: 7]
+  -m, --metrics-port=<port>    If set, serves Prometheus metrics about the
+                               last runs (durations of each step, data added,
+                               snapshots, recoveries, scheduler lag, etc.) over
+                               HTTP, on this port
+  -t, --metrics-file=<path>    If set, writes the same metrics to this file
+                               after each run, for the textfile collector of
+                               node-exporter (the name must end in ".prom")
 
 
 Examples:
@@ -153,6 +222,10 @@ Examples:
 
      $ %(prog)s -vv update --run-daily-at='1:00' --hostname=my-host "password" "/data|/backup"
 
+     Or, every 6 hours on weekdays, with up to 10 minutes of random delay:
+
+     $ %(prog)s -vv update --schedule='0 */6 * * 1-5' --jitter=600 --hostname=my-host "password" "/data|/backup"
+
   6. Runs a single repository check, reports:
 
      $ %(prog)s -vv check --hostname=my-host "password" "/data|/backup"
@@ -177,10 +250,6 @@ logger = logging.getLogger(__name__)
 
 import docopt
 
-from . import restic
-from . import b2
-from . import commands
-
 
 def main(user_input=None):
 
@@ -220,14 +289,17 @@ def main(user_input=None):
 
     logger = setup_logger("baker", args["--verbose"])
 
+    # imported only once we know there is work to do
+    from . import b2
+    from . import utils
+    from . import commands
+
     # log
     logger.info(
         "Baker version %s (running on %s)",
         completions["version"],
         args["--hostname"],
     )
-    logger.info(" - %s", restic.version().split("\n")[0])
-    logger.info(" - %s", b2.version().split("\n")[0])
 
     # do some commandline parsing
     config = collections.OrderedDict([k.split("|") for k in args["<config>"]])
@@ -294,6 +366,41 @@ def main(user_input=None):
             )
         logger.info("Caching restic requests at: %s", args["--cache"])
 
+    versions = [utils.tool_version("restic", cache=args["--cache"])]
+    if b2_cred:  # b2sdk is slow to import, only needed for B2 repositories
+        versions.append(b2.version(cache=args["--cache"]))
+    for version in versions:
+        logger.info(" - %s", version.split("\n")[0])
+
+    # verify schedule
+    period = args["--schedule"] or args["--run-daily-at"]
+    if period is not None:
+        from .scheduler import parse, OVERLAP_POLICIES
+
+        parse(period)  # raises if the specification is invalid
+        if args["--overlap"] not in OVERLAP_POLICIES:
+            raise RuntimeError(
+                "Overlap policy must be one of %s, not `%s'"
+                % (", ".join(OVERLAP_POLICIES), args["--overlap"])
+            )
+        logger.info(
+            "Scheduling at `%s' (jitter: %s seconds, on overlap: %s)",
+            period,
+            args["--jitter"],
+            args["--overlap"],
+        )
+
+    # optional metrics, only loaded if requested
+    metrics = None
+    if args["--metrics-port"] is not None or args["--metrics-file"]:
+        from .metrics import Metrics
+
+        metrics = Metrics(path=args["--metrics-file"])
+        if args["--metrics-port"] is not None:
+            metrics.serve(int(args["--metrics-port"]))
+        if args["--metrics-file"]:
+            logger.info("Writing metrics to `%s'", args["--metrics-file"])
+
     if args["init"]:
         try:
             commands.init(
@@ -319,6 +426,23 @@ def main(user_input=None):
         for key, value in keep.items():
             logger.info(" - %s: %d", key.capitalize(), value)
 
+        prune = None
+        if (
+            int(args["--prune-every"]) > 0
+            or utils.parse_size(args["--prune-after"]) > 0
+            or args["--max-unused"] is not None
+            or args["--max-repack"] is not None
+        ):
+            prune = dict(
+                every=int(args["--prune-every"]),
+                after=utils.parse_size(args["--prune-after"]),
+                max_unused=args["--max-unused"],
+                max_repack_size=args["--max-repack"],
+            )
+            logger.info("Pruning policy (--prune-* flags):")
+            for key, value in prune.items():
+                logger.info(" - %s: %s", key.replace("_", " "), value)
+
         try:
             commands.update(
                 configs=config,
@@ -328,9 +452,16 @@ def main(user_input=None):
                 email=email,
                 b2_cred=b2_cred,
                 keep=keep,
-                period=args["--run-daily-at"],
+                period=period,
                 max_recoveries=int(args["--max-recoveries"]),
                 force_recovery=args["--force-recovery"],
+                jobs=int(args["--jobs"]),
+                skip_unchanged=args["--skip-unchanged"],
+                verify=int(args["--verify-data"]),
+                prune=prune,
+                jitter=float(args["--jitter"]),
+                overlap=args["--overlap"],
+                metrics=metrics,
             )
         except Exception as e:
             raise RuntimeError(
@@ -348,7 +479,12 @@ def main(user_input=None):
                 email=email,
                 b2_cred=b2_cred,
                 alarm=int(args["--alarm"]),
-                period=args["--run-daily-at"],
+                period=period,
+                jobs=int(args["--jobs"]),
+                jitter=float(args["--jitter"]),
+                overlap=args["--overlap"],
+                size_every=int(args["--size-every"]),
+                metrics=metrics,
             )
         except Exception as e:
             raise RuntimeError(
@@ -0,0 +1,637 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Benchmarks baker's own overhead, and end-to-end runs
+
+Usage: %(prog)s [-v...] startup [--repeat=<n>] [--budget-version=<ms>]
+                [--budget-check=<ms>]
+       %(prog)s [-v...] runs [--files=<n>] [--sizes=<dist>] [--churn=<f>]
+                [--updates=<n>] [--seed=<n>] [--history=<path>]
+                [--tolerance=<percent>]
+       %(prog)s --help
+
+
+Commands:
+
+  startup  Measures the time ``bake --version`` takes to run, and the time
+           ``bake check`` takes until it calls restic for the first time.
+           Stand-ins for restic and b2 are used, so no real repository is
+           needed and only baker's own start-up is measured.
+  runs     Generates a synthetic directory tree, and times ``bake init``
+           on a local repository, followed by a number of ``bake update``
+           runs (each after changing part of the tree) and ``bake check``.
+           The restic found on the ${PATH} is used.  For each command, the
+           wall time, peak memory and number (and CPU time) of restic
+           invocations are recorded, as well as the time e-mail reports
+           take to render.  Results are appended to a JSON history and
+           compared to the last comparable entry.
+
+
+Options:
+
+  -h, --help                Shows this help message and exits
+  -v, --verbose             Increases the output verbosity level. May be
+                            used multiple times
+  -n, --repeat=<n>          Number of times each measurement is repeated.
+                            The median is reported [default: 5]
+  -a, --budget-version=<ms> If set, exits with an error if the median time
+                            of ``bake --version`` exceeds this value, in
+                            milliseconds
+  -b, --budget-check=<ms>   If set, exits with an error if the median time
+                            until the first restic call of ``bake check``
+                            exceeds this value, in milliseconds
+  -f, --files=<n>           Number of files on the synthetic tree
+                            [default: 1000]
+  -s, --sizes=<dist>        Distribution of file sizes: either a fixed size
+                            (e.g. "4K"), a range ("1K-1M", drawn
+                            log-uniformly) or "lognormal:<median>"
+                            [default: 1K-64K]
+  -c, --churn=<f>           Fraction of files changed before each update:
+                            half are rewritten, a quarter removed and as
+                            many new files added [default: 0.05]
+  -u, --updates=<n>         Number of updates to time. Medians are reported
+                            [default: 3]
+  -S, --seed=<n>            Seed for the generation of the tree and of its
+                            changes [default: 0]
+  -H, --history=<path>      JSON file where results are appended
+                            [default: benchmark-history.json]
+  -t, --tolerance=<percent> If set, exits with an error if any measurement
+                            is worse than on the last comparable entry of
+                            the history by more than this percentage
+
+"""
+
+import os
+import sys
+import glob
+import json
+import math
+import stat
+import time
+import random
+import datetime
+import tempfile
+import statistics
+import subprocess
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+_BAKE = [
+    sys.executable,
+    "-c",
+    "import sys; sys.argv[0] = 'bake'; "
+    "from baker.bake import main; sys.exit(main())",
+]
+"""Runs ``bake`` with the current interpreter"""
+
+
+_RESTIC_STUB = """#!/bin/sh
+if [ "$1" = "version" ]; then
+  echo "restic 0.0.0 (baker benchmark stand-in)"
+  exit 0
+fi
+touch "$BAKER_BENCHMARK_MARK"
+exit 1
+"""
+"""Stand-in for restic: records the time of the first real call, and fails"""
+
+
+_B2_STUB = """#!/bin/sh
+echo "b2 command line tool, version 0.0.0 (baker benchmark stand-in)"
+"""
+"""Stand-in for the b2 command-line tool"""
+
+
+def _install(directory, name, contents):
+    """Installs an executable script on a directory"""
+
+    path = os.path.join(directory, name)
+    with open(path, "wt") as f:
+        f.write(contents)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+
+
+def time_version():
+    """Returns the time ``bake --version`` takes to run, in seconds"""
+
+    start = time.perf_counter()
+    subprocess.run(_BAKE + ["--version"], check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def time_check(directory, env):
+    """Returns the time ``bake check`` takes to call restic, in seconds
+
+    The time is measured from the start of the process until the restic
+    stand-in is called with a command other than ``version``.
+    """
+
+    mark = env["BAKER_BENCHMARK_MARK"]
+    if os.path.exists(mark):
+        os.unlink(mark)
+
+    cache = os.path.join(directory, "cache")
+    config = "%s|%s" % (directory, os.path.join(directory, "repo"))
+
+    start = time.time_ns()
+    subprocess.run(
+        _BAKE + ["check", "--cache=%s" % cache, "password", config],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+    if not os.path.exists(mark):
+        raise RuntimeError("`bake check' did not call restic")
+    return (os.stat(mark).st_mtime_ns - start) / 1e9
+
+
+def startup(repeat):
+    """Measures start-up times
+
+
+    Parameters:
+
+      repeat (int): The number of times each measurement is repeated
+
+
+    Returns:
+
+      dict: A dictionary mapping each measurement (``version``, ``check``
+      and ``check (cold)``) to the median time it took, in seconds
+
+    """
+
+    results = {}
+
+    results["version"] = statistics.median(
+        [time_version() for k in range(repeat)]
+    )
+
+    with tempfile.TemporaryDirectory() as directory:
+
+        tools = os.path.join(directory, "bin")
+        os.makedirs(tools)
+        os.makedirs(os.path.join(directory, "cache"))
+        os.makedirs(os.path.join(directory, "repo"))
+        _install(tools, "restic", _RESTIC_STUB)
+        _install(tools, "b2", _B2_STUB)
+
+        env = dict(os.environ)
+        env["PATH"] = tools + os.pathsep + env.get("PATH", "")
+        env["BAKER_BENCHMARK_MARK"] = os.path.join(directory, "mark")
+
+        # the first run has to probe tool versions
+        results["check (cold)"] = time_check(directory, env)
+        results["check"] = statistics.median(
+            [time_check(directory, env) for k in range(repeat)]
+        )
+
+    return results
+
+
+_EMAIL_SNAPSHOTS = 365
+"""Number of snapshots listed on e-mails, while timing their rendering"""
+
+
+_EMAIL_LOG_LINES = 5000
+"""Number of log lines attached to e-mails, while timing their rendering"""
+
+
+def parse_sizes(spec):
+    """Parses a distribution of file sizes
+
+
+    Parameters:
+
+      spec (str): Either a size (e.g. ``4K``), a range of sizes, from which
+        sizes are drawn log-uniformly (e.g. ``1K-1M``), or
+        ``lognormal:<median>``, for a log-normal distribution with that
+        median
+
+
+    Returns:
+
+      callable: A function that draws a size, in bytes, given a
+      :py:class:`random.Random` object
+
+    """
+
+    from .utils import parse_size
+
+    if spec.startswith("lognormal:"):
+        mu = math.log(parse_size(spec.split(":", 1)[1]))
+        return lambda rng: int(rng.lognormvariate(mu, 1.0))
+
+    if "-" in spec:
+        low, high = [math.log(max(1, parse_size(k))) for k in spec.split("-")]
+        if low > high:
+            raise ValueError("invalid range of sizes `%s'" % spec)
+        return lambda rng: int(math.exp(rng.uniform(low, high)))
+
+    size = parse_size(spec)
+    return lambda rng: size
+
+
+def _write_file(path, size, rng):
+    """Writes a file with (incompressible) random contents"""
+
+    # getrandbits() refuses zero bits before Python 3.9
+    data = rng.getrandbits(8 * size).to_bytes(size, "little") if size else b""
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def generate_tree(directory, files, sizes, rng, per_directory=100):
+    """Generates a synthetic tree of files, returns their paths
+
+    Files are spread over sub-directories holding ``per_directory`` files
+    each.  ``sizes`` draws file sizes (see :py:func:`parse_sizes`).
+    """
+
+    paths = []
+    for k in range(files):
+        subdir = os.path.join(directory, "d%04d" % (k // per_directory))
+        if k % per_directory == 0:
+            os.makedirs(subdir, exist_ok=True)
+        path = os.path.join(subdir, "f%06d.bin" % k)
+        _write_file(path, sizes(rng), rng)
+        paths.append(path)
+    return paths
+
+
+def churn(paths, fraction, sizes, rng):
+    """Changes a fraction of the files on a tree, returns the new paths
+
+    Half of the changed files are rewritten, a quarter are removed, and as
+    many new files are added, on random sub-directories.
+    """
+
+    changed = int(round(fraction * len(paths)))
+    if changed == 0 or not paths:
+        return paths
+
+    removed = changed // 4
+    rewritten = changed - 2 * removed
+    paths = list(paths)
+    rng.shuffle(paths)
+
+    for path in paths[:rewritten]:
+        _write_file(path, sizes(rng), rng)
+
+    for path in paths[rewritten : rewritten + removed]:
+        os.unlink(path)
+    del paths[rewritten : rewritten + removed]
+
+    for k in range(removed):
+        subdir = os.path.dirname(rng.choice(paths))
+        path = os.path.join(subdir, "n%08x.bin" % rng.getrandbits(32))
+        _write_file(path, sizes(rng), rng)
+        paths.append(path)
+
+    return paths
+
+
+def _last_report(cache, command):
+    """Returns the last run report of a command (see :py:mod:`.spans`)"""
+
+    from .utils import baker_cache
+
+    reports = glob.glob(
+        os.path.join(baker_cache(cache), "reports", "%s-*.json" % command)
+    )
+    if not reports:
+        raise RuntimeError("`bake %s' did not write a run report" % command)
+    with open(max(reports, key=os.path.getmtime), "rt") as f:
+        return json.load(f)
+
+
+def _errors(report):
+    """Returns the errors of all steps on a run report"""
+
+    retval = [report["error"]] if report["error"] else []
+    for child in report["children"]:
+        retval += _errors(child)
+    return retval
+
+
+def time_command(arguments, cache, env):
+    """Runs ``bake``, and returns measurements of the run
+
+    The time and peak memory (of ``bake`` or any of the commands it ran) are
+    measured on the process itself.  The number of restic invocations and
+    their CPU time and peak memory are taken from the run report.
+
+
+    Parameters:
+
+      arguments (list): The arguments to ``bake``, starting with the command
+
+      cache (str): The cache directory passed to ``bake``
+
+      env (dict): The environment to run ``bake`` on
+
+
+    Returns:
+
+      dict: Measurements (``wall``, ``peak_memory``, ``restic_calls``,
+      ``restic_cpu`` and ``restic_peak_memory``), times are in seconds and
+      memory in bytes
+
+    """
+
+    from .utils import exit_code
+
+    with tempfile.TemporaryFile("w+t") as errors:
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            _BAKE + arguments,
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=errors,
+        )
+        _, status, rusage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - start
+        process.returncode = exit_code(status)
+        if process.returncode != 0:
+            errors.seek(0)
+            raise RuntimeError(
+                "`bake %s' exited with error state (%d):\n%s"
+                % (arguments[0], process.returncode, errors.read())
+            )
+
+    report = _last_report(cache, arguments[0])
+    failures = _errors(report)
+    if failures:
+        raise RuntimeError(
+            "`bake %s' failed: %s" % (arguments[0], "; ".join(failures))
+        )
+
+    return dict(
+        wall=wall,
+        peak_memory=rusage.ru_maxrss * 1024,
+        restic_calls=report["commands"],
+        restic_cpu=report["cpu"],
+        restic_peak_memory=report["maxrss"],
+    )
+
+
+def time_email(repeat):
+    """Times the rendering of an update e-mail, with a year of snapshots
+
+    Returns the time (in seconds) the first rendering takes (including the
+    compilation of templates), and the median of ``repeat`` further ones.
+    """
+
+    from . import commands, reporter, restic, spans, utils
+
+    now = datetime.datetime.now()
+    log = utils.OutputBuffer()
+    for k in range(_EMAIL_LOG_LINES):
+        log.write("line %d of the log of a restic command\n" % k)
+    with spans.span("update") as run:
+        with spans.span("repository", directory="/data", repository="/repo"):
+            for step in ("backup", "forget", "check"):
+                with spans.span(step):
+                    pass
+
+    context = dict(
+        configs={"/data": "/repo"},
+        summaries={"/repo": restic.BackupSummary("0123abcd", *([1] * 10))},
+        unchanged={},
+        snapshots=[
+            dict(
+                time=now - datetime.timedelta(days=k),
+                paths=["/data"],
+                short_id="%08x" % k,
+            )
+            for k in range(_EMAIL_SNAPSHOTS)
+        ],
+        log=str(log),
+        hostname="benchmark",
+        recovery=False,
+        report=run,
+    )
+    log.close()
+
+    def _render():
+        start = time.perf_counter()
+        env = commands._template_environment()
+        reporter.Email(
+            env.get_template("update/subject_success.txt").render(**context),
+            env.get_template("update/body_success.txt").render(**context),
+            env.get_template("update/body_success.html").render(**context),
+            "nobody@example.com",
+            ["nobody@example.com"],
+        ).message()
+        return time.perf_counter() - start
+
+    commands._templates = None  # starts cold
+    cold = _render()
+    warm = statistics.median([_render() for k in range(repeat)])
+    return dict(cold=cold, warm=warm)
+
+
+def runs(files, sizes, fraction, updates, seed):
+    """Times ``bake init``, ``update`` and ``check`` on a synthetic tree
+
+
+    Parameters:
+
+      files (int): The number of files on the tree
+
+      sizes (str): The distribution of file sizes (see
+        :py:func:`parse_sizes`)
+
+      fraction (float): The fraction of files changed before each update
+        (see :py:func:`churn`)
+
+      updates (int): The number of updates to run
+
+      seed (int): The seed for the generation of the tree and its changes
+
+
+    Returns:
+
+      dict: A dictionary mapping each command (and ``email``) to its
+      measurements (see :py:func:`time_command` and :py:func:`time_email`).
+      Measurements of updates are medians.
+
+    """
+
+    from .utils import which
+
+    if not which("restic"):
+        raise RuntimeError(
+            "The executable `restic' must be available on your ${PATH}"
+        )
+
+    rng = random.Random(seed)
+    draw = parse_sizes(sizes)
+    results = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+
+        data = os.path.join(directory, "data")
+        cache = os.path.join(directory, "cache")
+        os.makedirs(cache)
+        paths = generate_tree(data, files, draw, rng)
+
+        config = "%s|%s" % (data, os.path.join(directory, "repo"))
+        options = ["--cache=%s" % cache, "--hostname=benchmark", "password"]
+        env = dict(os.environ)
+
+        logger.info("Timing `bake init' on %d files", files)
+        results["init"] = time_command(
+            ["init"] + options + [config], cache, env
+        )
+
+        rounds = []
+        for k in range(updates):
+            paths = churn(paths, fraction, draw, rng)
+            logger.info("Timing `bake update' (%d/%d)", k + 1, updates)
+            rounds.append(
+                time_command(["update"] + options + [config], cache, env)
+            )
+        if rounds:
+            results["update"] = dict(
+                (key, statistics.median([k[key] for k in rounds]))
+                for key in rounds[0]
+            )
+
+        logger.info("Timing `bake check'")
+        results["check"] = time_command(
+            ["check"] + options + [config], cache, env
+        )
+
+    results["email"] = time_email(max(1, updates))
+
+    return results
+
+
+def _format(name, value):
+    """Formats a measurement for display"""
+
+    from .reporter import humanize_bytes
+
+    if name.endswith("memory"):
+        return humanize_bytes(value)
+    if name.endswith("calls"):
+        return "%d" % value
+    return "%.1f ms" % (value * 1000)
+
+
+def compare(results, previous, tolerance=None):
+    """Prints results, compared to previous ones, returns an exit status
+
+    Returns ``1`` if any measurement is worse than the previous one by more
+    than ``tolerance`` percent, or ``0`` otherwise.
+    """
+
+    retval = 0
+    for command, values in results.items():
+        for name, value in values.items():
+            line = "%-7s %-19s %14s" % (command, name, _format(name, value))
+            old = (previous or {}).get(command, {}).get(name)
+            if old:
+                change = 100.0 * (value - old) / old
+                line += " (%+.1f%%)" % change
+                if tolerance is not None and change > tolerance:
+                    line += " over tolerance"
+                    retval = 1
+            print(line)
+    return retval
+
+
+def main(user_input=None):
+
+    import docopt
+
+    from .reporter import setup_logger
+
+    argv = user_input if user_input is not None else sys.argv[1:]
+    args = docopt.docopt(
+        __doc__ % dict(prog=os.path.basename(sys.argv[0])), argv=argv
+    )
+
+    setup_logger("baker", args["--verbose"])
+
+    if args["runs"]:
+        return _main_runs(args)
+
+    results = startup(int(args["--repeat"]))
+
+    budgets = {
+        "version": args["--budget-version"],
+        "check": args["--budget-check"],
+    }
+
+    retval = 0
+    for name, value in results.items():
+        budget = budgets.get(name)
+        status = ""
+        if budget is not None:
+            if value * 1000 > float(budget):
+                status = " (over budget of %s ms)" % budget
+                retval = 1
+            else:
+                status = " (within budget of %s ms)" % budget
+        print("%-14s %8.1f ms%s" % (name, value * 1000, status))
+
+    return retval
+
+
+def _main_runs(args):
+    """Runs the end-to-end benchmark, and records it on the history"""
+
+    import importlib.metadata
+
+    from .utils import read_state, write_state, tool_version
+
+    parameters = dict(
+        files=int(args["--files"]),
+        sizes=args["--sizes"],
+        churn=float(args["--churn"]),
+        updates=int(args["--updates"]),
+        seed=int(args["--seed"]),
+    )
+
+    results = runs(
+        parameters["files"],
+        parameters["sizes"],
+        parameters["churn"],
+        parameters["updates"],
+        parameters["seed"],
+    )
+
+    history = read_state(args["--history"], [])
+    previous = [k for k in history if k["parameters"] == parameters]
+    if previous:
+        print("Compared to the run of %s:" % previous[-1]["time"])
+
+    tolerance = args["--tolerance"]
+    retval = compare(
+        results,
+        previous[-1]["results"] if previous else None,
+        float(tolerance) if tolerance is not None else None,
+    )
+
+    history.append(
+        dict(
+            time=datetime.datetime.now().isoformat(timespec="seconds"),
+            version=importlib.metadata.version(__package__),
+            restic=tool_version("restic").split("\n")[0],
+            parameters=parameters,
+            results=results,
+        )
+    )
+    write_state(args["--history"], history)
+
+    return retval
+
+
+if __name__ == "__main__":
+    sys.exit(main())
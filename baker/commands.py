@@ -6,19 +6,23 @@
 import os
 import time
 import shutil
+import asyncio
 import datetime
+import threading
 import traceback
+import contextvars
 import importlib.metadata
+import concurrent.futures
 
 import logging
 
 logger = logging.getLogger(__name__)
 
-import schedule
-import jinja2
-
 from . import utils
 from . import restic
+from . import index
+from . import spans
+from . import scheduler
 from . import reporter
 from . import b2
 
@@ -35,6 +39,137 @@ def _ordinal(n):
     )
 
 
+def _environment(b2_cred):
+    """Returns a new environment for a job, with B2 credentials, if required
+
+    Each job gets its own copy of :py:obj:`os.environ`, so that concurrent jobs
+    do not step on each other's toes.
+    """
+
+    env = dict(os.environ)
+    if b2_cred:
+        env["B2_ACCOUNT_ID"] = b2_cred["id"]
+        env["B2_ACCOUNT_KEY"] = b2_cred["key"]
+    return env
+
+
+def _local_size(path, cache):
+    """Returns the size of a local directory, re-scanning only what changed"""
+
+    return utils.get_size(path, state=utils.state_path(cache, "sizes", path))
+
+
+def _cache_size(cache):
+    """Returns the size of the cache directory, for our templates"""
+
+    path = cache
+    if path is None:  # restic's default
+        path = os.path.join(os.path.dirname(utils.baker_cache(None)), "restic")
+    return _local_size(path, cache)
+
+
+def _bucket_size(repo, cache, every=0):
+    """Returns the (estimated) size of a B2 repository, in bytes
+
+    Computing the size of a bucket requires listing all its file versions,
+    which is billed by BackBlaze.  The size is, therefore, only computed if
+    the last computation is older than ``every`` days (or always, if that is
+    zero).  In-between, it is estimated from the last computed size and the
+    amount of data added by each back-up since (see :py:func:`_account_size`).
+    The estimate does not account for data removed by pruning.
+    """
+
+    path = utils.state_path(cache, "bucket-sizes", repo)
+    state = utils.read_state(path, {})
+
+    # tolerates an hour of drift, so daily jobs are not delayed by a day
+    if "time" in state and every > 0:
+        elapsed = time.time() - state["time"]
+        if elapsed < (every * 86400 - 3600):
+            size = state["size"] + state.get("added", 0)
+            logger.info(
+                "Estimated size of `%s' is %s (computed %s ago, plus data "
+                "added since)",
+                repo,
+                reporter.humanize_bytes(size),
+                reporter.human_time(elapsed),
+            )
+            return size
+
+    size = b2.get_bucket(repo[3:])["totalSize"]
+    utils.write_state(path, dict(size=size, time=time.time(), added=0))
+    return size
+
+
+def _account_size(cache, repo, summary):
+    """Adds the data of a back-up to the estimated size of a B2 repository"""
+
+    path = utils.state_path(cache, "bucket-sizes", repo)
+    state = utils.read_state(path, {})
+    if "time" not in state:  # unknown, computed on the next request
+        return
+    added = state.get("added", 0) + summary.data_added
+    utils.write_state(path, dict(state, added=added))
+
+
+_templates = None
+"""The template environment, see :py:func:`_template_environment`"""
+
+_templates_lock = threading.Lock()
+
+
+def _template_environment():
+    """Returns the environment for rendering our templates
+
+    The environment is built on the first call and reused afterwards, so that
+    templates are only loaded and compiled once per process.  If the
+    environment variable ``BAKER_TEMPLATE_CACHE`` points to a directory, then
+    compiled templates are also cached there, across processes.
+    """
+
+    global _templates
+
+    with _templates_lock:
+
+        if _templates is not None:
+            return _templates
+
+        import jinja2  # only required for reporting
+
+        bytecode_cache = None
+        if os.environ.get("BAKER_TEMPLATE_CACHE"):
+            directory = os.environ["BAKER_TEMPLATE_CACHE"]
+            os.makedirs(directory, exist_ok=True)
+            bytecode_cache = jinja2.FileSystemBytecodeCache(directory)
+
+        env = jinja2.Environment(
+            loader=jinja2.PackageLoader(__package__, "templates"),
+            autoescape=jinja2.select_autoescape(
+                disabled_extensions=("txt",),
+                default_for_string=True,
+                default=True,
+            ),
+            bytecode_cache=bytecode_cache,
+            auto_reload=False,
+        )
+
+        # adds personalized filters for our templates
+        env.filters["bake_pluralize"] = reporter.pluralize
+        env.filters["du_dir"] = _cache_size
+        env.filters["format_datetime"] = reporter.format_datetime
+        env.filters["humanize_time"] = reporter.humanize_time
+        env.filters["summarize_seconds"] = reporter.summarize_seconds
+        env.filters["humanize_bytes"] = reporter.humanize_bytes
+        env.filters["short_id"] = restic.short_id
+
+        # package variables, available to all templates
+        env.globals["package"] = "baker"
+        env.globals["version"] = importlib.metadata.version(__package__)
+
+        _templates = env
+        return _templates
+
+
 def _send_message(
     subject_template,
     body_template_text,
@@ -43,26 +178,25 @@ def _send_message(
     email,
     error,
 ):
-    """Sends an e-mail message or logs only"""
+    """Sends an e-mail message or logs only
 
-    env = jinja2.Environment(
-        loader=jinja2.PackageLoader(__package__, "templates"),
-        autoescape=jinja2.select_autoescape(
-            disabled_extensions=("txt",), default_for_string=True, default=True
-        ),
+    Messages that would neither be sent, nor logged (because the debug level
+    is not enabled), are not rendered.
+    """
+
+    send = ("condition" in email) and (
+        (email["condition"] == "always")
+        or (email["condition"] == "onerror" and error)
     )
 
-    # adds personalized filters for our templates
-    env.filters["bake_pluralize"] = reporter.pluralize
-    env.filters["du_dir"] = utils.get_size
-    env.filters["format_datetime"] = reporter.format_datetime
-    env.filters["humanize_time"] = reporter.humanize_time
-    env.filters["summarize_seconds"] = reporter.summarize_seconds
-    env.filters["humanize_bytes"] = reporter.humanize_bytes
+    if not (send or logger.isEnabledFor(logging.DEBUG)):
+        return
+
+    env = _template_environment()
 
-    # completes the context with package variables
-    context["package"] = "baker"
-    context["version"] = importlib.metadata.version(__package__)
+    # the log may be long (and spilled to disk): converts it only once
+    if context.get("log") is not None:
+        context = dict(context, log=str(context["log"]))
 
     subject = env.get_template(subject_template).render(**context)
     body_text = env.get_template(body_template_text).render(**context)
@@ -77,13 +211,10 @@ def _send_message(
 
     msg = reporter.Email(subject, body_text, body_html, sender, receiver)
 
-    if ("condition" in email) and (
-        (email["condition"] == "always")
-        or (email["condition"] == "onerror" and error)
-    ):
-        msg.send(
+    if send:
+        reporter.notifier(
             email["server"], email["port"], email["username"], email["password"]
-        )
+        ).submit(msg)
     else:
         logger.debug(msg.message())
 
@@ -91,94 +222,120 @@ def _send_message(
 def init(configs, password, cache, overwrite, hostname, email, b2_cred):
     """Initializes a new set of repositories based on the configs"""
 
-    if b2_cred:
-        os.environ.setdefault("B2_ACCOUNT_ID", b2_cred["id"])
-        os.environ.setdefault("B2_ACCOUNT_KEY", b2_cred["key"])
+    env = _environment(b2_cred)
 
-    log = ""
+    log = utils.OutputBuffer()
     sizes = {}
+    summaries = {}
     snapshots = []
 
     try:
 
-        for dire, repo in configs.items():
-
-            if repo.startswith("b2:"):  # BackBlaze B2 repository
-                log += b2.authorize_account(b2_cred["id"], b2_cred["key"])
-                if repo[3:] in b2.list_buckets():
-                    if overwrite:
-                        b2.remove_bucket(repo[3:])
-                    else:
-                        raise RuntimeError(
-                            "BackBlaze B2 bucket `%s' already exists "
-                            "and you did not pass --overwrite" % (repo)
-                        )
-                log += b2.create_bucket(repo[3:])
+        with spans.span("init", hostname=hostname) as run:
 
-            else:
-                if os.path.exists(repo):
-                    if os.listdir(repo):
-                        if overwrite:
-                            logger.info(
-                                "Removing directory `%s' on user request", repo
-                            )
-                            shutil.rmtree(repo)
-                            os.makedirs(repo)
-                        else:
-                            raise RuntimeError(
-                                "Directory `%s' already exists "
-                                "and you did not pass --overwrite" % (repo)
-                            )
-                else:
-                    os.makedirs(repo)
+            with index.SnapshotIndex(
+                index.default_path(cache)
+            ) as snapshot_index:
 
-            log += restic.init(
-                repository=repo,
-                global_options=[],
-                password=password,
-                cache=cache,
-            )
+                if any(k.startswith("b2:") for k in configs.values()):
+                    b2.authorize(b2_cred["id"], b2_cred["key"], output=log)
 
-            log += restic.backup(
-                directory=dire,
-                repository=repo,
-                global_options=[],
-                hostname=hostname,
-                backup_options=[],
-                password=password,
-                cache=cache,
-            )
+                for dire, repo in configs.items():
 
-            snapshots += restic.snapshots(
-                repository=repo,
-                global_options=[],
-                hostname=hostname,
-                password=password,
-                cache=cache,
-            )
+                    with spans.span("create", repository=repo):
+                        if repo.startswith("b2:"):  # BackBlaze B2 repository
+                            if repo[3:] in b2.list_buckets():
+                                if overwrite:
+                                    b2.remove_bucket(repo[3:])
+                                else:
+                                    raise RuntimeError(
+                                        "BackBlaze B2 bucket `%s' already "
+                                        "exists and you did not pass "
+                                        "--overwrite" % (repo)
+                                    )
+                            b2.create_bucket(repo[3:], output=log)
 
-            if repo.startswith("b2:"):
-                info = b2.get_bucket(repo[3:])
-                sizes[repo] = info["totalSize"]
-            else:
-                sizes[repo] = utils.get_size(repo)
+                        else:
+                            if os.path.exists(repo):
+                                if os.listdir(repo):
+                                    if overwrite:
+                                        logger.info(
+                                            "Removing directory `%s' on user "
+                                            "request",
+                                            repo,
+                                        )
+                                        shutil.rmtree(repo)
+                                        os.makedirs(repo)
+                                    else:
+                                        raise RuntimeError(
+                                            "Directory `%s' already exists "
+                                            "and you did not pass --overwrite"
+                                            % (repo)
+                                        )
+                            else:
+                                os.makedirs(repo)
+
+                    with spans.span("init", repository=repo):
+                        restic.init(
+                            repository=repo,
+                            global_options=[],
+                            password=password,
+                            cache=cache,
+                            env=env,
+                            output=log,
+                        )
 
-            context = dict(
-                configs=configs,
-                sizes=sizes,
-                snapshots=snapshots,
-                cache=cache,
-                log=log,
-                hostname=hostname,
-            )
-            _send_message(
-                "init/subject_success.txt",
-                "init/body_success.txt",
-                "init/body_success.html",
-                context,
-                email,
-                error=False,
-            )
+                    # the previous manifest refers to a snapshot of another
+                    # repository
+                    manifest = _manifest_path(cache, dire, repo, hostname)
+                    if os.path.exists(manifest):
+                        os.remove(manifest)
+
+                    # a new repository has nothing to prune
+                    _pruned(cache, repo)
+
+                    with spans.span("backup", repository=repo):
+                        summaries[repo] = restic.backup_json(
+                            directory=dire,
+                            repository=repo,
+                            global_options=[],
+                            hostname=hostname,
+                            backup_options=[],
+                            password=password,
+                            cache=cache,
+                            env=env,
+                            output=log,
+                        )
+
+                    # the repository may have been overwritten
+                    with spans.span("index", repository=repo):
+                        snapshot_index.remove(repo, snapshot_index.ids(repo))
+                        snapshot_index.refresh(repo, password, cache, env)
+                        snapshots += snapshot_index.snapshots(repo, hostname)
+
+                    with spans.span("size", repository=repo):
+                        if repo.startswith("b2:"):
+                            sizes[repo] = _bucket_size(repo, cache)
+                        else:
+                            sizes[repo] = _local_size(repo, cache)
+
+                    context = dict(
+                        configs=configs,
+                        sizes=sizes,
+                        summaries=summaries,
+                        snapshots=snapshots,
+                        cache=cache,
+                        log=log,
+                        hostname=hostname,
+                    )
+                    _send_message(
+                        "init/subject_success.txt",
+                        "init/body_success.txt",
+                        "init/body_success.html",
+                        context,
+                        email,
+                        error=False,
+                    )
 
     except Exception:
         logger.error("Error at initialization:\n%s", traceback.format_exc())
@@ -198,7 +355,28 @@ def init(configs, password, cache, overwrite, hostname, email, b2_cred):
             error=True,
         )
 
-    return log, sizes, snapshots
+    _write_report(run, cache)
+
+    return str(log), sizes, snapshots
+
+
+def _step(name, recovery, **attributes):
+    """Returns a span (see :py:func:`.spans.span`) for a step of an update"""
+
+    if recovery > 0:
+        attributes["recovery"] = _ordinal(recovery)
+    return spans.span(
+        name, **dict((k, v) for k, v in attributes.items() if v is not None)
+    )
+
+
+def _write_report(run, cache):
+    """Writes the report of a run, logging (instead of raising) errors"""
+
+    try:
+        return spans.write_report(run, cache)
+    except OSError as e:
+        logger.warning("Could not write the run report: %s", e)
 
 
 def _do_update(
@@ -210,7 +388,12 @@ def _do_update(
     email,
     keep,
     max_recoveries,
+    env=None,
+    log=None,
+    summary=None,
     recovery=0,
+    verify=0,
+    prune=None,
 ):
     """Runs a single update job on a specific repository
 
@@ -248,9 +431,32 @@ def _do_update(
     max_recoveries : int
         The maximum number of recoveries to attempt
 
+    env : dict
+        The environment to run restic on (contains B2 credentials, if
+        required).  If not set, use :py:obj:`os.environ`.
+
+    log : utils.OutputBuffer
+        The buffer where to log operations into.  If not set, a new one is
+        created.  Recovery attempts append to the same buffer.
+
+    summary : restic.BackupSummary
+        The statistics of a back-up that already succeeded during a previous
+        attempt.  If set, the recovery does not back-up again, but only
+        repairs the repository.
+
     recovery : int
         The current recovery attempt
 
+    verify : int
+        If greater than zero, then the data of one out of ``verify`` slices of
+        the repository is read and verified after the back-up.  A different
+        slice is verified at every run, so the whole repository is verified
+        every ``verify`` runs.  Recoveries run thorough checks instead.
+
+    prune : dict
+        The pruning policy (see :py:func:`_prune_due`).  If not set, prune
+        while forgetting, at every run.  Recoveries always prune.
+
 
     Returns
     =======
@@ -258,13 +464,17 @@ def _do_update(
     error : bool
         A boolean indicating if there was an error
 
-    log : str
+    log : utils.OutputBuffer
         The log of operations
 
+    summary : restic.BackupSummary
+        The statistics of the back-up, or ``None``, if no snapshot was saved
+
     """
 
     error = False
-    log = ""
+    if log is None:
+        log = utils.OutputBuffer()
 
     try:
 
@@ -272,63 +482,117 @@ def _do_update(
             logger.info("Start %s recovery attempt -- max of %d (%s -> %s)",
                     _ordinal(recovery), max_recoveries, dire, repo)
 
-            log += restic.unlock(
-                repository=repo,
-                global_options=[],
-                password=password,
-                cache=cache,
-                remove_all=False,  # only stale lock removal
+            with _step("unlock", recovery):
+                restic.unlock(
+                    repository=repo,
+                    global_options=[],
+                    password=password,
+                    cache=cache,
+                    remove_all=False,  # only stale lock removal
+                    env=env,
+                    output=log,
+                )
+
+            with _step("rebuild-index", recovery):
+                restic.rebuild_index(
+                    repository=repo,
+                    global_options=[],
+                    password=password,
+                    cache=cache,
+                    env=env,
+                    output=log,
+                )
+        else:
+            logger.info("Start back-up (%s -> %s)", dire, repo)
+
+        if summary is None:
+            with _step("backup", recovery):
+                summary = restic.backup_json(
+                    directory=dire,
+                    repository=repo,
+                    global_options=[],
+                    hostname=hostname,
+                    backup_options=[],
+                    password=password,
+                    cache=cache,
+                    env=env,
+                    output=log,
+                )
+        else:
+            logger.info(
+                "Snapshot %s was saved by a previous attempt - not backing-up "
+                "again (%s -> %s)",
+                restic.short_id(summary.snapshot_id),
+                dire,
+                repo,
             )
 
-            log += restic.rebuild_index(
+        if recovery > 0:
+            with _step("prune", recovery):
+                restic.prune(
+                    repository=repo,
+                    global_options=[],
+                    password=password,
+                    cache=cache,
+                    env=env,
+                    output=log,
+                )
+
+        with _step("forget", recovery):
+            restic.forget(
                 repository=repo,
                 global_options=[],
+                hostname=hostname,
+                prune=(prune is None) or (recovery > 0),
+                keep=keep,
                 password=password,
                 cache=cache,
+                env=env,
+                output=log,
             )
-        else:
-            logger.info("Start back-up (%s -> %s)", dire, repo)
-
-        log += restic.backup(
-            directory=dire,
-            repository=repo,
-            global_options=[],
-            hostname=hostname,
-            backup_options=[],
-            password=password,
-            cache=cache,
-        )
 
         if recovery > 0:
-            log += restic.prune(
+            _pruned(cache, repo)
+        elif prune is not None and _prune_due(cache, repo, summary, prune):
+            logger.info("Pruning `%s'", repo)
+            with _step("prune", recovery):
+                restic.prune(
+                    repository=repo,
+                    global_options=[],
+                    password=password,
+                    cache=cache,
+                    env=env,
+                    output=log,
+                    max_unused=prune.get("max_unused"),
+                    max_repack_size=prune.get("max_repack_size"),
+                )
+            _pruned(cache, repo)
+
+        subset = None
+        if verify > 0 and recovery == 0:
+            subset = _next_subset(cache, repo, verify)
+            logger.info("Verifying data subset %d/%d of `%s'", *subset, repo)
+
+        with _step("check", recovery, subset=subset and "%d/%d" % subset):
+            restic.check(
                 repository=repo,
                 global_options=[],
+                thorough=bool(recovery),
                 password=password,
                 cache=cache,
+                env=env,
+                output=log,
+                subset=subset,
             )
 
-        log += restic.forget(
-            repository=repo,
-            global_options=[],
-            hostname=hostname,
-            prune=True,
-            keep=keep,
-            password=password,
-            cache=cache,
-        )
-
-        log += restic.check(
-            repository=repo,
-            global_options=[],
-            thorough=bool(recovery),
-            password=password,
-            cache=cache,
-        )
+        if subset is not None:
+            _subset_verified(cache, repo, subset)
 
         if recovery > 0:
             # if we are recovering, it is nice to know that it went well
             context = dict(
                 configs={dire:repo},
+                summaries={repo: summary},
                 cache=cache,
                 log=log,
                 hostname=hostname,
@@ -377,7 +641,7 @@ def _do_update(
 
         if recovery < max_recoveries:
             # tries again
-            e, l = _do_update(
+            e, l, summary = _do_update(
                 dire,
                 repo,
                 password,
@@ -386,15 +650,295 @@ def _do_update(
                 email,
                 keep,
                 max_recoveries=max_recoveries,
+                env=env,
+                log=log,
+                summary=summary,
                 recovery=recovery + 1,
+                verify=verify,
+                prune=prune,
             )
             error |= e
-            log += l
         else:
             # something requires attention here, stop trying recoveries
             error = True
 
-    return error, log
+    return error, log, summary
+
+
+def _next_subset(cache, repo, slices):
+    """Returns the next data subset to verify on a repository
+
+    Progress is kept on a state file, per repository.  Changing the number of
+    slices restarts the verification from the first slice.
+    """
+
+    state = utils.read_state(utils.state_path(cache, "verification", repo), {})
+    if state.get("slices") != slices:
+        return (1, slices)
+    return (state["next"], slices)
+
+
+def _subset_verified(cache, repo, subset):
+    """Records that a data subset of a repository was successfully verified"""
+
+    n, slices = subset
+    utils.write_state(
+        utils.state_path(cache, "verification", repo),
+        dict(slices=slices, next=(n % slices) + 1, last=n, time=time.time()),
+    )
+
+
+def _prune_due(cache, repo, summary, policy):
+    """Tells if a repository should be pruned, following a policy
+
+    The policy is a dictionary with the following (optional) keys:
+
+    * ``every``: prune if the last prune is older than this many days
+    * ``after``: prune if the amount of data added to the repository since the
+      last prune, in bytes, exceeds this value.  As snapshots containing that
+      data are eventually forgotten, this is an estimate of the unused space
+      that will have accumulated on the repository.
+    * ``max_unused``, ``max_repack_size``: the budgets of each prune (see
+      :py:func:`.restic.prune`)
+
+    If neither ``every`` nor ``after`` are set (or are zero), then pruning is
+    due at every run.  The amount of data added by the current back-up, from
+    ``summary``, is accumulated on a state file, per repository.  It is only
+    reset by :py:func:`_pruned`, once a prune succeeded.
+    """
+
+    path = utils.state_path(cache, "pruning", repo)
+    state = utils.read_state(path, {})
+
+    added = state.get("added", 0)
+    if summary is not None:
+        added += summary.data_added
+        utils.write_state(path, dict(state, added=added))
+
+    every = policy.get("every", 0)
+    after = policy.get("after", 0)
+
+    if every <= 0 and after <= 0:
+        return True
+
+    if "time" not in state:
+        logger.info("No previous prune recorded for `%s'", repo)
+        return True
+
+    # tolerates an hour of drift, so daily jobs are not delayed by a day
+    elapsed = time.time() - state["time"]
+    if every > 0 and elapsed >= (every * 86400 - 3600):
+        logger.info(
+            "Last prune of `%s' was %s ago", repo, reporter.human_time(elapsed)
+        )
+        return True
+
+    if after > 0 and added >= after:
+        logger.info(
+            "%s were added to `%s' since the last prune",
+            reporter.humanize_bytes(added),
+            repo,
+        )
+        return True
+
+    return False
+
+
+def _pruned(cache, repo):
+    """Records that a repository was pruned"""
+
+    path = utils.state_path(cache, "pruning", repo)
+    utils.write_state(path, dict(time=time.time(), added=0))
+
+
+def _manifest_path(cache, dire, repo, hostname):
+    """Returns the path of the manifest of the last back-up of a directory"""
+
+    key = "\n".join([repo, dire, hostname or ""])
+    return utils.state_path(cache, "manifests", key)
+
+
+def _verify_unchanged(
+    dire, repo, password, cache, hostname, email, env, log, verify
+):
+    """Verifies the next data subset of a repository whose back-up was skipped
+
+    Only runs the rolling ``restic check --read-data-subset`` of
+    :py:func:`_do_update`.  Errors are logged and reported by e-mail, but do
+    not start recoveries, as nothing was written to the repository.  Returns
+    ``True`` on errors.
+    """
+
+    subset = _next_subset(cache, repo, verify)
+    logger.info("Verifying data subset %d/%d of `%s'", *subset, repo)
+
+    try:
+        with _step("check", 0, subset="%d/%d" % subset):
+            restic.check(
+                repository=repo,
+                global_options=[],
+                thorough=False,
+                password=password,
+                cache=cache,
+                env=env,
+                output=log,
+                subset=subset,
+            )
+    except Exception:
+        logger.error(
+            "Error verifying `%s':\n%s", repo, traceback.format_exc()
+        )
+        context = dict(
+            configs={dire: repo},
+            trace=traceback.format_exc(),
+            cache=cache,
+            log=log,
+            hostname=hostname,
+            recovery=False,
+        )
+        _send_message(
+            "update/subject_error.txt",
+            "update/body_error.txt",
+            "update/body_error.html",
+            context,
+            email,
+            error=True,  # send 'onerror' or 'always'
+        )
+        return True
+
+    _subset_verified(cache, repo, subset)
+    return False
+
+
+def _update_if_changed(
+    dire,
+    repo,
+    password,
+    cache,
+    hostname,
+    email,
+    keep,
+    max_recoveries,
+    env=None,
+    recovery=0,
+    skip_unchanged=False,
+    verify=0,
+    prune=None,
+):
+    """Runs :py:func:`_do_update`, unless the directory did not change
+
+    If ``skip_unchanged`` is set, a signature of the metadata of all entries
+    under ``dire`` is computed locally, before backing-up.  If it matches the
+    signature recorded after the last successful back-up to ``repo``, then the
+    back-up, forget and check steps are skipped altogether, as they would not
+    change the repository.  Recoveries are never skipped.  If ``verify`` is
+    greater than zero, the next data subset of a skipped repository is still
+    verified (see :py:func:`_verify_unchanged`), so all data is verified
+    every ``verify`` runs, whether sources change or not.  The time of each
+    successful skip is recorded on the manifest: ``check`` alarms take it as
+    the time of the last back-up (see :py:func:`_last_backup`).
+
+
+    Returns
+    =======
+
+    error : bool
+        A boolean indicating if there was an error
+
+    log : utils.OutputBuffer
+        The log of operations
+
+    summary : restic.BackupSummary
+        The statistics of the back-up, or ``None``, if no snapshot was saved
+
+    unchanged : str
+        The identifier of the snapshot still holding the contents of ``dire``,
+        if the update was skipped, or ``None``, otherwise
+
+    """
+
+    if not skip_unchanged or recovery > 0:
+        error, log, summary = _do_update(
+            dire,
+            repo,
+            password,
+            cache,
+            hostname,
+            email,
+            keep,
+            max_recoveries,
+            env=env,
+            recovery=recovery,
+            verify=verify,
+            prune=prune,
+        )
+        return error, log, summary, None
+
+    path = _manifest_path(cache, dire, repo, hostname)
+    start = time.time_ns()
+    with spans.span("scan"):
+        signature = utils.tree_signature(dire)
+    manifest = utils.read_state(path, {})
+
+    if manifest.get("digest") == signature.digest:
+        logger.info(
+            "No changes under `%s' since snapshot %s - skipping back-up, "
+            "forget and check (%s -> %s)",
+            dire,
+            restic.short_id(manifest.get("snapshot")),
+            dire,
+            repo,
+        )
+        log = utils.OutputBuffer()
+        log += "no change since snapshot %s: %d files in %d directories\n" % (
+            restic.short_id(manifest.get("snapshot")),
+            signature.files,
+            signature.directories,
+        )
+        error = False
+        if verify > 0:
+            error = _verify_unchanged(
+                dire, repo, password, cache, hostname, email, env, log, verify
+            )
+        if not error:
+            # the last snapshot still holds the contents of the directory
+            utils.write_state(path, dict(manifest, confirmed=time.time()))
+        return error, log, None, manifest.get("snapshot")
+
+    error, log, summary = _do_update(
+        dire,
+        repo,
+        password,
+        cache,
+        hostname,
+        email,
+        keep,
+        max_recoveries,
+        env=env,
+        verify=verify,
+        prune=prune,
+    )
+
+    # entries changed less than 2 seconds before the signature was computed
+    # may have changed again within the same timestamp tick: only trust the
+    # signature otherwise
+    if not error and summary is not None and summary.snapshot_id:
+        if signature.newest < start - 2 * 10**9:
+            utils.write_state(
+                path,
+                dict(signature._asdict(), snapshot=summary.snapshot_id),
+            )
+        elif os.path.exists(path):
+            os.remove(path)
+
+    return error, log, summary, None
+
+
+def _update_repository(dire, repo, *args, **kwargs):
+    """Runs :py:func:`_update_if_changed` on a span for the repository"""
+
+    with spans.span("repository", directory=dire, repository=repo):
+        return _update_if_changed(dire, repo, *args, **kwargs)
 
 
 def update(
@@ -408,42 +952,119 @@ def update(
     period,
     max_recoveries,
     force_recovery,
+    jobs=1,
+    skip_unchanged=False,
+    verify=0,
+    prune=None,
+    jitter=0,
+    overlap="skip",
+    metrics=None,
 ):
-    """Runs a continuous job (never exits) for keeping the backup updated"""
+    """Runs a continuous job (never exits) for keeping the backup updated
+
+    If ``period`` is ``None``, then runs the job once and returns.  Otherwise,
+    ``period`` is a schedule specification (see :py:func:`.scheduler.parse`)
+    and the job runs following it, with the provided ``jitter`` and
+    ``overlap`` policy (see :py:class:`.scheduler.Scheduler`).
+
+    Repositories are independent from each other and are updated by a pool of
+    at most ``jobs`` workers.  Each worker runs on its own environment and
+    keeps its own log.  Logs are concatenated following the order of
+    ``configs`` and reported in a single e-mail, at the end.
+
+    If ``skip_unchanged`` is set, then directories whose contents did not
+    change since their last back-up are not backed-up again (see
+    :py:func:`_update_if_changed`).  If ``verify`` is greater than zero, then
+    the data of each repository is verified in that many slices, one per run
+    (see :py:func:`_do_update`).  Repositories are pruned following the
+    ``prune`` policy (see :py:func:`_prune_due`), or at every run, if that is
+    not set.  If set, ``metrics`` (a :py:class:`.metrics.Metrics`) are fed
+    with the results of each run.
+    """
 
     def job():
         """The job that gets scheduled"""
 
-        if b2_cred:
-            os.environ.setdefault("B2_ACCOUNT_ID", b2_cred["id"])
-            os.environ.setdefault("B2_ACCOUNT_KEY", b2_cred["key"])
-
         error = False
-        log = ""
-
-        for dire, repo in configs.items():
-
-            e, l = _do_update(
-                dire,
-                repo,
-                password,
-                cache,
-                hostname,
-                email,
-                keep,
-                max_recoveries,
-                recovery = 0 if not force_recovery else 1,
-            )
-            error |= e
-            log += l
+        log = utils.OutputBuffer()
+        summaries = {}
+        unchanged = {}
+        # repositories are only successful once their update returns
+        failed = dict((k, True) for k in configs.values())
+
+        workers = max(1, min(jobs, len(configs)))
+        if workers > 1:
+            logger.info("Updating %d repositories with %d parallel jobs",
+                    len(configs), workers)
+
+        run = None
+        try:
+            with spans.span("update", hostname=hostname) as run:
+                with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=workers, thread_name_prefix="update"
+                ) as executor:
+
+                    futures = [
+                        executor.submit(
+                            contextvars.copy_context().run,
+                            _update_repository,
+                            dire,
+                            repo,
+                            password,
+                            cache,
+                            hostname,
+                            email,
+                            keep,
+                            max_recoveries,
+                            env=_environment(b2_cred),
+                            recovery=0 if not force_recovery else 1,
+                            skip_unchanged=skip_unchanged,
+                            verify=verify,
+                            prune=prune,
+                        )
+                        for dire, repo in configs.items()
+                    ]
+
+                    # an unexpected error must not hide the other results
+                    concurrent.futures.wait(futures)
+                    unexpected = None
+
+                    # collects results in configuration (not completion) order
+                    for (dire, repo), future in zip(configs.items(), futures):
+                        if future.exception() is not None:
+                            unexpected = unexpected or future.exception()
+                            continue
+                        e, l, summary, snapshot = future.result()
+                        error |= e
+                        failed[repo] = e
+                        log += l
+                        l.close()
+                        if summary is not None:
+                            summaries[repo] = summary
+                            if repo.startswith("b2:"):
+                                _account_size(cache, repo, summary)
+                        if snapshot is not None:
+                            unchanged[repo] = snapshot
+
+                    if unexpected is not None:
+                        raise unexpected
+
+        finally:
+            if run is not None:
+                _write_report(run, cache)
+                if metrics is not None:
+                    metrics.update_finished(run, failed, summaries)
 
         # sends one e-mail with the whole logs for the procedure
         context = dict(
             configs=configs,
+            summaries=summaries,
+            unchanged=unchanged,
             cache=cache,
             log=log,
             hostname=hostname,
             recovery=False,
+            report=run,
         )
         _send_message(
             "update/subject_success.txt",
@@ -454,66 +1075,152 @@ def update(
             error=False,  # send only if 'always' context is set
         )
 
-        return log
+        return str(log)
 
     if period is None:
-        wait = 15
-        logger.info("Scheduling backup job to run only once")
-        logger.info("Waiting %d seconds before starting...", wait)
-        time.sleep(wait)
-        return job()  # run once
-    else:
-        logger.info("Scheduling backup job to run every day at %s", period)
-        schedule.every().day.at(period).do(job)
+        logger.info("Running backup job only once")
+        return job()
 
-    while True:
-        schedule.run_pending()
-        time.sleep(600)  # checks every 10 minutes
+    logger.info("Scheduling backup job to run at `%s'", period)
+    runner = scheduler.Scheduler(job, period, jitter, overlap, name="backup")
+    if metrics is not None:
+        metrics.watch("update", runner)
+    runner.run()
 
 
-def check(configs, password, cache, hostname, email, b2_cred, alarm, period):
-    """Runs a continuous job (never exits) for checking health of repositories"""
+def _last_backup(snapshot_index, cache, dire, repo, hostname):
+    """Returns when a directory was last backed-up, or ``None``, if never
 
-    def job():
-        """The job that gets scheduled"""
+    That is the time of the latest snapshot on the repository or, if later,
+    the last time a back-up of the (unchanged) directory was skipped, as long
+    as the snapshot it refers to is still on the repository (see
+    :py:func:`_update_if_changed`).
+    """
 
-        if b2_cred:
-            os.environ.setdefault("B2_ACCOUNT_ID", b2_cred["id"])
-            os.environ.setdefault("B2_ACCOUNT_KEY", b2_cred["key"])
+    latest = snapshot_index.latest(repo, hostname)
+    if latest is None:
+        return None
 
-        log = ""
-        sizes = {}
-        snapshots = []
+    path = _manifest_path(cache, dire, repo, hostname)
+    manifest = utils.read_state(path, {})
+    if "confirmed" not in manifest:
+        return latest["time"]
+    if manifest.get("snapshot") not in snapshot_index.ids(repo):
+        return latest["time"]
+    confirmed = datetime.datetime.fromtimestamp(manifest["confirmed"])
+    return max(latest["time"], confirmed)
 
-        try:
 
-            alarm_condition = False
+async def _indexed_snapshots(
+    snapshot_index, repo, hostname, password, cache, env
+):
+    """Refreshes the snapshot index for a repository and lists its snapshots"""
 
-            for repo in configs.values():
+    with spans.span("snapshots", repository=repo):
+        await snapshot_index.refresh_async(repo, password, cache, env)
+        return snapshot_index.snapshots(repo, hostname)
 
-                if period is None:  # calling a single time
-                    if repo.startswith("b2:"):  # BackBlaze B2 repository
-                        log += b2.authorize_account(
-                            b2_cred["id"], b2_cred["key"]
-                        )
 
-                    if repo.startswith("b2:"):
-                        info = b2.get_bucket(repo[3:])
-                        sizes[repo] = info["totalSize"]
-                    else:
-                        sizes[repo] = utils.get_size(repo)
+async def _repository_size(repo, cache, every=0):
+    """Returns the size of a repository, in bytes"""
 
-                snapshots += restic.snapshots(
-                    repository=repo,
-                    global_options=[],
-                    hostname=hostname,
-                    password=password,
-                    cache=cache,
-                )
+    loop = asyncio.get_running_loop()
+    with spans.span("size", repository=repo):
+        if repo.startswith("b2:"):
+            return await loop.run_in_executor(
+                None, _bucket_size, repo, cache, every
+            )
+        return await loop.run_in_executor(None, _local_size, repo, cache)
+
+
+def check(
+    configs,
+    password,
+    cache,
+    hostname,
+    email,
+    b2_cred,
+    alarm,
+    period,
+    jobs=1,
+    jitter=0,
+    overlap="skip",
+    size_every=0,
+    metrics=None,
+):
+    """Runs a continuous job (never exits) for checking health of repositories
+
+    If ``period`` is ``None``, then runs the job once and returns.  Otherwise,
+    runs it following a schedule (see :py:func:`update`).
+
+    Snapshot listings and repository size queries are independent from each
+    other and run concurrently, with at most ``jobs`` of them at a time.
+    Sizes of B2 repositories are only fully computed every ``size_every``
+    days (see :py:func:`_bucket_size`).  If set, ``metrics`` (see
+    :py:func:`update`) are fed with the results of each run.
+    """
+
+    def job():
+        """The job that gets scheduled"""
+
+        env = _environment(b2_cred)
+        log = utils.OutputBuffer()
+        sizes = {}
+        snapshots = []
+        by_repo = {}
+        failed = False
 
-                delta = datetime.datetime.now() - snapshots[-1]["time"]
-                if alarm > 0 and delta.total_seconds() > alarm:
-                    alarm_condition = True
+        try:
+
+            with spans.span("check", hostname=hostname) as run:
+
+                alarm_condition = False
+                repos = list(configs.values())
+                with index.SnapshotIndex(
+                    index.default_path(cache)
+                ) as snapshot_index:
+
+                    # reuses the current authorization, unless about to expire
+                    if any(k.startswith("b2:") for k in repos):
+                        b2.authorize(b2_cred["id"], b2_cred["key"], output=log)
+
+                    coroutines = [
+                        _indexed_snapshots(
+                            snapshot_index,
+                            repo,
+                            hostname,
+                            password,
+                            cache,
+                            env,
+                        )
+                        for repo in repos
+                    ]
+                    if period is None:
+                        coroutines += [
+                            _repository_size(repo, cache, size_every)
+                            for repo in repos
+                        ]
+
+                    results = asyncio.run(utils.gather(coroutines, jobs))
+
+                    if period is None:
+                        sizes.update(zip(repos, results[len(repos) :]))
+
+                    for (dire, repo), repo_snapshots in zip(
+                        configs.items(), results[: len(repos)]
+                    ):
+                        snapshots += repo_snapshots
+                        by_repo[repo] = repo_snapshots
+                        if alarm > 0:
+                            last = _last_backup(
+                                snapshot_index, cache, dire, repo, hostname
+                            )
+                            if last is None:
+                                alarm_condition = True
+                                continue
+                            delta = datetime.datetime.now() - last
+                            if delta.total_seconds() > alarm:
+                                alarm_condition = True
 
             context = dict(
                 configs=configs,
@@ -547,6 +1254,7 @@ def check(configs, password, cache, hostname, email, b2_cred, alarm, period):
                 )
 
         except Exception:
+            failed = True
             logger.error("Error at update:\n%s", traceback.format_exc())
             context = dict(
                 configs=configs,
@@ -564,18 +1272,23 @@ def check(configs, password, cache, hostname, email, b2_cred, alarm, period):
                 error=True,
             )
 
-        return log, sizes, snapshots
+        _write_report(run, cache)
+        if metrics is not None:
+            metrics.check_finished(
+                run,
+                dict((k, failed) for k in configs.values()),
+                by_repo,
+                sizes,
+            )
 
-    if period is None:
-        wait = 15
-        logger.info("Scheduling check job to run only once")
-        logger.info("Waiting %d seconds before starting...", wait)
-        time.sleep(wait)
-        return job()  # run once
-    else:
-        logger.info("Scheduling check job to run every day at %s", period)
-        schedule.every().day.at(period).do(job)
+        return str(log), sizes, snapshots
 
-    while True:
-        schedule.run_pending()
-        time.sleep(600)  # checks every 10 minutes
+    if period is None:
+        logger.info("Running check job only once")
+        return job()
+
+    logger.info("Scheduling check job to run at `%s'", period)
+    runner = scheduler.Scheduler(job, period, jitter, overlap, name="check")
+    if metrics is not None:
+        metrics.watch("check", runner)
+    runner.run()
@@ -1,22 +1,201 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-"""Dump (optionless) script that just deployes all our containers"""
+"""Dump (optionless) script that just deployes all our containers
+
+Existing containers are only re-created if their image, command or volumes
+differ from the desired ones.  Containers are independent, so they are
+inspected and rolled out concurrently.
+"""
+
+import time
+import shlex
+import collections
+import importlib.metadata
+import concurrent.futures
+
+import logging
+
+logger = logging.getLogger(__name__)
 
 from . import qnap, utils, reporter
 
 
-def _delete_create(session, server, name, existing, options):
+IMAGE = "anjos/baker"
+"""The image to deploy"""
+
+
+TAG = "v%s" % importlib.metadata.version(__package__)
+"""The image tag to deploy"""
+
+
+Step = collections.namedtuple("Step", ["name", "action", "reason"])
+"""One step of a deployment plan
+
+``action`` is one of ``create``, ``recreate``, ``start`` or ``keep``.
+"""
+
+
+def _mounts(volumes):
+    """Returns the set of (destination, writeable) mounts of a volume spec"""
+
+    retval = set()
+    for k in volumes.get("new", []):
+        retval.add((k.split(":", 1)[1], True))
+    for k in volumes.get("host", {}).values():
+        retval.add((k["bind"], not k.get("ro", False)))
+    return retval
+
+
+def _differences(inspected, options):
+    """Lists how an existing container differs from the desired options
+
+
+    Parameters:
+
+      inspected (dict): The container information, as returned by
+        :py:meth:`.qnap.QnapClient.inspect_container`
+
+      options (dict): The desired container options
+
+
+    Returns:
+
+      list: Descriptions of each difference found (empty if none)
+
+    """
+
+    config = inspected.get("Config", {})
+    retval = []
+
+    image = "%s:%s" % (IMAGE, TAG)
+    if config.get("Image") != image:
+        retval.append("image is %s, not %s" % (config.get("Image"), image))
+
+    if config.get("Cmd") != shlex.split(options["command"]):
+        retval.append("command changed")
+
+    mounts = set(
+        (k.get("Destination"), k.get("RW"))
+        for k in inspected.get("Mounts", [])
+    )
+    if mounts != _mounts(options.get("volume", {})):
+        retval.append("volumes changed")
+
+    return retval
+
+
+def _step(client, name, options, existing):
+    """Decides what to do with a single container"""
+
+    if name not in existing:
+        return Step(name, "create", "does not exist")
+
+    inspected = client.inspect_container(existing[name]["id"])
+    differences = _differences(inspected, options)
+    if differences:
+        return Step(name, "recreate", ", ".join(differences))
+
+    if options.get("autostart", True) and existing[name]["state"] != "running":
+        return Step(name, "start", "is %s" % existing[name]["state"])
+
+    return Step(name, "keep", "is up-to-date")
+
+
+def plan(client, desired, existing):
+    """Computes a deployment plan, inspecting existing containers concurrently
 
-    if name in existing:
-        if existing[name]["state"] == "running":
-            qnap.stop_container(session, server, existing[name]["id"])
-        qnap.remove_container(session, server, existing[name]["id"])
 
-    retval = qnap.create_container(session, server, name, options)
-    if options.get("autostart", True) == False:
-        if "id" in retval:
-            qnap.stop_container(session, server, retval["id"])
+    Parameters:
+
+      client (qnap.QnapClient): The client to the NAS
+
+      desired (dict): Maps container names to their desired options
+
+      existing (dict): Maps names of existing containers to their information,
+        as returned by :py:meth:`.qnap.QnapClient.get_containers`
+
+
+    Returns:
+
+      list: A list of :py:class:`Step`, in the order of ``desired``
+
+    """
+
+    with concurrent.futures.ThreadPoolExecutor(len(desired) or 1) as executor:
+        futures = [
+            executor.submit(_step, client, name, options, existing)
+            for name, options in desired.items()
+        ]
+        return [k.result() for k in futures]
+
+
+def _apply(client, step, options, existing):
+    """Executes a step of the plan, returns the time it took, in seconds"""
+
+    start = time.time()
+
+    if step.action == "start":
+        client.start_container(existing[step.name]["id"])
+
+    elif step.action in ("create", "recreate"):
+        if step.name in existing:
+            if existing[step.name]["state"] == "running":
+                client.stop_container(existing[step.name]["id"])
+            client.remove_container(existing[step.name]["id"])
+
+        retval = client.create_container(step.name, options, IMAGE, TAG)
+        if options.get("autostart", True) == False:
+            if "id" in retval:
+                client.stop_container(retval["id"])
+
+    return time.time() - start
+
+
+def deploy(client, desired):
+    """Rolls out containers, only (re-)creating those that changed
+
+
+    Parameters:
+
+      client (qnap.QnapClient): The client to the NAS
+
+      desired (dict): Maps container names to their desired options
+
+
+    Returns:
+
+      list: Tuples with each :py:class:`Step` of the plan and the time it took
+      to execute it, in seconds
+
+    """
+
+    start = time.time()
+
+    existing = dict([(k["name"], k) for k in client.get_containers()])
+    steps = plan(client, desired, existing)
+
+    logger.info("Deployment plan:")
+    for step in steps:
+        logger.info(" - %s: %s (%s)", step.name, step.action, step.reason)
+
+    with concurrent.futures.ThreadPoolExecutor(len(steps) or 1) as executor:
+        futures = [
+            executor.submit(_apply, client, k, desired[k.name], existing)
+            for k in steps
+        ]
+        timings = [k.result() for k in futures]
+
+    for step, elapsed in zip(steps, timings):
+        logger.info(
+            " - %s: %s in %s",
+            step.name,
+            step.action,
+            reporter.human_time(elapsed),
+        )
+    logger.info("Deployment took %s", reporter.human_time(time.time() - start))
+
+    return list(zip(steps, timings))
 
 
 def main():
@@ -41,40 +220,37 @@ def main():
         },
     }
 
-    with qnap.session(server, nas["username"], nas["password"]) as session:
+    desired = collections.OrderedDict()
 
-        existing = qnap.get_containers(session, server)
-        existing = dict([(k["name"], k) for k in existing])
+    # Use this one for tests
+    options = dict(volume=volumes, autostart=False, command="-vvv --help",)
+    # desired["baker-help"] = options
 
-        # Use this one for tests
-        options = dict(volume=volumes, autostart=False, command="-vvv --help",)
-        # _delete_create(session, server, 'baker-help', existing, options)
+    #### RECURRENT ACTIONS ####
 
-        #### RECURRENT ACTIONS ####
+    desired["baker-update"] = dict(
+        volume=volumes,
+        autostart=True,
+        command='-vv update --email=onerror --run-daily-at="03:00" '
+        + common_command,
+    )
 
-        options = dict(
-            volume=volumes,
-            autostart=True,
-            command='-vv update --email=onerror --run-daily-at="03:00" '
-            + common_command,
-        )
-        _delete_create(session, server, "baker-update", existing, options)
+    #### ONCE IN A TIME ACTIONS ####
 
-        #### ONCE IN A TIME ACTIONS ####
+    desired["baker-check"] = dict(
+        autostart=False,
+        volume=volumes,
+        command="-vvv check --email=always " + common_command,
+    )
 
-        options = dict(
-            autostart=False,
-            volume=volumes,
-            command="-vvv check --email=always " + common_command,
-        )
-        _delete_create(session, server, "baker-check", existing, options)
+    desired["baker-recover"] = dict(
+        autostart=False,
+        volume=volumes,
+        command="-vv update --force-recovery --email=always " + common_command,
+    )
 
-        options = dict(
-            autostart=False,
-            volume=volumes,
-            command="-vv update --force-recovery --email=always " + common_command,
-        )
-        _delete_create(session, server, "baker-recover", existing, options)
+    with qnap.session(server, nas["username"], nas["password"]) as client:
+        deploy(client, desired)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""A local index of restic snapshots, kept in a SQLite database
+
+Listing snapshots on a remote repository requires restic to download and
+decrypt every snapshot file.  This module keeps the (few) properties of each
+snapshot we actually use locally, so that alarm evaluation and e-mail
+rendering only need to query the repository for snapshots we did not know
+about yet.
+"""
+
+import os
+import json
+import sqlite3
+import asyncio
+import datetime
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+from . import utils
+from . import restic
+
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+"""Reference for storing (naive) snapshot times as integers"""
+
+
+_FULL_LISTING = 100
+"""Number of unknown snapshots above which we fetch a complete listing"""
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    repository TEXT NOT NULL,
+    id TEXT NOT NULL,
+    hostname TEXT NOT NULL,
+    time INTEGER NOT NULL,
+    paths TEXT NOT NULL,
+    PRIMARY KEY (repository, id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS snapshots_by_host
+    ON snapshots (repository, hostname, time);
+"""
+
+
+def default_path(cache):
+    """Returns the default location of the snapshot index database
+
+
+    Parameters:
+
+      cache (str): The path to the cache directory used for restic, or
+        ``None``, if restic uses its defaults
+
+
+    Returns:
+
+      str: The path to the SQLite database file
+
+    """
+
+    return os.path.join(utils.baker_cache(cache), "snapshots.sqlite3")
+
+
+def _to_row(repository, snapshot):
+    """Converts a snapshot, as returned by restic, into a database row"""
+
+    return (
+        repository,
+        snapshot["id"],
+        snapshot["hostname"],
+        (snapshot["time"] - _EPOCH) // datetime.timedelta(microseconds=1),
+        json.dumps(snapshot["paths"]),
+    )
+
+
+def _from_row(row):
+    """Converts a database row into a snapshot dictionary
+
+    The returned dictionary contains the same keys (and value types) as those
+    returned by :py:func:`baker.restic.snapshots`, that we use.
+    """
+
+    return dict(
+        id=row[0],
+        short_id=row[0][:8],
+        hostname=row[1],
+        time=_EPOCH + datetime.timedelta(microseconds=row[2]),
+        paths=json.loads(row[3]),
+    )
+
+
+class SnapshotIndex:
+    """A persistent index of snapshots, for one or more repositories
+
+    Use :py:meth:`refresh` to synchronise the index with a repository, and
+    :py:meth:`snapshots` or :py:meth:`latest` to query it.
+
+
+    Parameters:
+
+      path (str): Path to the SQLite database file.  It is created if it does
+        not exist.  Use ``:memory:`` for a volatile index.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=30)
+        self.connection.executescript(_SCHEMA)
+
+    def close(self):
+        """Closes the connection to the database"""
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def ids(self, repository):
+        """Returns the set of snapshot identifiers known for a repository"""
+
+        cursor = self.connection.execute(
+            "SELECT id FROM snapshots WHERE repository = ?", (repository,)
+        )
+        return set(k[0] for k in cursor)
+
+    def add(self, repository, snapshots):
+        """Adds (or replaces) snapshots, as returned by restic, to the index"""
+
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?)",
+                [_to_row(repository, k) for k in snapshots],
+            )
+
+    def remove(self, repository, ids):
+        """Removes snapshots from the index, given their identifiers"""
+
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM snapshots WHERE repository = ? AND id = ?",
+                [(repository, k) for k in ids],
+            )
+
+    def snapshots(self, repository, hostname=None):
+        """Lists indexed snapshots of a repository, sorted by time
+
+
+        Parameters:
+
+          repository (str): The restic repository to list snapshots for
+
+          hostname (str, Optional): If set, only list snapshots from this host
+
+
+        Returns:
+
+          list: A list of dictionaries with keys ``id``, ``short_id``,
+          ``hostname``, ``time`` (:py:class:`datetime.datetime`) and ``paths``,
+          sorted by time
+
+        """
+
+        query = "SELECT id, hostname, time, paths FROM snapshots "
+        query += "WHERE repository = ?"
+        args = [repository]
+        if hostname is not None:
+            query += " AND hostname = ?"
+            args.append(hostname)
+        query += " ORDER BY time"
+        return [_from_row(k) for k in self.connection.execute(query, args)]
+
+    def latest(self, repository, hostname=None):
+        """Returns the newest indexed snapshot of a repository, or ``None``"""
+
+        query = "SELECT id, hostname, time, paths FROM snapshots "
+        query += "WHERE repository = ?"
+        args = [repository]
+        if hostname is not None:
+            query += " AND hostname = ?"
+            args.append(hostname)
+        query += " ORDER BY time DESC LIMIT 1"
+        row = self.connection.execute(query, args).fetchone()
+        return _from_row(row) if row is not None else None
+
+    def refresh(self, repository, password, cache, env=None):
+        """Synchronises the index with the contents of a repository
+
+        Only the (cheap) list of snapshot identifiers is read from the
+        repository.  Snapshots that are unknown to the index are then fetched
+        and added, while snapshots that disappeared from the repository (e.g.
+        because of ``restic forget``) are removed from the index.
+
+
+        Parameters:
+
+          repository (str): The restic repository to synchronise with
+
+          password (str): The restic repository password
+
+          cache (str): The path to the cache directory to use for restic. If
+            not set, use the XDG cache default (typically ~/.cache/restic)
+
+          env (dict, Optional): The environment to run restic on. If not set,
+            use :py:obj:`os.environ`.
+
+
+        Returns:
+
+          int: The number of snapshots added to the index
+
+        """
+
+        return asyncio.run(
+            self.refresh_async(repository, password, cache, env)
+        )
+
+    async def refresh_async(self, repository, password, cache, env=None):
+        """Asynchronous version of :py:meth:`refresh`"""
+
+        known = self.ids(repository)
+        remote = set(
+            await restic.list_snapshot_ids_async(
+                repository=repository,
+                global_options=[],
+                password=password,
+                cache=cache,
+                env=env,
+            )
+        )
+
+        new = remote - known
+        gone = known - remote
+
+        if new:
+            # a full listing is cheaper than a very long command-line
+            ids = sorted(new) if len(new) <= _FULL_LISTING else None
+            snapshots = await restic.snapshots_async(
+                repository=repository,
+                global_options=[],
+                hostname=None,
+                password=password,
+                cache=cache,
+                env=env,
+                ids=ids,
+            )
+            self.add(repository, [k for k in snapshots if k["id"] in new])
+
+        if gone:
+            self.remove(repository, gone)
+
+        logger.debug(
+            "Snapshot index for `%s': %d added, %d removed, %d unchanged",
+            repository,
+            len(new),
+            len(gone),
+            len(known & remote),
+        )
+
+        return len(new)
@@ -1,39 +1,206 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-"""Dump (optionless) script that retrieves logs from one of our containers"""
+"""Dump script that retrieves logs from one or more of our containers
 
+Usage: %(prog)s [--follow] [--interval=<seconds>] [--tail=<n>] [<name>...]
+       %(prog)s --help
+
+Logs of several containers are retrieved concurrently, and each line is
+prefixed by the name of its container.  Without names, lists the existing
+containers.
+
+
+Options:
+
+  -h, --help                Shows this help message and exits
+  -f, --follow              Keeps polling for, and printing, new lines until
+                            interrupted
+  -i, --interval=<seconds>  Time between polls, while following [default: 5]
+  -n, --tail=<n>            Number of lines to retrieve, from the end of the
+                            logs of each container [default: 1000]
+
+"""
+
+import io
+import os
 import sys
+import datetime
+import threading
+import concurrent.futures
+
+import logging
+
+logger = logging.getLogger(__name__)
+
 from . import qnap, utils, reporter
 
 
-def main():
+_output_lock = threading.Lock()
+"""Serializes writes of lines from several containers"""
+
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _emit(prefix, line):
+    """Writes a single (whole) line to the standard output"""
+
+    with _output_lock:
+        sys.stdout.write(prefix + line)
+        if not line.endswith("\n"):
+            sys.stdout.write("\n")
+        sys.stdout.flush()
+
+
+def _timestamp(text):
+    """Converts an RFC 3339 UTC timestamp into ``(seconds, nanoseconds)``
+
+    Timestamps have a variable number of fractional digits, so they cannot be
+    compared as strings.
+    """
+
+    seconds = int(
+        (
+            datetime.datetime.strptime(text[:19], "%Y-%m-%dT%H:%M:%S")
+            - _EPOCH
+        ).total_seconds()
+    )
+    fraction = text[19:].rstrip("Z")
+    if fraction.startswith("."):
+        return seconds, int(fraction[1:10].ljust(9, "0"))
+    return seconds, 0
+
+
+class _Cursor(object):
+    """Tracks the last line printed for a container, from its timestamp
+
+    The API only accepts whole seconds for ``since``, so lines logged during
+    that second are retrieved again: those already printed are skipped.
+    """
+
+    def __init__(self):
+        self.time = None
+        self.seen = set()
+
+    @property
+    def since(self):
+        return self.time[0] if self.time is not None else None
+
+    def new(self, line):
+        """Returns the line, without its timestamp, if it was not printed"""
+
+        stamp, _, text = line.partition(" ")
+        try:
+            key = _timestamp(stamp)
+        except ValueError:  # not timestamped
+            return line
+
+        if self.time is not None:
+            if key < self.time or (key == self.time and line in self.seen):
+                return None
+        if key != self.time:
+            self.time = key
+            self.seen = set()
+        self.seen.add(line)
+        return text
+
+
+def stream(
+    client, id_, prefix, tail=1000, follow=False, interval=5, stop=None
+):
+    """Prints the logs of a container, line by line
+
+
+    Parameters:
+
+      client (qnap.QnapClient): The client to the NAS
+
+      id_ (str): The identifier of the container
+
+      prefix (str): A prefix for each printed line
+
+      tail (int, Optional): The number of lines to retrieve first
+
+      follow (bool, Optional): If set, keep polling for new lines
+
+      interval (float, Optional): Time between polls, in seconds
+
+      stop (threading.Event, Optional): Stops following, once set
+
+    """
+
+    stop = stop or threading.Event()
+    cursor = _Cursor()
+
+    while True:
+        if cursor.since is None:
+            logs = client.retrieve_logs(id_, tail=tail, timestamps=follow)
+        else:
+            logs = client.retrieve_logs(
+                id_, tail=None, since=cursor.since, timestamps=True
+            )
+
+        for line in io.StringIO(logs["logs"]):
+            if follow:
+                line = cursor.new(line)
+            if line is not None:
+                _emit(prefix, line)
+
+        if not follow or stop.wait(interval):
+            return
+
+
+def main(user_input=None):
+
+    import docopt
+
+    argv = user_input if user_input is not None else sys.argv[1:]
+    args = docopt.docopt(
+        __doc__ % dict(prog=os.path.basename(sys.argv[0])), argv=argv
+    )
 
     reporter.setup_logger("baker", 2)
 
     nas = utils.retrieve_json_secret("nas/info.json")
     server = nas["server"]
 
-    with qnap.session(server, nas["username"], nas["password"]) as session:
+    with qnap.session(server, nas["username"], nas["password"]) as client:
 
-        existing = qnap.get_containers(session, server)
+        existing = client.get_containers()
         existing = dict([(k["name"], k) for k in existing])
 
-        if len(sys.argv) > 1:
-            for k in sys.argv[1:]:
-                if len(sys.argv) > 2:
-                    print(">>>>>>>>>>>> %s <<<<<<<<<<<<<<" % k)
-                print(
-                    qnap.retrieve_logs(
-                        session, server, existing[k]["id"], tail=1000
-                    )["logs"]
-                )
-
-        else:
-            print("usage: %s <container-name> [<container-name> ...]")
+        names = args["<name>"]
+        if not names:
             print("  Existing container names:")
             for key in sorted(existing.keys()):
                 print("  - %s (state: %s)" % (key, existing[key]["state"]))
+            return
+
+        width = max(len(k) for k in names)
+        stop = threading.Event()
+
+        with concurrent.futures.ThreadPoolExecutor(len(names)) as executor:
+            futures = [
+                executor.submit(
+                    stream,
+                    client,
+                    existing[k]["id"],
+                    prefix="%s | " % k.ljust(width) if len(names) > 1 else "",
+                    tail=int(args["--tail"]),
+                    follow=args["--follow"],
+                    interval=float(args["--interval"]),
+                    stop=stop,
+                )
+                for k in names
+            ]
+            try:
+                for future in futures:
+                    while not future.done():  # keeps Ctrl-C responsive
+                        concurrent.futures.wait([future], timeout=1)
+                    future.result()
+            except KeyboardInterrupt:
+                stop.set()
 
 
 if __name__ == "__main__":
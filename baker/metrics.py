@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Prometheus metrics of update and check runs
+
+Metrics are optional: this module is only imported, and jobs only feed it,
+if a metrics endpoint or file is requested.  Values are exposed in the
+Prometheus text format, either by a small HTTP server (see
+:py:meth:`Metrics.serve`) or on a file for the textfile collector of
+node-exporter (see :py:meth:`Metrics.write`).
+
+Except for B2 operation counts, metrics describe the last run of each job,
+so both exposition methods report the same values, even if ``bake`` only
+runs once per invocation.
+"""
+
+import os
+import sys
+import time
+import threading
+import collections
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+"""Content type of the Prometheus text format"""
+
+
+METRICS = collections.OrderedDict(
+    [
+        (
+            "baker_last_run_timestamp_seconds",
+            ("gauge", "When the last run of a job finished"),
+        ),
+        (
+            "baker_last_run_duration_seconds",
+            ("gauge", "How long the last run of a job took"),
+        ),
+        (
+            "baker_last_success_timestamp_seconds",
+            ("gauge", "When a job last succeeded on a repository"),
+        ),
+        (
+            "baker_last_run_failed",
+            ("gauge", "If the last run of a job failed on a repository"),
+        ),
+        (
+            "baker_step_duration_seconds",
+            ("gauge", "Time spent on each step, for a repository, last run"),
+        ),
+        (
+            "baker_recovery_attempts",
+            ("gauge", "Recovery attempts on a repository, last update"),
+        ),
+        (
+            "baker_backup_added_bytes",
+            ("gauge", "Data added to a repository by the last back-up"),
+        ),
+        (
+            "baker_snapshots",
+            ("gauge", "Snapshots of this host on a repository, last check"),
+        ),
+        (
+            "baker_latest_snapshot_timestamp_seconds",
+            ("gauge", "When the latest snapshot on a repository was taken"),
+        ),
+        (
+            "baker_repository_size_bytes",
+            ("gauge", "The size of a repository, last check"),
+        ),
+        (
+            "baker_scheduler_lag_seconds",
+            ("gauge", "How late the last scheduled run of a job started"),
+        ),
+        (
+            "baker_scheduler_next_run_timestamp_seconds",
+            ("gauge", "When the next run of a job is due"),
+        ),
+        (
+            "baker_b2_calls_total",
+            ("counter", "B2 operations run by this process"),
+        ),
+    ]
+)
+"""Exposed metrics, mapped to their type and help text"""
+
+
+def _escape(value):
+    """Escapes a label value for the Prometheus text format"""
+
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\n", "\\n")
+        .replace('"', '\\"')
+    )
+
+
+def _steps(run):
+    """Returns the time spent per ``(repository, step)`` on a run
+
+    Steps inherit the repository of their closest ancestor tagged with one.
+    Time spent on repeated steps (e.g. during recoveries) is added up.
+    """
+
+    retval = collections.OrderedDict()
+
+    def _visit(span, repository):
+        repository = span.attributes.get("repository", repository)
+        if repository is not None and span.name != "repository":
+            key = (repository, span.name)
+            retval[key] = retval.get(key, 0.0) + (span.wall or 0.0)
+        for child in list(span.children):
+            _visit(child, repository)
+
+    _visit(run, None)
+    return retval
+
+
+def _recoveries(run):
+    """Returns the number of recovery attempts per repository on a run"""
+
+    attempts = collections.defaultdict(set)
+    for _, span in run.walk():
+        if span.name == "repository":
+            for _, step in span.walk():
+                if "recovery" in step.attributes:
+                    attempts[span.attributes["repository"]].add(
+                        step.attributes["recovery"]
+                    )
+    return attempts
+
+
+class Metrics(object):
+    """Keeps the current values of all metrics, and exposes them
+
+
+    Parameters:
+
+      path (str, Optional): If set, write metrics to this file after each
+        run (see :py:meth:`write`).  To be picked up by node-exporter, its
+        name must end in ``.prom``.
+
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._values = collections.OrderedDict((k, {}) for k in METRICS)
+        self._collectors = [self._collect_b2]
+        self._lock = threading.Lock()
+        self._server = None
+
+    def set(self, name, value, **labels):
+        """Sets the value of a metric, for a set of labels"""
+
+        with self._lock:
+            self._values[name][tuple(sorted(labels.items()))] = value
+
+    def clear(self, name, **labels):
+        """Removes all series of a metric matching a set of labels"""
+
+        with self._lock:
+            series = self._values[name]
+            for key in list(series):
+                if set(labels.items()) <= set(key):
+                    del series[key]
+
+    def collector(self, function):
+        """Registers a function, called before metrics are exposed"""
+
+        self._collectors.append(function)
+
+    def _collect_b2(self):
+        """Exposes the count of B2 operations, if any were run"""
+
+        b2 = sys.modules.get(__package__ + ".b2")
+        if b2 is None:
+            return
+        for operation, count in list(b2.calls.items()):
+            self.set("baker_b2_calls_total", count, operation=operation)
+
+    def render(self):
+        """Returns all metrics, in the Prometheus text format"""
+
+        for function in self._collectors:
+            function()
+
+        lines = []
+        with self._lock:
+            for name, (kind, description) in METRICS.items():
+                series = self._values[name]
+                if not series:
+                    continue
+                lines.append("# HELP %s %s" % (name, description))
+                lines.append("# TYPE %s %s" % (name, kind))
+                for labels, value in series.items():
+                    text = ""
+                    if labels:
+                        text = "{%s}" % ",".join(
+                            '%s="%s"' % (k, _escape(v)) for k, v in labels
+                        )
+                    lines.append("%s%s %r" % (name, text, float(value)))
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        """Writes metrics to :py:attr:`path` (atomically), if that is set"""
+
+        if self.path is None:
+            return
+        tmp = "%s.%d.tmp" % (self.path, os.getpid())
+        try:
+            with open(tmp, "wt") as f:
+                f.write(self.render())
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logger.warning("Could not write metrics to `%s': %s", self.path, e)
+
+    def serve(self, port, address=""):
+        """Serves metrics over HTTP, from a background thread
+
+        Returns the port the server listens to (useful if ``port`` is zero).
+        """
+
+        import http.server
+
+        metrics = self
+
+        class _Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug("Metrics request: " + format, *args)
+
+        self._server = http.server.ThreadingHTTPServer(
+            (address, port), _Handler
+        )
+        self._server.daemon_threads = True
+        threading.Thread(
+            target=self._server.serve_forever, name="metrics", daemon=True
+        ).start()
+        port = self._server.server_address[1]
+        logger.info("Serving metrics on port %d", port)
+        return port
+
+    def close(self):
+        """Stops the HTTP server, if one is running"""
+
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def _run_finished(self, command, run, failed):
+        """Sets metrics common to all jobs
+
+        ``failed`` maps each repository to ``True``, if the job failed on it.
+        """
+
+        now = time.time()
+        self.set("baker_last_run_timestamp_seconds", now, command=command)
+        self.set(
+            "baker_last_run_duration_seconds", run.wall or 0.0, command=command
+        )
+
+        self.clear("baker_step_duration_seconds", command=command)
+        for (repository, step), wall in _steps(run).items():
+            self.set(
+                "baker_step_duration_seconds",
+                wall,
+                command=command,
+                repository=repository,
+                step=step,
+            )
+
+        for repository, error in failed.items():
+            self.set(
+                "baker_last_run_failed",
+                int(bool(error)),
+                command=command,
+                repository=repository,
+            )
+            if not error:
+                self.set(
+                    "baker_last_success_timestamp_seconds",
+                    now,
+                    command=command,
+                    repository=repository,
+                )
+
+    def update_finished(self, run, failed, summaries):
+        """Records the results of an update run, then writes metrics
+
+
+        Parameters:
+
+          run (baker.spans.Span): The span of the whole run
+
+          failed (dict): Maps each repository to ``True``, if the update
+            failed, or ``False``, otherwise
+
+          summaries (dict): Maps repositories to the
+            :py:class:`baker.restic.BackupSummary` of their back-up, if one
+            was done
+
+        """
+
+        self._run_finished("update", run, failed)
+
+        recoveries = _recoveries(run)
+        for repository in failed:
+            self.set(
+                "baker_recovery_attempts",
+                len(recoveries.get(repository, ())),
+                repository=repository,
+            )
+
+        for repository, summary in summaries.items():
+            self.set(
+                "baker_backup_added_bytes",
+                summary.data_added,
+                repository=repository,
+            )
+
+        self.write()
+
+    def check_finished(self, run, failed, snapshots, sizes):
+        """Records the results of a check run, then writes metrics
+
+
+        Parameters:
+
+          run (baker.spans.Span): The span of the whole run
+
+          failed (dict): Maps each repository to ``True``, if the check
+            failed, or ``False``, otherwise
+
+          snapshots (dict): Maps repositories to the list of snapshots of
+            this host on them
+
+          sizes (dict): Maps repositories to their size, in bytes, if known
+
+        """
+
+        self._run_finished("check", run, failed)
+
+        for repository, items in snapshots.items():
+            self.set("baker_snapshots", len(items), repository=repository)
+            if items:
+                self.set(
+                    "baker_latest_snapshot_timestamp_seconds",
+                    max(k["time"] for k in items).timestamp(),
+                    repository=repository,
+                )
+
+        for repository, size in sizes.items():
+            self.set(
+                "baker_repository_size_bytes", size, repository=repository
+            )
+
+        self.write()
+
+    def watch(self, command, scheduler):
+        """Exposes the lag and next run of a job's scheduler"""
+
+        def _collect():
+            if scheduler.last_lag is not None:
+                self.set(
+                    "baker_scheduler_lag_seconds",
+                    scheduler.last_lag,
+                    command=command,
+                )
+            if scheduler.next_run is not None:
+                self.set(
+                    "baker_scheduler_next_run_timestamp_seconds",
+                    scheduler.next_run.timestamp(),
+                    command=command,
+                )
+
+        self.collector(_collect)
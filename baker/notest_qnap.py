@@ -5,31 +5,32 @@
 """Tests for the QNAP Container Station API"""
 
 
-from . import qnap
+from . import qnap, utils
 
 
-session = None
+client = None
 
 
 def setup():
 
-    global session
-    session = qnap.login()
+    global client
+    nas = utils.retrieve_json_secret("nas/info.json")
+    client = qnap.QnapClient(nas["server"], nas["username"], nas["password"])
 
 
 def teardown():
 
-    qnap.logout()
+    client.close()
 
 
 def test_system():
 
-    info = qnap.system(session)
+    info = client.system()
     assert info["status"] == "running"
     assert info["needRestart"] == False
 
 
 def test_get_containers():
 
-    info = qnap.get_containers(session)
+    info = client.get_containers()
     assert isinstance(info, list)
@@ -11,9 +11,13 @@ import os
 import pickle
 import requests
 import warnings
+import threading
 import contextlib
 import importlib.metadata
 
+import requests.adapters
+import urllib3.util
+
 import logging
 
 logger = logging.getLogger(__name__)
@@ -22,6 +26,14 @@ logger = logging.getLogger(__name__)
 SESSION_FILE = os.path.expanduser("~/.qnap-auth.pickle")
 
 
+_UNAUTHORIZED = (401, 403)
+"""Status codes after which we log-in again"""
+
+
+_RETRY_STATUS = (429, 502, 503, 504)
+"""Status codes after which (idempotent) requests are retried"""
+
+
 @contextlib.contextmanager
 def no_ssl_warnings(verify):
     if not verify:
@@ -31,52 +43,23 @@ def no_ssl_warnings(verify):
         warnings.resetwarnings()
 
 
-def api(session, server, url, verb="get", data=None, json=None, verify=False):
-    """Calls the container station API with a given url and data dictionary
-
-
-    Parameters:
-
-      session (requests.Session): A previously opened session with the
-        authentication cookies to use
+class QnapClient(object):
+    """A client to the Container Station API of a QNAP NAS
 
-      server (str): The server to reach
+    All requests go through a single :py:class:`requests.Session`, so
+    connections are kept alive and reused.  Requests time out, and idempotent
+    ones are retried with exponential backoff on connection errors and on
+    temporary server errors.
 
-      url (str): The URL to call on the container station API, relative to the
-        the address ``/container-station/api/v1", which is always
-        prepended.
-
-      verb (str, Optional): One of the HTTP verbs to query the URL with. If not
-        specified, defaults to ``get``. Any verb available in
-        :py:class:`requests.Session` is acceptable.
-
-      data (dict, Optional): A dictionary containing parameters to pass to the
-        API
-
-      verify (bool, Optional): If should use ``verify=True`` for requests calls
-
-
-    Returns:
-
-      int: The returned status code
-
-      requests.Result: An object that contains the reply from the HTTP API call
-
-    """
-
-    url = server + '/container-station/api/v1' + url
-    logger.debug('%s %s', verb.upper(), url)
-    with no_ssl_warnings(verify):
-      return getattr(session, verb)(url, data=data, json=json, verify=verify)
-
-
-def login(server, username, password, verify=False):
-    """Logs-in the server, if a session file is not available yet.
+    Authentication cookies are kept on :py:data:`SESSION_FILE`, so that they
+    can be reused by later runs.  We only log-in when there are no cookies, or
+    once the server replies a request is unauthorized (then, the request is
+    sent again).  Clients may be shared by several threads.
 
 
     Parameters:
 
-      server (str): The server to reach
+      server (str): The server to reach (e.g. ``https://nas:8443``)
 
       username (str): The user identifier to use for login
 
@@ -84,287 +67,334 @@ def login(server, username, password, verify=False):
 
       verify (bool, Optional): If should use ``verify=True`` for requests calls
 
+      timeout (tuple, Optional): Connection and read timeouts, in seconds
+
+      retries (int, Optional): Maximum number of retries for each request
 
-    Returns:
+      backoff (float, Optional): Backoff factor, in seconds, between retries
+        (see :py:class:`urllib3.util.Retry`)
 
-      requests.Session: A restored or new session after successfuly
-      authenticating to the server
+      pool_size (int, Optional): Maximum number of connections kept open
 
     """
 
-    if os.path.exists(SESSION_FILE):
-        logger.debug(
-            "Session file (%s) exists - trying to use it", SESSION_FILE
-        )
-        with open(SESSION_FILE, "rb") as f:
-            session = pickle.load(f)
-        result = api(session, server, "/login_refresh", verify=verify)
-        if "error" in result.json():
-            logout(server, verify=verify)
-
-    if not os.path.exists(SESSION_FILE):
-        logger.debug(
-            "Session file (%s) does not exist - logging-in", SESSION_FILE
+    def __init__(
+        self,
+        server,
+        username,
+        password,
+        verify=False,
+        timeout=(5, 60),
+        retries=3,
+        backoff=0.5,
+        pool_size=4,
+    ):
+
+        self.server = server.rstrip("/")
+        self.username = username
+        self.password = password
+        self.verify = verify
+        self.timeout = timeout
+        self._login_lock = threading.Lock()
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=urllib3.util.Retry(
+                total=retries,
+                backoff_factor=backoff,
+                status_forcelist=_RETRY_STATUS,
+                raise_on_status=False,
+            ),
         )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
 
-    session = requests.Session()
-    data = dict(username=username, password=password)
-    result = api(session, server, '/login', verb='post', json=data, verify=verify)
+        if os.path.exists(SESSION_FILE):
+            logger.debug("Reusing authentication from %s", SESSION_FILE)
+            try:
+                with open(SESSION_FILE, "rb") as f:
+                    saved = pickle.load(f)
+                # older versions saved the whole session
+                self.session.cookies.update(getattr(saved, "cookies", saved))
+            except Exception as e:
+                logger.warning("Ignoring %s: %s", SESSION_FILE, e)
 
-    if result.status_code != 200:
-        raise RuntimeError(
-            "Login request failed with status code %d" % result.status_code
-        )
-    response = result.json()
-    if response.get("username") != username:
-        raise RuntimeError(
-            "Login request for user %s failed (%s is "
-            "logged in)" % (username, response.get("username"))
-        )
+    def __enter__(self):
+        return self
 
-    with open(SESSION_FILE, "wb") as f:
-        pickle.dump(session, f)
+    def __exit__(self, *exc):
+        self.close()
 
-    return session
+    def close(self):
+        """Closes all connections (authentication is kept for later runs)"""
 
+        self.session.close()
 
-def logout(server, verify=False):
-    """Logs the user out
+    def _send(self, verb, url, data=None, json=None):
+        """Sends a request, without checking for authentication errors"""
 
+        url = self.server + "/container-station/api/v1" + url
+        logger.debug("%s %s", verb.upper(), url)
+        with no_ssl_warnings(self.verify):
+            return self.session.request(
+                verb.upper(),
+                url,
+                data=data,
+                json=json,
+                verify=self.verify,
+                timeout=self.timeout,
+            )
 
-    Parameters:
+    def api(self, url, verb="get", data=None, json=None):
+        """Calls the container station API with a given url and data
 
-      server (str): The server to reach
 
-      verify (bool, Optional): If should use ``verify=True`` for requests calls
+        Parameters:
 
-    """
+          url (str): The URL to call on the container station API, relative to
+            the address ``/container-station/api/v1``, which is always
+            prepended.
 
-    if not os.path.exists(SESSION_FILE):
-        logger.error(
-            "No session file exists at %s - not logging out", SESSION_FILE
-        )
-        return
+          verb (str, Optional): One of the HTTP verbs to query the URL with. If
+            not specified, defaults to ``get``.
 
-    logger.debug("Logging out...")
+          data (dict, Optional): A dictionary containing parameters to pass to
+            the API
 
-    with open(SESSION_FILE, "rb") as f:
-        session = pickle.load(f)
+          json (dict, Optional): An object to pass to the API, as JSON
 
-    result = api(session, server, "/logout", verb="put", verify=verify)
-    response = result.json()
 
-    if os.path.exists(SESSION_FILE):
-        logger.debug("Removing %s...", SESSION_FILE)
-        os.unlink(SESSION_FILE)
+        Returns:
 
-    session.close()  # close all connections
+          requests.Response: The reply from the HTTP API call
 
+        """
 
-@contextlib.contextmanager
-def session(server, username, password, verify=False):
-    """Context manager that opens and closes a connection to the NAS"""
+        with self._login_lock:
+            if not self.session.cookies:
+                self.login()
+            cookies = self.session.cookies.get_dict()
 
-    yield login(server, username, password, verify=verify)
-    logout(server, verify=verify)
+        result = self._send(verb, url, data=data, json=json)
 
+        if result.status_code in _UNAUTHORIZED:
+            with self._login_lock:
+                # another thread may have logged-in meanwhile
+                if self.session.cookies.get_dict() == cookies:
+                    logger.debug(
+                        "Request was not authorized (%d) - logging-in again",
+                        result.status_code,
+                    )
+                    self.login()
+            result = self._send(verb, url, data=data, json=json)
 
-def system(server, session=None, verify=False):
-    """Checks system information
+        return result
 
+    def login(self):
+        """Logs-in the server, saving authentication cookies for later runs"""
 
-    Parameters:
-
-      server (str): The server to reach
-
-      session (requests.Session): A previously opened session you'd like to close
-
-      verify (bool, Optional): If should use ``verify=True`` for requests calls
-
-
-    Returns:
-
-      dict: A valid JSON object, decoded into Python
+        logger.debug("Logging-in as %s...", self.username)
 
-    """
+        self.session.cookies.clear()
+        data = dict(username=self.username, password=self.password)
+        result = self._send("post", "/login", json=data)
 
-    return api(session, server, "/system", verify=verify).json()
+        if result.status_code != 200:
+            raise RuntimeError(
+                "Login request failed with status code %d" % result.status_code
+            )
+        response = result.json()
+        if response.get("username") != self.username:
+            raise RuntimeError(
+                "Login request for user %s failed (%s is "
+                "logged in)" % (self.username, response.get("username"))
+            )
 
+        with open(SESSION_FILE, "wb") as f:
+            os.chmod(SESSION_FILE, 0o600)
+            pickle.dump(self.session.cookies, f)
 
-def get_containers(session, server, verify=False):
-    """Gets all information on available containers
+    def logout(self):
+        """Logs the user out, and removes the saved authentication"""
 
+        if self.session.cookies:
+            logger.debug("Logging out...")
+            self._send("put", "/logout")
+            self.session.cookies.clear()
 
-    Parameters:
+        if os.path.exists(SESSION_FILE):
+            logger.debug("Removing %s...", SESSION_FILE)
+            os.unlink(SESSION_FILE)
 
-      session (requests.Session): A previously opened session you'd like to close
+    def system(self):
+        """Checks system information
 
-      server (str): The server to reach
 
-      verify (bool, Optional): If should use ``verify=True`` for requests calls
+        Returns:
 
+          dict: A valid JSON object, decoded into Python
 
-    Returns:
+        """
 
-      list of dict: Containing information about all running containers
+        return self.api("/system").json()
 
-    """
+    def get_containers(self):
+        """Gets all information on available containers
 
-    return api(session, server, "/container", verify=verify).json()
 
+        Returns:
 
-def inspect_container(session, server, id_, verify=False):
-    """Gets all information on the container with the given identifier
+          list of dict: Containing information about all running containers
 
+        """
 
-    Parameters:
+        return self.api("/container").json()
 
-      session (requests.Session): A previously opened session you'd like to close
+    def inspect_container(self, id_):
+        """Gets all information on the container with the given identifier
 
-      server (str): The server to reach
 
-      id_ (str): The identify of the container to inspect
+        Parameters:
 
-      verify (bool, Optional): If should use ``verify=True`` for requests calls
+          id_ (str): The identify of the container to inspect
 
 
-    Returns:
+        Returns:
 
-      list: A valid JSON object, decoded into Python
+          list: A valid JSON object, decoded into Python
 
-    """
+        """
 
-    return api(
-        session, server, "/container/docker/%s/inspect" % id_, verify=verify
-    ).json()
+        return self.api("/container/docker/%s/inspect" % id_).json()
 
+    def start_container(self, id_):
+        """Starts the container with the given identifier
 
-def stop_container(session, server, id_, verify=False):
-    """Stops the container with the given identifier
 
+        Parameters:
 
-    Parameters:
+          id_ (str): The identify of the container to start
 
-      session (requests.Session): A previously opened session you'd like to close
 
-      server (str): The server to reach
+        Returns:
 
-      id_ (str): The identify of the container to stop
+          list: A valid JSON object, decoded into Python
 
-      verify (bool, Optional): If should use ``verify=True`` for requests calls
+        """
 
+        return self.api("/container/docker/%s/start" % id_, verb="put").json()
 
-    Returns:
+    def stop_container(self, id_):
+        """Stops the container with the given identifier
 
-      list: A valid JSON object, decoded into Python
 
-    """
+        Parameters:
 
-    return api(
-        session,
-        server,
-        "/container/docker/%s/stop" % id_,
-        verb="put",
-        verify=verify,
-    ).json()
+          id_ (str): The identify of the container to stop
 
 
-def remove_container(session, server, id_, verify=False):
-    """Removes the container with the given identifier
+        Returns:
 
+          list: A valid JSON object, decoded into Python
 
-    Parameters:
+        """
 
-      session (requests.Session): A previously opened session you'd like to close
+        return self.api("/container/docker/%s/stop" % id_, verb="put").json()
 
-      server (str): The server to reach
+    def remove_container(self, id_):
+        """Removes the container with the given identifier
 
-      id_ (str): The identify of the container to be removed
 
-      verify (bool, Optional): If should use ``verify=True`` for requests calls
+        Parameters:
 
+          id_ (str): The identify of the container to be removed
 
-    Returns:
 
-      list: A valid JSON object, decoded into Python
+        Returns:
 
-    """
+          list: A valid JSON object, decoded into Python
 
-    return api(
-        session,
-        server,
-        "/container/docker/%s" % id_,
-        verb="delete",
-        verify=verify,
-    ).json()
+        """
 
+        return self.api("/container/docker/%s" % id_, verb="delete").json()
 
-def create_container(
-    session,
-    server,
-    name,
-    options,
-    image="anjos/baker",
-    tag="v%s" % importlib.metadata.version(__package__),
-    verify=False,
-):
-    """Creates a container with an existing image
+    def create_container(
+        self,
+        name,
+        options,
+        image="anjos/baker",
+        tag="v%s" % importlib.metadata.version(__package__),
+    ):
+        """Creates a container with an existing image
 
 
-    Parameters:
+        Parameters:
 
-      session (requests.Session): A previously opened session you'd like to close
+          name (str): The name of the container to update
 
-      server (str): The server to reach
+          options (dict): A dictionary of options that will be passed to the
+            API
 
-      name (str): The name of the container to update
+          image (str): The name of the image to use for the update (e.g.:
+            'anjos/baker')
 
-      image (str): The name of the image to use for the update (e.g.:
-        'anjos/baker')
+          tag (str): Tag to be used for the above image (e.g.: 'v1.2.3')
 
-      tag (str): Tag to be used for the above image (e.g.: 'v1.2.3')
+        """
 
-      options (dict): A dictionary of options that will be passed to the API
+        info = dict(
+            type="docker",
+            name=name,
+            image=image,
+            tag=tag,
+        )
 
-      verify (bool, Optional): If should use ``verify=True`` for requests calls
+        # prepares new container information
+        info.update(options)
 
-    """
+        return self.api("/container", verb="post", json=info).json()
 
-    info = dict(
-        type="docker",
-        name=name,
-        image=image,
-        tag=tag,
-    )
+    def retrieve_logs(self, id_, tail=1000, since=None, timestamps=False):
+        """Retrieves the logs from container
 
-    # prepares new container information
-    info.update(options)
 
-    response = api(
-        session, server, "/container", verb="post", json=info, verify=verify
-    )
-    return response.json()
+        Parameters:
 
+          id_ (str): The identifier of the container to retrieve logs from
 
-def retrieve_logs(session, server, id_, tail=1000, verify=False):
-    """Retrieves the logs from container
+          tail (int, Optional): The number of lines to retrieve, from the end.
+            If ``None``, retrieve all lines
 
+          since (int, Optional): If set, only retrieve lines logged at, or
+            after, this time (in seconds since the epoch)
 
-    Parameters:
+          timestamps (bool, Optional): If set, prefix each line with the time
+            it was logged at (RFC 3339, with nanoseconds)
 
-      session (requests.Session): A previously opened session you'd like to close
+        """
 
-      server (str): The server to reach
+        args = []
+        if tail is not None:
+            args.append("tail=%d" % tail)
+        if since is not None:
+            args.append("since=%d" % since)
+        if timestamps:
+            args.append("timestamps=1")
+        url = "/container/docker/%s/logs" % id_
+        if args:
+            url += "?" + "&".join(args)
+        return self.api(url).json()
 
-      id_ (str): The identifier of the container to retrieve logs from
 
-      verify (bool, Optional): If should use ``verify=True`` for requests calls
+@contextlib.contextmanager
+def session(server, username, password, verify=False):
+    """Context manager that opens and closes a connection to the NAS
 
+    Authentication is not revoked when leaving the context, so that later
+    runs can reuse it (see :py:class:`QnapClient`).
     """
 
-    return api(
-        session,
-        server,
-        "/container/docker/%s/logs?tail=%d" % (id_, tail),
-        verify=verify,
-    ).json()
+    with QnapClient(server, username, password, verify=verify) as client:
+        yield client
@@ -5,19 +5,25 @@
 """Removes all test buckets from my B2 account"""
 
 
+JOBS = 4
+"""Number of buckets torn down concurrently"""
+
+
 def main():
+    import asyncio
+
     from . import b2
+    from .utils import gather
 
     buckets = b2.list_buckets()
-    count = 0
-    delete_keys = []
-    for k in buckets.keys():
-        if k.startswith("baker-test-"):
-            count += 1
-            print('Removing test bucket "%s"...' % k)
-            d = b2.remove_bucket(k)
-            print('Removed bucket "%(bucketName)s" (id: %(bucketId)s)' % d)
-            delete_keys.append(k)
+    delete_keys = [k for k in buckets.keys() if k.startswith("baker-test-")]
+
+    async def _remove(k):
+        print('Removing test bucket "%s"...' % k)
+        d = await b2.remove_bucket_async(k)
+        print('Removed bucket "%(bucketName)s" (id: %(bucketId)s)' % d)
+
+    asyncio.run(gather([_remove(k) for k in delete_keys], jobs=JOBS))
 
     for k in delete_keys:
         del buckets[k]
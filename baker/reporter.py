@@ -6,8 +6,12 @@
 
 import sys
 import io
+import time
+import queue
+import atexit
 import smtplib
 import datetime
+import threading
 import email.mime.text
 import email.mime.multipart
 
@@ -54,19 +58,225 @@ class Email(object):
 
     def send(self, server, port, username, password):
 
-        server = smtplib.SMTP(server, port)
-        server.ehlo()
-        server.starttls()
-        server.login(username, password)
-        server.sendmail(self.sender, self.to, self.msg.as_bytes())
+        server = _connect(server, port, username, password)
+        self.send_on(server)
         server.close()
 
+    def send_on(self, connection):
+        """Sends the message on an open (and authenticated) SMTP connection"""
+
+        connection.sendmail(self.sender, self.to, self.msg.as_bytes())
+
     def message(self):
         """Returns a string representation of the message"""
 
         return self.msg.as_string()
 
 
+def _connect(server, port, username, password, timeout=None):
+    """Opens an authenticated SMTP connection"""
+
+    if timeout is None:
+        connection = smtplib.SMTP(server, port)
+    else:
+        connection = smtplib.SMTP(server, port, timeout=timeout)
+    connection.ehlo()
+    connection.starttls()
+    connection.login(username, password)
+    return connection
+
+
+class Notifier(object):
+    """Sends e-mail messages from a background thread
+
+    Messages submitted with :py:meth:`submit` are queued and sent, in order, by
+    a worker thread, so callers never wait on the SMTP server.  The worker
+    keeps one authenticated connection open while there are messages to send,
+    and closes it after being idle for a while.  Failed deliveries are retried,
+    on a new connection, with exponential backoff.
+
+
+    Parameters:
+
+      server (str): The SMTP server to connect to
+
+      port (int): The port to connect to
+
+      username (str): The username for the SMTP authentication
+
+      password (str): The password for the SMTP authentication
+
+      maxsize (int, Optional): The maximum number of messages waiting to be
+        sent.  If the queue is full, :py:meth:`submit` waits up to ``timeout``
+        seconds for a free slot and then drops the message.
+
+      timeout (float, Optional): Timeout, in seconds, for network operations
+
+      retries (int, Optional): The number of times to retry sending a message
+
+      backoff (float, Optional): Seconds to wait before the first retry.  This
+        time doubles at every new retry.
+
+      idle (float, Optional): Seconds after which an unused connection is
+        closed
+
+    """
+
+    def __init__(
+        self,
+        server,
+        port,
+        username,
+        password,
+        maxsize=100,
+        timeout=60,
+        retries=3,
+        backoff=10,
+        idle=30,
+    ):
+
+        self.server = server
+        self.port = port
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.idle = idle
+
+        self.queue = queue.Queue(maxsize)
+        self.connection = None
+        self.thread = threading.Thread(
+            target=self._run, name="notifier", daemon=True
+        )
+        self.thread.start()
+
+    def submit(self, msg):
+        """Queues a message (an :py:class:`Email`) for delivery"""
+
+        try:
+            self.queue.put(msg, timeout=self.timeout)
+        except queue.Full:
+            logger.error(
+                "Notification queue is full - dropping message `%s'",
+                msg.msg["Subject"],
+            )
+
+    def flush(self, timeout=None):
+        """Waits until all queued messages were handled
+
+        Returns ``True`` if the queue was flushed, or ``False`` if the timeout
+        expired first.
+        """
+
+        with self.queue.all_tasks_done:
+            return self.queue.all_tasks_done.wait_for(
+                lambda: not self.queue.unfinished_tasks, timeout
+            )
+
+    def close(self, timeout=None):
+        """Sends pending messages and stops the worker thread"""
+
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+    def _disconnect(self):
+
+        if self.connection is not None:
+            try:
+                self.connection.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.connection = None
+
+    def _deliver(self, msg):
+
+        for attempt in range(self.retries + 1):
+            try:
+                if self.connection is None:
+                    self.connection = _connect(
+                        self.server,
+                        self.port,
+                        self.username,
+                        self.password,
+                        self.timeout,
+                    )
+                msg.send_on(self.connection)
+                return
+
+            except (smtplib.SMTPException, OSError) as e:
+                self._disconnect()
+                if attempt == self.retries:
+                    logger.error(
+                        "Could not send message `%s' after %d attempts: %s",
+                        msg.msg["Subject"],
+                        attempt + 1,
+                        e,
+                    )
+                    return
+                wait = self.backoff * (2**attempt)
+                logger.warning(
+                    "Error sending message `%s' (%s) - retrying in %s",
+                    msg.msg["Subject"],
+                    e,
+                    human_time(wait),
+                )
+                time.sleep(wait)
+
+    def _run(self):
+
+        while True:
+            try:
+                msg = self.queue.get(timeout=self.idle)
+            except queue.Empty:
+                self._disconnect()
+                continue
+
+            try:
+                if msg is None:  # stop
+                    self._disconnect()
+                    return
+                self._deliver(msg)
+            except Exception:
+                logger.exception("Unexpected error sending message")
+            finally:
+                self.queue.task_done()
+
+
+_notifiers = {}
+"""Notifiers in use, per server and user"""
+
+_notifiers_lock = threading.Lock()
+
+
+def notifier(server, port, username, password):
+    """Returns the notifier for a given SMTP server and user
+
+    Notifiers are shared, so that all messages for the same server and user go
+    through the same connection.  Pending messages are sent before the
+    interpreter exits.
+    """
+
+    key = (server, port, username)
+    with _notifiers_lock:
+        if key not in _notifiers:
+            if not _notifiers:
+                atexit.register(_flush_notifiers)
+            _notifiers[key] = Notifier(server, port, username, password)
+        return _notifiers[key]
+
+
+def _flush_notifiers():
+    """Sends pending messages of all notifiers, at exit"""
+
+    with _notifiers_lock:
+        notifiers = list(_notifiers.values())
+        _notifiers.clear()
+
+    for k in notifiers:
+        k.close()
+
+
 def setup_logger(name, verbosity):
     """Sets up the logging of a script
 
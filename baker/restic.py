@@ -7,22 +7,28 @@
 import os
 import copy
 import json
-import shutil
+import time
+import asyncio
 import datetime
+import collections
 
 import logging
 
 logger = logging.getLogger(__name__)
 
-from .utils import run_cmdline
-
-
-RESTIC_BIN = shutil.which("restic")
-logger.debug("Using restic from `%s'", RESTIC_BIN)
+from .utils import run_cmdline_async, OutputBuffer, which
+from .reporter import human_time, humanize_bytes
 
 
 def run_restic(
-    global_options, subcmd, subcmd_options, password=None, cache=None
+    global_options,
+    subcmd,
+    subcmd_options,
+    password=None,
+    cache=None,
+    env=None,
+    output=None,
+    callback=None,
 ):
     """Runs restic on a contained environment, report output and status
 
@@ -44,40 +50,85 @@ def run_restic(
       cache (str, Optional): The path to the cache directory to use for restic.
         If not set, use the XDG cache default (typically ~/.cache/restic)
 
+      env (dict, Optional): The environment to run restic on. If not set, use
+        :py:obj:`os.environ`. The dictionary is not modified.
+
+      output (OutputBuffer, Optional): If set, stream the output of restic into
+        this buffer (see :py:func:`.utils.run_cmdline`)
+
+      callback (callable, Optional): If set, called for each line of output
+        (see :py:func:`.utils.run_cmdline`)
+
 
     Returns:
 
-      bool: ``True`` if the program returned 0 exit status (ran w/o problems)
+      str: The output of the command, or ``output``, if that is set
+
+    """
+
+    return asyncio.run(
+        run_restic_async(
+            global_options,
+            subcmd,
+            subcmd_options,
+            password,
+            cache,
+            env,
+            output,
+            callback,
+        )
+    )
+
+
+async def run_restic_async(
+    global_options,
+    subcmd,
+    subcmd_options,
+    password=None,
+    cache=None,
+    env=None,
+    output=None,
+    callback=None,
+):
+    """Asynchronous version of :py:func:`run_restic`
 
+    Cancelling the returned coroutine kills the restic process.
     """
 
-    if not RESTIC_BIN:
+    restic_bin = which("restic", cache)
+    if not restic_bin:
         raise RuntimeError(
             "The executable `restic' must be available " "on your ${PATH}"
         )
 
-    env = copy.copy(os.environ)
+    env = copy.copy(os.environ if env is None else env)
     if password:
         env.setdefault("RESTIC_PASSWORD", password)
 
     if cache:
-        global_options += ["--cache-dir", cache]
+        # do not modify the caller's list, it may be shared between jobs
+        global_options = global_options + ["--cache-dir", cache]
 
-    cmd = [RESTIC_BIN] + global_options + [subcmd] + subcmd_options
+    cmd = [restic_bin] + global_options + [subcmd] + subcmd_options
 
-    return run_cmdline(cmd, env)
+    return await run_cmdline_async(
+        cmd, env, output=output, callback=callback
+    )
 
 
-def _assert_b2_setup(repo):
+def _assert_b2_setup(repo, env=None):
     """Checks if B2 credentials are setup correctly"""
 
+    if env is None:
+        env = os.environ
+
     if repo.startswith("b2:"):
-        if "B2_ACCOUNT_ID" not in os.environ:
+        if "B2_ACCOUNT_ID" not in env:
             raise RuntimeError(
                 "You must setup ${B2_ACCOUNT_ID} to use a "
                 "BackBlaze B2 repository"
             )
-        if "B2_ACCOUNT_KEY" not in os.environ:
+        if "B2_ACCOUNT_KEY" not in env:
             raise RuntimeError(
                 "You must setup ${B2_ACCOUNT_KEY} to use a "
                 "BackBlaze B2 repository"
@@ -87,10 +138,16 @@ def _assert_b2_setup(repo):
 def version():
     """Returns the result of ``restic version``"""
 
-    return run_restic([], "version", [])
+    return asyncio.run(version_async())
+
+
+async def version_async():
+    """Asynchronous version of :py:func:`version`"""
+
+    return await run_restic_async([], "version", [])
 
 
-def init(repository, global_options, password, cache):
+def init(repository, global_options, password, cache, env=None, output=None):
     """Initializes a restic repository
 
     The repository may be local or sitting on a remote B2 bucket
@@ -111,11 +168,38 @@ def init(repository, global_options, password, cache):
       cache (str): The path to the cache directory to use for restic. If not set,
         use the XDG cache default (typically ~/.cache/restic)
 
+      env (dict, Optional): The environment to run restic on. If not set, use
+        :py:obj:`os.environ`. Use it to pass per-job B2 credentials.
+
+      output (OutputBuffer, Optional): If set, stream the output of restic into
+        this buffer, which is returned instead of a string
+
     """
 
-    _assert_b2_setup(repository)
-    return run_restic(
-        ["--repo", repository] + global_options, "init", [], password, cache
+    return asyncio.run(
+        init_async(repository, global_options, password, cache, env, output)
+    )
+
+
+async def init_async(
+    repository,
+    global_options,
+    password,
+    cache,
+    env=None,
+    output=None,
+):
+    """Asynchronous version of :py:func:`init`"""
+
+    _assert_b2_setup(repository, env)
+    return await run_restic_async(
+        ["--repo", repository] + global_options,
+        "init",
+        [],
+        password,
+        cache,
+        env,
+        output,
     )
 
 
@@ -127,6 +211,8 @@ def backup(
     backup_options,
     password,
     cache,
+    env=None,
+    output=None,
 ):
     """Performs the backup
 
@@ -158,19 +244,335 @@ def backup(
       cache (str): The path to the cache directory to use for restic. If not set,
         use the XDG cache default (typically ~/.cache/restic)
 
+      env (dict, Optional): The environment to run restic on. If not set, use
+        :py:obj:`os.environ`. Use it to pass per-job B2 credentials.
+
+      output (OutputBuffer, Optional): If set, stream the output of restic into
+        this buffer, which is returned instead of a string
+
     """
 
-    _assert_b2_setup(repository)
-    return run_restic(
+    return asyncio.run(
+        backup_async(
+            directory,
+            repository,
+            global_options,
+            hostname,
+            backup_options,
+            password,
+            cache,
+            env,
+            output,
+        )
+    )
+
+
+async def backup_async(
+    directory,
+    repository,
+    global_options,
+    hostname,
+    backup_options,
+    password,
+    cache,
+    env=None,
+    output=None,
+):
+    """Asynchronous version of :py:func:`backup`"""
+
+    _assert_b2_setup(repository, env)
+    return await run_restic_async(
         ["--repo", repository] + global_options,
         "backup",
         ["--host", hostname] + backup_options + [directory],
         password,
         cache,
+        env,
+        output,
+    )
+
+
+
+BackupSummary = collections.namedtuple(
+    "BackupSummary",
+    [
+        "snapshot_id",
+        "files_new",
+        "files_changed",
+        "files_unmodified",
+        "dirs_new",
+        "dirs_changed",
+        "dirs_unmodified",
+        "data_added",
+        "total_files_processed",
+        "total_bytes_processed",
+        "total_duration",
+    ],
+)
+BackupSummary.__doc__ = """Statistics of a ``restic backup`` run
+
+All fields are integers, except ``snapshot_id`` (a string, the identifier of
+the saved snapshot, or ``None``, if restic did not report one) and
+``total_duration`` (a float, in seconds).  ``data_added`` is the number of
+bytes added to the repository.  Counts restic did not report are zero.
+"""
+
+
+def short_id(snapshot_id):
+    """Returns the short form of a snapshot identifier, as restic shows it
+
+    Missing identifiers (``None`` or empty) are shown as ``unknown``.
+    """
+
+    return snapshot_id[:8] if snapshot_id else "unknown"
+
+
+class _BackupProgress(object):
+    """Parses the messages of ``restic backup --json``, as they arrive
+
+    Status messages are logged (at most once every ``interval`` seconds) with
+    the current processing rates and the estimated time to completion.  The
+    summary message is kept on the attribute ``summary``.  Anything that is not
+    a JSON message (e.g. warnings) is captured as is.
+
+
+    Parameters:
+
+      directory (str): The directory being backed-up, for logging purposes
+
+      interval (float, Optional): Minimum interval, in seconds, between two
+        progress log messages
+
+    """
+
+    def __init__(self, directory, interval=60):
+
+        self.directory = directory
+        self.interval = interval
+        self.summary = None
+        self._last = None
+
+    def __call__(self, line):
+
+        if not line.startswith("{"):
+            return line
+
+        try:
+            message = json.loads(line)
+        except ValueError:
+            return line
+
+        kind = message.get("message_type")
+
+        if kind == "status":
+            now = time.time()
+            if self._last is None or (now - self._last) >= self.interval:
+                self._last = now
+                self._log_status(message)
+            return None
+
+        elif kind == "summary":
+            fields = BackupSummary._fields
+            values = dict((k, message.get(k, 0)) for k in fields)
+            values["snapshot_id"] = message.get("snapshot_id")
+            self.summary = BackupSummary(**values)
+            return None
+
+        elif kind == "error":
+            error = message.get("error")
+            if isinstance(error, dict):
+                error = error.get("message", error)
+            return "error during %s of `%s': %s" % (
+                message.get("during", "?"),
+                message.get("item", "?"),
+                error,
+            )
+
+        return None  # verbose_status and other types are not captured
+
+    def _log_status(self, message):
+
+        elapsed = message.get("seconds_elapsed", 0)
+        files_done = message.get("files_done", 0)
+        bytes_done = message.get("bytes_done", 0)
+        total_bytes = message.get("total_bytes", 0)
+
+        files_rate = files_done / elapsed if elapsed else 0.0
+        bytes_rate = bytes_done / elapsed if elapsed else 0.0
+
+        remaining = message.get("seconds_remaining")
+        if remaining is None and bytes_rate and total_bytes:
+            remaining = (total_bytes - bytes_done) / bytes_rate
+
+        logger.info(
+            "%s: %.1f%% done, %d/%d files (%.1f files/s), %s/%s "
+            "(%.2f MB/s), ETA %s",
+            self.directory,
+            100 * message.get("percent_done", 0),
+            files_done,
+            message.get("total_files", 0),
+            files_rate,
+            humanize_bytes(bytes_done),
+            humanize_bytes(total_bytes),
+            bytes_rate / 1e6,
+            human_time(remaining) if remaining is not None else "unknown",
+        )
+
+
+def _format_summary(summary):
+    """Formats a backup summary like restic does on text mode"""
+
+    return (
+        "\n"
+        "Files:       %5d new, %5d changed, %5d unmodified\n"
+        "Dirs:        %5d new, %5d changed, %5d unmodified\n"
+        "Added to the repo: %s\n"
+        "\n"
+        "processed %d files, %s in %s\n"
+        "snapshot %s saved\n"
+        % (
+            summary.files_new,
+            summary.files_changed,
+            summary.files_unmodified,
+            summary.dirs_new,
+            summary.dirs_changed,
+            summary.dirs_unmodified,
+            humanize_bytes(summary.data_added),
+            summary.total_files_processed,
+            humanize_bytes(summary.total_bytes_processed),
+            human_time(summary.total_duration),
+            short_id(summary.snapshot_id),
+        )
+    )
+
+
+def backup_json(
+    directory,
+    repository,
+    global_options,
+    hostname,
+    backup_options,
+    password,
+    cache,
+    env=None,
+    output=None,
+    interval=60,
+):
+    """Performs the backup, reporting progress and statistics
+
+    This command executes ``restic backup --json`` for the provided local
+    directory on the remote repository.  Progress messages are parsed as they
+    arrive and logged, with processing rates and the estimated time to
+    completion.  A textual summary, similar to that of :py:func:`backup`, is
+    appended to ``output``.
+
+
+    Parameters:
+
+      directory (str): The path leading to the directory that is going to be
+        backed up
+
+      repository (str): The restic repository that will hold the backup. This can
+        be either a local repository path or a BackBlaze B2 bucket name, duly
+        prefixed by ``b2:``.
+
+      global_options (list): A list of global options to pass to restic (like
+        ``--limit-download`` or ``--limit-upload``) - don't include ``--repo``
+        or ``--json`` as these will be included automatically
+
+      hostname (str): The name of the host to use for backing-up
+
+      backup_options (list): A list of backup options to pass to restic (like
+        ``--exclude`` flags) - don't pass ``--host`` as this will be included
+        automatically
+
+      password (str): The restic repository password
+
+      cache (str): The path to the cache directory to use for restic. If not set,
+        use the XDG cache default (typically ~/.cache/restic)
+
+      env (dict, Optional): The environment to run restic on. If not set, use
+        :py:obj:`os.environ`. Use it to pass per-job B2 credentials.
+
+      output (OutputBuffer, Optional): If set, stream the (non-progress) output
+        of restic and the backup summary into this buffer
+
+      interval (float, Optional): Minimum interval, in seconds, between two
+        progress log messages
+
+
+    Returns:
+
+      BackupSummary: The statistics of this backup
+
+    """
+
+    return asyncio.run(
+        backup_json_async(
+            directory,
+            repository,
+            global_options,
+            hostname,
+            backup_options,
+            password,
+            cache,
+            env,
+            output,
+            interval,
+        )
+    )
+
+
+async def backup_json_async(
+    directory,
+    repository,
+    global_options,
+    hostname,
+    backup_options,
+    password,
+    cache,
+    env=None,
+    output=None,
+    interval=60,
+):
+    """Asynchronous version of :py:func:`backup_json`"""
+
+    _assert_b2_setup(repository, env)
+
+    if output is None:
+        output = OutputBuffer()
+
+    progress = _BackupProgress(directory, interval)
+    await run_restic_async(
+        ["--repo", repository, "--json"] + global_options,
+        "backup",
+        ["--host", hostname] + backup_options + [directory],
+        password,
+        cache,
+        env,
+        output,
+        progress,
     )
 
+    if progress.summary is None:
+        raise RuntimeError(
+            "restic backup of `%s' did not report a summary" % directory
+        )
+
+    output.write(_format_summary(progress.summary))
+    return progress.summary
 
-def forget(repository, global_options, hostname, prune, keep, password, cache):
+def forget(
+    repository,
+    global_options,
+    hostname,
+    prune,
+    keep,
+    password,
+    cache,
+    env=None,
+    output=None,
+):
     """Performs the backup
 
     This command executes ``restic forget`` for the provided local directory on
@@ -201,27 +603,73 @@ def forget(repository, global_options, hostname, prune, keep, password, cache):
       cache (str): The path to the cache directory to use for restic. If not set,
         use the XDG cache default (typically ~/.cache/restic)
 
+      env (dict, Optional): The environment to run restic on. If not set, use
+        :py:obj:`os.environ`. Use it to pass per-job B2 credentials.
+
+      output (OutputBuffer, Optional): If set, stream the output of restic into
+        this buffer, which is returned instead of a string
+
     """
 
-    _assert_b2_setup(repository)
+    return asyncio.run(
+        forget_async(
+            repository,
+            global_options,
+            hostname,
+            prune,
+            keep,
+            password,
+            cache,
+            env,
+            output,
+        )
+    )
+
+
+async def forget_async(
+    repository,
+    global_options,
+    hostname,
+    prune,
+    keep,
+    password,
+    cache,
+    env=None,
+    output=None,
+):
+    """Asynchronous version of :py:func:`forget`"""
+
+    _assert_b2_setup(repository, env)
 
     options = ["--prune"] if prune else []
     for key in keep:
         options += ["--keep-%s" % key, str(keep[key])]
 
-    return run_restic(
+    return await run_restic_async(
         ["--repo", repository] + global_options,
         "forget",
         ["--host", hostname] + options,
         password,
         cache,
+        env,
+        output,
     )
 
 
-def check(repository, global_options, thorough, password, cache):
+def check(
+    repository,
+    global_options,
+    thorough,
+    password,
+    cache,
+    env=None,
+    output=None,
+    subset=None,
+):
     """Checks the sanity of a restic repository
 
-    This procedure is recommended after each forget operation
+    This procedure is recommended after each forget operation.  Pack data is
+    only read (and verified) if ``subset`` is set.
 
 
     Parameters:
@@ -242,24 +690,65 @@ def check(repository, global_options, thorough, password, cache):
       cache (str): The path to the cache directory to use for restic. If not set,
         use the XDG cache default (typically ~/.cache/restic)
 
+      env (dict, Optional): The environment to run restic on. If not set, use
+        :py:obj:`os.environ`. Use it to pass per-job B2 credentials.
+
+      output (OutputBuffer, Optional): If set, stream the output of restic into
+        this buffer, which is returned instead of a string
+
+      subset (tuple, Optional): If set, a tuple with two integers ``(n, N)``,
+        indicating that the ``n``-th out of ``N`` slices of the pack files in
+        the repository should be read and verified (``--read-data-subset``).
+        Checking all slices, from 1 to ``N``, reads the whole repository.
+
     """
 
-    _assert_b2_setup(repository)
+    return asyncio.run(
+        check_async(
+            repository,
+            global_options,
+            thorough,
+            password,
+            cache,
+            env,
+            output,
+            subset,
+        )
+    )
+
+
+async def check_async(
+    repository,
+    global_options,
+    thorough,
+    password,
+    cache,
+    env=None,
+    output=None,
+    subset=None,
+):
+    """Asynchronous version of :py:func:`check`"""
+
+    _assert_b2_setup(repository, env)
 
     if thorough:
         options = ["--check-unused"]
     else:
         options = ["--with-cache"]
-    return run_restic(
+    if subset is not None:
+        options += ["--read-data-subset=%d/%d" % tuple(subset)]
+    return await run_restic_async(
         ["--repo", repository] + global_options,
         "check",
         options,
         password,
         cache,
+        env,
+        output,
     )
 
 
-def lock(repository, password, cache):
+def lock(repository, password, cache, env=None):
     """Locks a restic repository
 
 
@@ -274,9 +763,12 @@ def lock(repository, password, cache):
       cache (str): The path to the cache directory to use for restic. If not set,
         use the XDG cache default (typically ~/.cache/restic)
 
+      env (dict, Optional): The environment to run restic on. If not set, use
+        :py:obj:`os.environ`. Use it to pass per-job B2 credentials.
+
     """
 
-    _assert_b2_setup(repository)
+    _assert_b2_setup(repository, env)
     options = ["--with-cache"]
     return run_restic(
         ["--repo", repository] + global_options,
@@ -284,10 +776,13 @@ def lock(repository, password, cache):
         options,
         password,
         cache,
+        env,
     )
 
 
-def snapshots(repository, global_options, hostname, password, cache):
+def snapshots(
+    repository, global_options, hostname, password, cache, env=None, ids=None
+):
     """Lists current snapshots available
 
     Parameters:
@@ -300,13 +795,20 @@ def snapshots(repository, global_options, hostname, password, cache):
         ``--limit-download`` or ``--limit-upload``) - don't include ``--repo`` as
         this will be included automatically
 
-      hostname (str): The name of the host to use for backing-up
+      hostname (str): The name of the host to use for backing-up. If set to
+        ``None``, then list snapshots of all hosts.
 
       password (str): The restic repository password
 
       cache (str): The path to the cache directory to use for restic. If not set,
         use the XDG cache default (typically ~/.cache/restic)
 
+      env (dict, Optional): The environment to run restic on. If not set, use
+        :py:obj:`os.environ`. Use it to pass per-job B2 credentials.
+
+      ids (list, Optional): If set, only list the snapshots with these
+        identifiers
+
 
     Returns:
 
@@ -316,27 +818,152 @@ def snapshots(repository, global_options, hostname, password, cache):
 
     """
 
-    _assert_b2_setup(repository)
+    return asyncio.run(
+        snapshots_async(
+            repository,
+            global_options,
+            hostname,
+            password,
+            cache,
+            env,
+            ids,
+        )
+    )
+
+
+async def snapshots_async(
+    repository, global_options, hostname, password, cache, env=None, ids=None
+):
+    """Asynchronous version of :py:func:`snapshots`"""
+
+    _assert_b2_setup(repository, env)
 
-    output = run_restic(
+    options = ["--host", hostname] if hostname is not None else []
+
+    output = await run_restic_async(
         ["--repo", repository, "--json"] + global_options,
         "snapshots",
-        ["--host", hostname],
+        options + list(ids or []),
         password,
         cache,
+        env,
     )
 
-    data = json.loads(output)
+    data = _parse_snapshots(output)
+
+    return sorted(data, key=lambda k: k["time"])
+
+
+def _parse_time(s):
+    """Parses a restic (RFC 3339) timestamp into a naive datetime
+
+    This is a lot faster than :py:meth:`datetime.datetime.strptime`, that
+    would, in any case, not handle the nanosecond resolution of restic
+    timestamps.  As before, the timezone offset is ignored: restic reports
+    snapshot times on the local timezone of the machine that saved them.
+    Digits beyond microseconds are truncated.
+    """
+
+    micro = 0
+    if len(s) > 19 and s[19] == ".":
+        end = 20
+        while end < len(s) and s[end].isdigit():
+            end += 1
+        micro = int(s[20:end][:6].ljust(6, "0"))
+
+    return datetime.datetime(
+        int(s[0:4]),
+        int(s[5:7]),
+        int(s[8:10]),
+        int(s[11:13]),
+        int(s[14:16]),
+        int(s[17:19]),
+        micro,
+    )
 
-    # convert date/time representations for easier parsing
+
+def _parse_snapshots(output):
+    """Parses the output of ``restic snapshots --json``
+
+    The ``time`` of each snapshot is converted to a
+    :py:class:`datetime.datetime`.
+    """
+
+    data = json.loads(output)
     for k in data:
-        s = k["time"][:24]
-        k["time"] = datetime.datetime.strptime(s, "%Y-%m-%dT%H:%M:%S.%f")
+        k["time"] = _parse_time(k["time"])
+    return data
 
-    return sorted(data, key=lambda k: k["time"])
 
+def list_snapshot_ids(repository, global_options, password, cache, env=None):
+    """Lists the identifiers of all snapshots available
+
+    This is much cheaper than :py:func:`snapshots`, as restic only lists the
+    files in the ``snapshots`` directory of the repository, without
+    downloading or decrypting them.
+
+
+    Parameters:
+
+      repository (str): The restic repository that will hold the backup. This can
+        be either a local repository path or a BackBlaze B2 bucket name, duly
+        prefixed by ``b2:``.
+
+      global_options (list): A list of global options to pass to restic (like
+        ``--limit-download`` or ``--limit-upload``) - don't include ``--repo`` as
+        this will be included automatically
+
+      password (str): The restic repository password
+
+      cache (str): The path to the cache directory to use for restic. If not set,
+        use the XDG cache default (typically ~/.cache/restic)
+
+      env (dict, Optional): The environment to run restic on. If not set, use
+        :py:obj:`os.environ`. Use it to pass per-job B2 credentials.
+
+
+    Returns:
+
+      list: The (full) identifiers of all snapshots on the repository, of all
+      hosts
 
-def unlock(repository, global_options, password, cache, remove_all):
+    """
+
+    return asyncio.run(
+        list_snapshot_ids_async(
+            repository, global_options, password, cache, env
+        )
+    )
+
+
+async def list_snapshot_ids_async(
+    repository, global_options, password, cache, env=None
+):
+    """Asynchronous version of :py:func:`list_snapshot_ids`"""
+
+    _assert_b2_setup(repository, env)
+
+    output = await run_restic_async(
+        ["--repo", repository] + global_options,
+        "list",
+        ["snapshots"],
+        password,
+        cache,
+        env,
+    )
+
+    return [k.strip() for k in output.split("\n") if k.strip()]
+
+
+def unlock(
+    repository,
+    global_options,
+    password,
+    cache,
+    remove_all,
+    env=None,
+    output=None,
+):
     """Removes stale locks from a remote repository
 
     Parameters:
@@ -357,6 +984,12 @@ def unlock(repository, global_options, password, cache, remove_all):
       remove_all (bool): If we should remove all locks (including non-stale ones).
         This will pass the subcommand option ``--remove-all`` to restic
 
+      env (dict, Optional): The environment to run restic on. If not set, use
+        :py:obj:`os.environ`. Use it to pass per-job B2 credentials.
+
+      output (OutputBuffer, Optional): If set, stream the output of restic into
+        this buffer, which is returned instead of a string
+
 
     Returns:
 
@@ -364,18 +997,51 @@ def unlock(repository, global_options, password, cache, remove_all):
 
     """
 
-    _assert_b2_setup(repository)
+    return asyncio.run(
+        unlock_async(
+            repository,
+            global_options,
+            password,
+            cache,
+            remove_all,
+            env,
+            output,
+        )
+    )
+
+
+async def unlock_async(
+    repository,
+    global_options,
+    password,
+    cache,
+    remove_all,
+    env=None,
+    output=None,
+):
+    """Asynchronous version of :py:func:`unlock`"""
+
+    _assert_b2_setup(repository, env)
     unlock_options = ["--remove-all"] if remove_all else []
-    return run_restic(
+    return await run_restic_async(
         ["--repo", repository] + global_options,
         "unlock",
         unlock_options,
         password,
         cache,
+        env,
+        output,
     )
 
 
-def rebuild_index(repository, global_options, password, cache):
+def rebuild_index(
+    repository,
+    global_options,
+    password,
+    cache,
+    env=None,
+    output=None,
+):
     """Rebuilds the index on an existing repository
 
     Parameters:
@@ -393,6 +1059,12 @@ def rebuild_index(repository, global_options, password, cache):
       cache (str): The path to the cache directory to use for restic. If not set,
         use the XDG cache default (typically ~/.cache/restic)
 
+      env (dict, Optional): The environment to run restic on. If not set, use
+        :py:obj:`os.environ`. Use it to pass per-job B2 credentials.
+
+      output (OutputBuffer, Optional): If set, stream the output of restic into
+        this buffer, which is returned instead of a string
+
 
     Returns:
 
@@ -400,18 +1072,51 @@ def rebuild_index(repository, global_options, password, cache):
 
     """
 
-    _assert_b2_setup(repository)
+    return asyncio.run(
+        rebuild_index_async(
+            repository,
+            global_options,
+            password,
+            cache,
+            env,
+            output,
+        )
+    )
 
-    return run_restic(
+
+async def rebuild_index_async(
+    repository,
+    global_options,
+    password,
+    cache,
+    env=None,
+    output=None,
+):
+    """Asynchronous version of :py:func:`rebuild_index`"""
+
+    _assert_b2_setup(repository, env)
+
+    return await run_restic_async(
         ["--repo", repository] + global_options,
         "rebuild-index",
         [],
         password,
         cache,
+        env,
+        output,
     )
 
 
-def prune(repository, global_options, password, cache):
+def prune(
+    repository,
+    global_options,
+    password,
+    cache,
+    env=None,
+    output=None,
+    max_unused=None,
+    max_repack_size=None,
+):
     """Prunes unreferenced objects on an existing repository
 
     Parameters:
@@ -429,6 +1134,20 @@ def prune(repository, global_options, password, cache):
       cache (str): The path to the cache directory to use for restic. If not set,
         use the XDG cache default (typically ~/.cache/restic)
 
+      env (dict, Optional): The environment to run restic on. If not set, use
+        :py:obj:`os.environ`. Use it to pass per-job B2 credentials.
+
+      output (OutputBuffer, Optional): If set, stream the output of restic into
+        this buffer, which is returned instead of a string
+
+      max_unused (str, Optional): If set, tolerate this much unused space in
+        the repository, avoiding to repack packs that are only partly used
+        (e.g. ``5%`` or ``10G``).  If not set, use restic's default.
+
+      max_repack_size (str, Optional): If set, repack at most this much data
+        (e.g. ``2G``), so that pruning finishes in bounded time.  Remaining
+        unused space is dealt with on the next prune.
+
 
     Returns:
 
@@ -436,8 +1155,46 @@ def prune(repository, global_options, password, cache):
 
     """
 
-    _assert_b2_setup(repository)
+    return asyncio.run(
+        prune_async(
+            repository,
+            global_options,
+            password,
+            cache,
+            env,
+            output,
+            max_unused,
+            max_repack_size,
+        )
+    )
+
 
-    return run_restic(
-        ["--repo", repository] + global_options, "prune", [], password, cache
+async def prune_async(
+    repository,
+    global_options,
+    password,
+    cache,
+    env=None,
+    output=None,
+    max_unused=None,
+    max_repack_size=None,
+):
+    """Asynchronous version of :py:func:`prune`"""
+
+    _assert_b2_setup(repository, env)
+
+    options = []
+    if max_unused is not None:
+        options += ["--max-unused=%s" % max_unused]
+    if max_repack_size is not None:
+        options += ["--max-repack-size=%s" % max_repack_size]
+
+    return await run_restic_async(
+        ["--repo", repository] + global_options,
+        "prune",
+        options,
+        password,
+        cache,
+        env,
+        output,
     )
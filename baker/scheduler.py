@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""In-process scheduling of periodic jobs
+
+Schedules are either lists of daily times (e.g. ``02:00,14:30``) or cron-like
+expressions (e.g. ``30 */6 * * 1-5``), several of which may be combined with
+semi-colons.  A :py:class:`Scheduler` sleeps until the next due time and runs
+its job on a separate thread, applying an explicit policy if the job is still
+running when the next run is due.
+"""
+
+import random
+import datetime
+import threading
+import collections
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+from .reporter import human_time
+
+
+OVERLAP_POLICIES = ("skip", "queue", "coalesce")
+"""What to do with runs that are due while the previous one did not finish
+
+* ``skip``: the due run is skipped
+* ``queue``: the due run starts as soon as the previous one(s) finish
+* ``coalesce``: like ``queue``, but all pending runs are merged into one
+"""
+
+
+_FIELDS = (
+    ("minute", 0, 59),
+    ("hour", 0, 23),
+    ("day of month", 1, 31),
+    ("month", 1, 12),
+    ("day of week", 0, 7),
+)
+
+
+def _parse_field(text, name, low, high):
+    """Parses one field of a cron expression into a set of integers"""
+
+    values = set()
+
+    for item in text.split(","):
+        step = 1
+        if "/" in item:
+            item, step = item.split("/", 1)
+            step = int(step)
+            if step < 1:
+                raise ValueError(
+                    "invalid step on %s field `%s'" % (name, text)
+                )
+
+        if item == "*":
+            start, end = low, high
+        elif "-" in item:
+            start, end = [int(k) for k in item.split("-", 1)]
+        else:
+            start = int(item)
+            end = high if step > 1 else start
+
+        if not (low <= start <= end <= high):
+            raise ValueError(
+                "%s field `%s' is out of range [%d, %d]"
+                % (name, text, low, high)
+            )
+
+        values.update(range(start, end + 1, step))
+
+    return values
+
+
+class Cron(object):
+    """A cron-like expression, in local time
+
+    The expression contains 5 fields separated by white space: minute (0-59),
+    hour (0-23), day of month (1-31), month (1-12) and day of week (0-7, where
+    both 0 and 7 are Sunday).  Each field may be ``*``, a number, a range
+    (``a-b``) or a comma-separated list of those, optionally followed by a step
+    (``/n``).  Like for cron, if both day fields are restricted, then either
+    of them must match.
+
+
+    Parameters:
+
+      expression (str): The cron expression
+
+    """
+
+    def __init__(self, expression):
+
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(
+                "cron expression `%s' must have 5 fields" % expression
+            )
+
+        self.expression = expression
+        (
+            self.minutes,
+            self.hours,
+            self.days,
+            self.months,
+            self.weekdays,
+        ) = [_parse_field(t, *f) for t, f in zip(fields, _FIELDS)]
+
+        if 7 in self.weekdays:
+            self.weekdays = (self.weekdays - {7}) | {0}
+
+        self._any_day = fields[2] == "*"
+        self._any_weekday = fields[4] == "*"
+
+    def __repr__(self):
+        return "Cron(%r)" % self.expression
+
+    def _day_matches(self, dt):
+
+        day = dt.day in self.days
+        weekday = ((dt.weekday() + 1) % 7) in self.weekdays  # 0 is Sunday
+        if self._any_day or self._any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_after(self, dt):
+        """Returns the first matching time strictly after ``dt``"""
+
+        dt = dt.replace(second=0, microsecond=0) + datetime.timedelta(
+            minutes=1
+        )
+        limit = dt + datetime.timedelta(days=5 * 366)
+
+        while dt < limit:
+            if dt.month not in self.months:
+                dt = dt.replace(
+                    year=dt.year + (dt.month // 12),
+                    month=(dt.month % 12) + 1,
+                    day=1,
+                    hour=0,
+                    minute=0,
+                )
+                continue
+            if not self._day_matches(dt):
+                dt = dt.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+                continue
+            if dt.hour not in self.hours:
+                dt = dt.replace(minute=0) + datetime.timedelta(hours=1)
+                continue
+            if dt.minute not in self.minutes:
+                dt += datetime.timedelta(minutes=1)
+                continue
+            return dt
+
+        raise ValueError(
+            "cron expression `%s' never matches" % self.expression
+        )
+
+
+def parse(spec):
+    """Parses a schedule specification into a list of :py:class:`Cron`
+
+    The specification may contain daily times (``HH:MM``) separated by commas,
+    or cron expressions separated by semi-colons.  Both may be mixed, if
+    separated by semi-colons (e.g. ``02:00,14:00;0 * * * 6``).
+    """
+
+    crons = []
+
+    for part in spec.split(";"):
+        part = part.strip()
+        if not part:
+            continue
+        if ":" in part:
+            for moment in part.split(","):
+                hour, minute = [int(k) for k in moment.strip().split(":")]
+                if not (0 <= hour <= 23 and 0 <= minute <= 59):
+                    raise ValueError("invalid daily time `%s'" % moment)
+                crons.append(Cron("%d %d * * *" % (minute, hour)))
+        else:
+            crons.append(Cron(part))
+
+    if not crons:
+        raise ValueError("empty schedule specification `%s'" % spec)
+
+    return crons
+
+
+def next_after(crons, dt):
+    """Returns the first time strictly after ``dt`` matching any ``crons``"""
+
+    return min(k.next_after(dt) for k in crons)
+
+
+class Scheduler(object):
+    """Runs a job periodically, following a schedule
+
+
+    Parameters:
+
+      job (callable): The job to run, without arguments
+
+      spec (str): The schedule specification (see :py:func:`parse`)
+
+      jitter (float, Optional): Maximum random delay, in seconds, added to
+        each scheduled time, so that several hosts do not hit the same
+        (remote) resources at once
+
+      overlap (str, Optional): The policy for runs that are due while the
+        previous one is still running (see :py:data:`OVERLAP_POLICIES`)
+
+      name (str, Optional): A name for the job, for logging purposes
+
+    """
+
+    def __init__(self, job, spec, jitter=0, overlap="skip", name="job"):
+
+        if overlap not in OVERLAP_POLICIES:
+            raise ValueError(
+                "overlap policy must be one of %s, not `%s'"
+                % (", ".join(OVERLAP_POLICIES), overlap)
+            )
+
+        self.job = job
+        self.spec = spec
+        self.crons = parse(spec)
+        self.jitter = jitter
+        self.overlap = overlap
+        self.name = name
+
+        self.next_run = None
+        """When the next run is due (:py:class:`datetime.datetime`)"""
+
+        self.last_run = None
+        """When the last run started (:py:class:`datetime.datetime`)"""
+
+        self.last_duration = None
+        """How long the last (finished) run took, in seconds"""
+
+        self.last_lag = None
+        """How late, in seconds, the last run started after it was due"""
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._worker = None
+        self._pending = collections.deque()  # when pending runs were due
+
+    def _due(self, base):
+        """Returns the next scheduled time after ``base``, and with jitter"""
+
+        scheduled = next_after(self.crons, base)
+        delay = random.uniform(0, self.jitter) if self.jitter else 0
+        return scheduled, scheduled + datetime.timedelta(seconds=delay)
+
+    def _work(self, due):
+        """Runs the job, and any pending runs, on the worker thread"""
+
+        while True:
+            start = datetime.datetime.now()
+            self.last_run = start
+            self.last_lag = max(0.0, (start - due).total_seconds())
+            logger.info("Starting %s run", self.name)
+            try:
+                self.job()
+            except Exception:
+                logger.exception("Error running %s", self.name)
+            elapsed = datetime.datetime.now() - start
+            self.last_duration = elapsed.total_seconds()
+            logger.info(
+                "Finished %s run in %s",
+                self.name,
+                human_time(self.last_duration),
+            )
+
+            with self._lock:
+                if not self._pending:
+                    self._worker = None
+                    return
+                due = self._pending.popleft()
+
+    def _fire(self, due=None):
+        """Starts a run, due at ``due``, or applies the overlap policy"""
+
+        if due is None:
+            due = datetime.datetime.now()
+
+        with self._lock:
+
+            if self._worker is None:
+                self._worker = threading.Thread(
+                    target=self._work, args=(due,), name=self.name, daemon=True
+                )
+                self._worker.start()
+                return
+
+            if self.overlap == "skip":
+                logger.warning(
+                    "Skipping %s run: the previous one (started at %s) is "
+                    "still running",
+                    self.name,
+                    self.last_run,
+                )
+            elif self.overlap == "queue":
+                self._pending.append(due)
+                logger.warning(
+                    "Queueing %s run (%d pending): the previous one is still "
+                    "running",
+                    self.name,
+                    len(self._pending),
+                )
+            else:  # coalesce, keeping the time the oldest pending run was due
+                if not self._pending:
+                    self._pending.append(due)
+                logger.warning(
+                    "Coalescing %s run with pending ones: the previous one is "
+                    "still running",
+                    self.name,
+                )
+
+    def _sleep_until(self, moment):
+        """Sleeps until a moment, returning ``True`` if stopped before that
+
+        Sleeps are done in chunks of at most an hour, to follow changes of the
+        wall clock (e.g. after a suspension).
+        """
+
+        while True:
+            remaining = (moment - datetime.datetime.now()).total_seconds()
+            if remaining <= 0:
+                return self._stop.is_set()
+            if self._stop.wait(min(remaining, 3600)):
+                return True
+
+    def run(self):
+        """Runs the job following the schedule, until :py:meth:`stop`"""
+
+        base = datetime.datetime.now()
+
+        while not self._stop.is_set():
+            # after a suspension, scheduled times that were missed are skipped
+            now = datetime.datetime.now()
+            base = max(base, now - datetime.timedelta(seconds=self.jitter))
+            base, self.next_run = self._due(base)
+            logger.info(
+                "Next %s run at %s", self.name, self.next_run.isoformat(" ")
+            )
+            if self._sleep_until(self.next_run):
+                break
+            self._fire(self.next_run)
+
+    def stop(self):
+        """Stops scheduling new runs (a running one is not interrupted)"""
+
+        self._stop.set()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Instrumentation of runs: time and resources spent on each step
+
+Steps are delimited with :py:func:`span`, and spans opened while another one
+is active become its children, so a run is described by a tree of spans.
+The active span is kept on a context variable, so it follows coroutines and
+(explicitly copied) contexts of worker threads.
+
+Commands run through :py:func:`baker.utils.run_cmdline_async` report their
+resource usage (as returned by :py:func:`os.wait4`) with :py:func:`record`.
+It is accounted to the active span and to all of its ancestors.
+"""
+
+import os
+import time
+import datetime
+import threading
+import contextlib
+import contextvars
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+_current = contextvars.ContextVar("baker_span", default=None)
+"""The innermost active span"""
+
+
+_lock = threading.Lock()
+"""Serializes resource accounting, as spans are shared by threads"""
+
+
+class Span(object):
+    """A (timed) step of a run
+
+    Resource usage only covers commands that ran (and finished) while the
+    span, or one of its children, was active.
+
+
+    Attributes:
+
+      name (str): The kind of step (e.g. ``backup``)
+
+      attributes (dict): Further information about the step (e.g. the
+        repository it refers to)
+
+      start (datetime.datetime): When the step started
+
+      wall (float): How long the step took, in seconds, once it finished
+
+      cpu (float): User and system CPU time used by commands, in seconds
+
+      maxrss (int): The largest resident set size of a command, in bytes
+
+      read_bytes (int): Bytes read from block devices by commands
+
+      written_bytes (int): Bytes written to block devices by commands
+
+      commands (int): The number of commands run
+
+      error (str): A description of the exception that ended the step, if any
+
+      children (list): Spans for the sub-steps of this one
+
+    """
+
+    def __init__(self, name, parent=None, **attributes):
+        self.name = name
+        self.attributes = attributes
+        self.parent = parent
+        self.children = []
+        self.start = datetime.datetime.now()
+        self.wall = None
+        self.cpu = 0.0
+        self.maxrss = 0
+        self.read_bytes = 0
+        self.written_bytes = 0
+        self.commands = 0
+        self.error = None
+        self._started = time.perf_counter()
+
+    def finish(self, error=None):
+        """Marks the step as finished, optionally with an error"""
+
+        self.wall = time.perf_counter() - self._started
+        if error is not None:
+            self.error = "%s: %s" % (type(error).__name__, error)
+
+    def add_usage(self, cpu, maxrss, read_bytes, written_bytes):
+        """Accounts a command to this span and all of its ancestors"""
+
+        with _lock:
+            current = self
+            while current is not None:
+                current.cpu += cpu
+                current.maxrss = max(current.maxrss, maxrss)
+                current.read_bytes += read_bytes
+                current.written_bytes += written_bytes
+                current.commands += 1
+                current = current.parent
+
+    @property
+    def label(self):
+        """A human-readable description of the step"""
+
+        if not self.attributes:
+            return self.name
+        return "%s (%s)" % (
+            self.name,
+            ", ".join("%s: %s" % k for k in self.attributes.items()),
+        )
+
+    def walk(self, depth=0):
+        """Yields ``(depth, span)`` for this span and all of its descendants"""
+
+        yield depth, self
+        for child in list(self.children):
+            yield from child.walk(depth + 1)
+
+    def as_dict(self):
+        """Returns a JSON-serializable representation of the span tree"""
+
+        return dict(
+            name=self.name,
+            attributes=dict((k, str(v)) for k, v in self.attributes.items()),
+            start=self.start.isoformat(),
+            wall=self.wall,
+            cpu=self.cpu,
+            maxrss=self.maxrss,
+            read_bytes=self.read_bytes,
+            written_bytes=self.written_bytes,
+            commands=self.commands,
+            error=self.error,
+            children=[k.as_dict() for k in list(self.children)],
+        )
+
+
+def current():
+    """Returns the innermost active span, or ``None``"""
+
+    return _current.get()
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """Delimits a step of a run, yielding its :py:class:`Span`
+
+    The new span is a child of the active one, if any.  Errors are recorded
+    on the span, and then re-raised.
+    """
+
+    parent = _current.get()
+    retval = Span(name, parent, **attributes)
+    if parent is not None:
+        with _lock:
+            parent.children.append(retval)
+    token = _current.set(retval)
+    try:
+        yield retval
+    except BaseException as e:
+        retval.finish(e)
+        raise
+    else:
+        retval.finish()
+    finally:
+        _current.reset(token)
+
+
+def record(rusage):
+    """Accounts the resources used by a command to the active span
+
+    Parameters:
+
+      rusage (resource.struct_rusage): Resource usage of the (reaped)
+        command, as returned by :py:func:`os.wait4`
+
+    """
+
+    active = _current.get()
+    if active is None:
+        return
+    active.add_usage(
+        cpu=rusage.ru_utime + rusage.ru_stime,
+        maxrss=rusage.ru_maxrss * 1024,  # kilobytes on Linux
+        read_bytes=rusage.ru_inblock * 512,
+        written_bytes=rusage.ru_oublock * 512,
+    )
+
+
+def write_report(root, cache, keep=30):
+    """Writes a JSON report of a run, returns its path
+
+    Reports are kept in a ``reports`` sub-directory of
+    :py:func:`baker.utils.baker_cache`, named after the root span and the
+    time the run started.  Only the last ``keep`` reports of each kind are
+    kept.
+
+
+    Parameters:
+
+      root (Span): The (finished) span of the whole run
+
+      cache (str): The path to the cache directory used for restic, or
+        ``None``, if restic uses its defaults
+
+      keep (int, Optional): The number of reports to keep
+
+
+    Returns:
+
+      str: The path to the report
+
+    """
+
+    from .utils import baker_cache, write_state
+
+    directory = os.path.join(baker_cache(cache), "reports")
+    os.makedirs(directory, exist_ok=True)
+    prefix = "%s-" % root.name
+    path = os.path.join(
+        directory,
+        prefix + root.start.strftime("%Y%m%d-%H%M%S") + ".json",
+    )
+    write_state(path, root.as_dict())
+    logger.info("Wrote run report to `%s'", path)
+
+    reports = sorted(
+        k
+        for k in os.listdir(directory)
+        if k.startswith(prefix) and k.endswith(".json")
+    )
+    for k in reports[:-keep]:
+        os.unlink(os.path.join(directory, k))
+
+    return path
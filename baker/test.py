@@ -5,14 +5,24 @@
 
 
 import os
+import sys
+import json
+import time
+import asyncio
+import datetime
 import pkg_resources
+import shutil
 import tempfile
 
+import pytest
+
 import logging
 
 logger = logging.getLogger(__name__)
 
 from . import restic
+from . import utils
+from . import index
 
 
 SAMPLE_DIR = pkg_resources.resource_filename(
@@ -140,3 +150,1103 @@ def test_restic_prune():
     assert len(messages) == 22
     assert messages[0] == "counting files in repo"
     assert messages[-1] == "done"
+
+
+def test_output_buffer_bounds():
+
+    buf = utils.OutputBuffer(head=2, tail=3)
+    for k in range(10):
+        buf.write("line %d\n" % k)
+    buf.write("partial")
+
+    assert buf.lines == 10
+    assert buf.omitted == 5
+    messages = str(buf).split("\n")
+    assert messages[:2] == ["line 0", "line 1"]
+    assert messages[2] == "[... 5 lines omitted ...]"
+    assert messages[3:] == ["line 7", "line 8", "line 9", "partial"]
+
+
+def test_output_buffer_spill():
+
+    buf = utils.OutputBuffer(head=1, tail=1, spill=True)
+    buf.write("a\nb\nc\n")
+    buf += "d\n"
+    assert str(buf) == "a\nb\nc\nd\n"
+    buf.close()
+
+
+def test_run_cmdline_multibyte():
+
+    # 8191 bytes before the first 2-byte character: as chunks have 8 KiB (an
+    # even size), a character is split at every (full) chunk boundary
+    script = "import sys; sys.stdout.write('x' * 8191 + '\\u00e9' * 10000)"
+    out = utils.run_cmdline([sys.executable, "-c", script])
+    assert out == "x" * 8191 + "\u00e9" * 10000
+
+    buf = utils.OutputBuffer(head=None)
+    assert utils.run_cmdline([sys.executable, "-c", script], output=buf) is buf
+    assert str(buf) == out
+
+
+def test_backup_progress():
+
+    progress = restic._BackupProgress("/data", interval=0)
+
+    status = (
+        '{"message_type":"status","percent_done":0.5,"total_files":4,'
+        '"files_done":2,"total_bytes":2000000,"bytes_done":1000000,'
+        '"seconds_elapsed":2}'
+    )
+    summary = (
+        '{"message_type":"summary","files_new":1,"files_changed":2,'
+        '"files_unmodified":3,"dirs_new":0,"dirs_changed":1,'
+        '"dirs_unmodified":1,"data_blobs":3,"tree_blobs":2,'
+        '"data_added":1234,"total_files_processed":6,'
+        '"total_bytes_processed":2000000,"total_duration":2.5,'
+        '"snapshot_id":"0123456789abcdef"}'
+    )
+
+    assert progress(status) is None  # consumed
+    assert progress("some warning") == "some warning"  # captured as is
+    assert progress(summary) is None
+    assert progress.summary.snapshot_id == "0123456789abcdef"
+    assert progress.summary.files_changed == 2
+    assert progress.summary.data_added == 1234
+
+    text = restic._format_summary(progress.summary).split("\n")[:-1]
+    assert text[1].startswith("Files:")
+    assert text[-1] == "snapshot 01234567 saved"
+
+
+def test_backup_summary_without_snapshot():
+
+    from .commands import _template_environment
+
+    progress = restic._BackupProgress("/data", interval=0)
+    assert progress('{"message_type":"summary","files_new":1}') is None
+    assert progress.summary.snapshot_id is None
+    assert progress.summary.files_new == 1
+    assert progress.summary.total_duration == 0
+
+    text = restic._format_summary(progress.summary).split("\n")[:-1]
+    assert text[-1] == "snapshot unknown saved"
+
+    env = _template_environment()
+    for name in ("update/body_success.txt", "update/body_success.html"):
+        text = env.get_template(name).render(
+            configs={"/data": "/repo"},
+            summaries={"/repo": progress.summary},
+            unchanged={"/other": None},
+        )
+        assert text.count("unknown") == 2
+
+
+def test_gather_cancels_on_error():
+
+    sleeper = [sys.executable, "-c", "import time; time.sleep(30)"]
+    failure = [sys.executable, "-c", "import sys; sys.exit(3)"]
+
+    start = time.time()
+    with pytest.raises(RuntimeError):
+        asyncio.run(
+            utils.gather(
+                [
+                    utils.run_cmdline_async(sleeper),
+                    utils.run_cmdline_async(failure),
+                    utils.run_cmdline_async(sleeper),  # never started
+                ],
+                jobs=2,
+            )
+        )
+    assert time.time() - start < 10  # the sleeper was killed
+
+
+def test_cancel_command_after_child_exited():
+
+    # the shell exits at once, but its background child keeps the output open
+    cmd = ["sh", "-c", "(sleep 3; echo x) & exit 0"]
+
+    async def _cancel():
+        task = asyncio.ensure_future(utils.run_cmdline_async(cmd))
+        await asyncio.sleep(1)
+        task.cancel()
+        await task
+
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(_cancel())
+
+
+def test_run_cmdline_exit_codes():
+
+    failure = ["sh", "-c", "exit 3"]
+    killed = ["sh", "-c", "kill -9 $$"]
+
+    with pytest.raises(RuntimeError, match=r"error state \(3\)"):
+        utils.run_cmdline(failure)
+    with pytest.raises(RuntimeError, match=r"error state \(-9\)"):
+        utils.run_cmdline(killed)
+
+
+def test_spans_record_command_usage():
+
+    from . import spans
+    from .commands import _template_environment
+
+    busy = [sys.executable, "-c", "sum(range(10**6))"]
+    failure = [sys.executable, "-c", "import sys; sys.exit(3)"]
+
+    with spans.span("update", hostname="host") as run:
+        with spans.span("backup", repository="/repo") as backup:
+            utils.run_cmdline(busy)
+            utils.run_cmdline(busy)
+        with pytest.raises(RuntimeError):
+            with spans.span("check"):
+                utils.run_cmdline(failure)
+        assert spans.current() is run
+    assert spans.current() is None
+
+    assert backup.commands == 2
+    assert backup.cpu > 0
+    assert backup.maxrss > 1 << 20  # the interpreter itself
+    assert 0 < backup.wall <= run.wall
+    assert run.commands == 3
+    assert run.cpu >= backup.cpu
+    assert run.error is None
+    assert run.children[1].error.startswith("RuntimeError:")
+    assert [(d, k.label) for d, k in run.walk()] == [
+        (0, "update (hostname: host)"),
+        (1, "backup (repository: /repo)"),
+        (1, "check"),
+    ]
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = spans.write_report(run, tmpdir, keep=1)
+        with open(path) as f:
+            report = json.load(f)
+        assert report["commands"] == 3
+        assert report["children"][0]["attributes"] == {"repository": "/repo"}
+        assert os.listdir(os.path.dirname(path)) == [os.path.basename(path)]
+    finally:
+        shutil.rmtree(tmpdir)
+
+    text = _template_environment().get_template("update/body_success.txt")
+    text = text.render(configs={}, summaries={}, report=run)
+    assert "## backup (repository: /repo): " in text
+    assert "2 commands (cpu: " in text
+
+
+def test_template_environment_cache(monkeypatch):
+
+    from . import commands, spans
+
+    with spans.span("update") as run:
+        with spans.span("backup", repository="/repo"):
+            pass
+    snapshot = dict(
+        time=datetime.datetime.now() - datetime.timedelta(days=30, hours=12),
+        paths=["/data"],
+        short_id="0123abcd",
+    )
+    context = dict(
+        configs={"/data": "/repo"},
+        summaries={"/repo": restic.BackupSummary("0123abcd", *([1] * 10))},
+        unchanged={},
+        sizes={"/repo": 1 << 20},
+        snapshots=[snapshot],
+        log="a line of log\n",
+        hostname="host",
+        report=run,
+    )
+
+    templates = [
+        "%s/%s" % (command, name)
+        for command in ("update", "check")
+        for name in (
+            "subject_success.txt",
+            "body_success.txt",
+            "body_success.html",
+        )
+    ]
+
+    def _render():
+        env = commands._template_environment()
+        assert commands._template_environment() is env  # built only once
+        return [env.get_template(k).render(**context) for k in templates]
+
+    monkeypatch.delenv("BAKER_TEMPLATE_CACHE", raising=False)
+    monkeypatch.setattr(commands, "_templates", None)
+    expected = _render()
+    assert "0123abcd" in expected[1]
+    assert _render() == expected
+
+    with tempfile.TemporaryDirectory() as d:
+        directory = os.path.join(d, "templates")
+        monkeypatch.setenv("BAKER_TEMPLATE_CACHE", directory)
+        monkeypatch.setattr(commands, "_templates", None)
+        assert _render() == expected  # compiles and fills the cache
+        assert os.listdir(directory)
+
+        monkeypatch.setattr(commands, "_templates", None)
+        assert _render() == expected  # loads from the cache
+
+
+def test_metrics_exposition():
+
+    import urllib.request
+
+    from . import b2, spans, metrics
+
+    with spans.span("update") as run:
+        with spans.span("repository", directory="/data", repository="b2:x"):
+            with spans.span("backup"):
+                pass
+            with spans.span("check", recovery="1st"):
+                pass
+            with spans.span("check", recovery="2nd"):
+                pass
+    summary = restic.BackupSummary("abcdef", *([0] * 10))._replace(
+        data_added=1234
+    )
+
+    m = metrics.Metrics()
+    m.update_finished(run, {"b2:x": False}, {"b2:x": summary})
+
+    with spans.span("check") as run:
+        with spans.span("snapshots", repository="b2:x"):
+            pass
+    snapshots = [{"time": datetime.datetime(2021, 6, 1)}] * 2
+    m.check_finished(run, {"b2:x": True}, {"b2:x": snapshots}, {})
+
+    b2._count("list_buckets")
+
+    text = m.render()
+    assert "# TYPE baker_b2_calls_total counter\n" in text
+    assert 'baker_b2_calls_total{operation="list-buckets"} ' in text
+    assert 'baker_backup_added_bytes{repository="b2:x"} 1234.0\n' in text
+    assert 'baker_recovery_attempts{repository="b2:x"} 2.0\n' in text
+    assert 'baker_snapshots{repository="b2:x"} 2.0\n' in text
+    assert (
+        'baker_last_run_failed{command="check",repository="b2:x"} 1.0\n'
+        in text
+    )
+    assert (
+        'baker_step_duration_seconds{command="update",repository="b2:x",'
+        'step="check"} ' in text
+    )
+    assert 'command="check",repository="b2:x",step="snapshots"' in text
+    assert text.count("baker_last_success_timestamp_seconds{") == 1
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        m.path = os.path.join(tmpdir, "baker.prom")
+        m.write()
+        assert os.listdir(tmpdir) == ["baker.prom"]
+
+        port = m.serve(0, "127.0.0.1")
+        url = "http://127.0.0.1:%d/metrics" % port
+        with urllib.request.urlopen(url, timeout=10) as response:
+            assert response.headers["Content-Type"] == metrics.CONTENT_TYPE
+            assert "baker_snapshots{" in response.read().decode("utf-8")
+    finally:
+        m.close()
+        shutil.rmtree(tmpdir)
+
+
+def test_metrics_of_failed_update(monkeypatch):
+
+    from . import commands, metrics
+
+    def _update(dire, repo, *args, **kwargs):
+        if repo == "/r2":
+            raise RuntimeError("unexpected")
+        return False, utils.OutputBuffer(), None, None
+
+    monkeypatch.setattr(commands, "_update_repository", _update)
+
+    m = metrics.Metrics()
+    configs = {"/a": "/r1", "/b": "/r2", "/c": "/r3"}
+    with tempfile.TemporaryDirectory() as d:
+        with pytest.raises(RuntimeError):
+            commands.update(
+                configs,
+                password="password",
+                cache=d,
+                hostname="host",
+                email={},
+                b2_cred=None,
+                keep={},
+                period=None,
+                max_recoveries=0,
+                force_recovery=False,
+                metrics=m,
+            )
+        assert os.listdir(os.path.join(d, "baker", "reports"))
+
+    text = m.render()
+    # the other repositories were still updated
+    for repo, failed in (("/r1", 0), ("/r2", 1), ("/r3", 0)):
+        assert (
+            'baker_last_run_failed{command="update",repository="%s"} %d.0\n'
+            % (repo, failed)
+            in text
+        )
+    assert text.count("baker_last_success_timestamp_seconds{") == 2
+
+
+def test_benchmark_synthetic_tree():
+
+    import random
+
+    from . import benchmark
+
+    assert benchmark.parse_sizes("4K")(random.Random(0)) == 4096
+    draw = benchmark.parse_sizes("1K-8K")
+    rng = random.Random(0)
+    assert all(1024 <= draw(rng) <= 8192 for k in range(100))
+    with pytest.raises(ValueError):
+        benchmark.parse_sizes("8K-1K")
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        paths = benchmark.generate_tree(tmpdir, 250, draw, rng)
+        assert len(os.listdir(tmpdir)) == 3
+        before = utils.tree_signature(tmpdir)
+        assert before.files == 250
+
+        changed = benchmark.churn(paths, 0.1, draw, rng)
+        assert len(changed) == 250  # as many files removed as added
+        assert len(set(changed) - set(paths)) == 6
+        assert all(os.path.exists(k) for k in changed)
+        assert utils.tree_signature(tmpdir).digest != before.digest
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_snapshot_index():
+
+    t = datetime.datetime(2021, 3, 4, 5, 6, 7, 891011)
+    snapshots = [
+        dict(id="a" * 64, hostname="h1", time=t, paths=["/data"]),
+        dict(
+            id="b" * 64,
+            hostname="h2",
+            time=t + datetime.timedelta(hours=1),
+            paths=["/data", "/other"],
+        ),
+        dict(
+            id="c" * 64,
+            hostname="h1",
+            time=t + datetime.timedelta(days=1),
+            paths=["/data"],
+        ),
+    ]
+
+    with index.SnapshotIndex(":memory:") as idx:
+        idx.add("repo1", snapshots)
+        idx.add("repo2", snapshots[:1])
+
+        assert idx.ids("repo1") == set(k["id"] for k in snapshots)
+        assert [k["id"] for k in idx.snapshots("repo2")] == ["a" * 64]
+
+        listed = idx.snapshots("repo1", "h1")
+        assert [k["short_id"] for k in listed] == ["aaaaaaaa", "cccccccc"]
+        assert listed[0]["time"] == t  # microsecond precision is preserved
+        assert listed[0]["paths"] == ["/data"]
+
+        assert idx.latest("repo1")["id"] == "c" * 64
+        assert idx.latest("repo1", "h2")["paths"] == ["/data", "/other"]
+        assert idx.latest("repo1", "h3") is None
+
+        idx.remove("repo1", ["c" * 64])
+        assert idx.latest("repo1")["id"] == "b" * 64
+        assert len(idx.snapshots("repo2")) == 1
+
+
+def test_snapshot_index_refresh(monkeypatch):
+
+    t = datetime.datetime(2021, 3, 4, 5, 6, 7)
+    hour = datetime.timedelta(hours=1)
+    remote = dict(
+        (k, dict(id=k * 64, hostname="h", time=t + i * hour, paths=["/d"]))
+        for i, k in enumerate("abc")
+    )
+    calls = []
+
+    async def _ids(**kwargs):
+        calls.append("ids")
+        return [k["id"] for k in remote.values()]
+
+    async def _snapshots(**kwargs):
+        calls.append("snapshots")
+        return [remote[k[0]] for k in kwargs["ids"]]
+
+    monkeypatch.setattr(index.restic, "list_snapshot_ids_async", _ids)
+    monkeypatch.setattr(index.restic, "snapshots_async", _snapshots)
+
+    with index.SnapshotIndex(":memory:") as idx:
+        assert idx.refresh("repo", "password", None) == 3
+        assert calls == ["ids", "snapshots"]
+
+        # nothing new: a single (cheap) listing of identifiers
+        del calls[:]
+        assert idx.refresh("repo", "password", None) == 0
+        assert calls == ["ids"]
+
+        # forgotten, without a new back-up
+        del remote["a"]
+        del calls[:]
+        assert idx.refresh("repo", "password", None) == 0
+        assert calls == ["ids"]
+        assert [k["id"][0] for k in idx.snapshots("repo")] == ["b", "c"]
+
+
+def test_parse_snapshots():
+
+    output = (
+        '[{"time":"2021-03-04T05:06:07.891011123+01:00","id":"a"},\n'
+        ' {"time":"2021-03-04T05:06:08Z","id":"b"},'
+        '{"time":"2021-03-04T05:06:09.5-05:00","id":"c"}]\n'
+    )
+    snapshots = restic._parse_snapshots(output)
+    assert [k["id"] for k in snapshots] == ["a", "b", "c"]
+    assert snapshots[0]["time"] == datetime.datetime(
+        2021, 3, 4, 5, 6, 7, 891011
+    )
+    assert snapshots[1]["time"] == datetime.datetime(2021, 3, 4, 5, 6, 8)
+    assert snapshots[2]["time"].microsecond == 500000
+    assert restic._parse_snapshots("[]") == []
+
+
+def test_get_size():
+
+    with tempfile.TemporaryDirectory() as d:
+
+        os.makedirs(os.path.join(d, "tree", "a", "b"))
+        os.makedirs(os.path.join(d, "tree", "c"))
+        for name, size in (("x", 10), ("a/y", 20), ("a/b/z", 30), ("c/w", 5)):
+            with open(os.path.join(d, "tree", name), "wb") as f:
+                f.write(b"0" * size)
+
+        tree = os.path.join(d, "tree")
+        state = os.path.join(d, "state.json")
+        assert utils.get_size(tree) == 65
+        assert utils.get_size(tree, state=state) == 65
+        assert utils.read_state(state) == {}  # too recent to be cached
+
+        past = time.time() - 60
+        for path in ("", "a", "a/b", "c"):
+            os.utime(os.path.join(tree, path), (past, past))
+        assert utils.get_size(tree, state=state) == 65
+        assert len(utils.read_state(state)) == 4  # all directories
+
+        # new files in a sub-directory are picked-up
+        with open(os.path.join(tree, "a", "b", "v"), "wb") as f:
+            f.write(b"0" * 100)
+        assert utils.get_size(tree, state=state) == 165
+
+        shutil.rmtree(os.path.join(tree, "c"))
+        assert utils.get_size(tree, state=state) == 160
+        assert os.path.join(tree, "c") not in utils.read_state(state)
+
+        assert utils.get_size(os.path.join(d, "missing")) == 0
+
+
+def test_tree_signature():
+
+    with tempfile.TemporaryDirectory() as d:
+
+        os.makedirs(os.path.join(d, "a", "b"))
+        with open(os.path.join(d, "a", "x"), "wb") as f:
+            f.write(b"0" * 10)
+
+        first = utils.tree_signature(d)
+        assert (first.directories, first.files, first.size) == (3, 1, 10)
+        assert utils.tree_signature(d) == first
+
+        # a new empty file, deep in the tree
+        open(os.path.join(d, "a", "b", "y"), "wb").close()
+        second = utils.tree_signature(d)
+        assert second.digest != first.digest
+        assert second.files == 2
+
+        # in-place modification, keeping the size
+        with open(os.path.join(d, "a", "x"), "wb") as f:
+            f.write(b"1" * 10)
+        os.utime(os.path.join(d, "a", "x"), ns=(0, 0))
+        assert utils.tree_signature(d).digest != second.digest
+
+
+def test_rolling_verification():
+
+    from . import commands
+
+    with tempfile.TemporaryDirectory() as cache:
+        seen = []
+        for k in range(4):
+            subset = commands._next_subset(cache, "b2:repo", 3)
+            commands._subset_verified(cache, "b2:repo", subset)
+            seen.append(subset)
+        assert seen == [(1, 3), (2, 3), (3, 3), (1, 3)]
+
+        # changing the number of slices restarts from the first one
+        assert commands._next_subset(cache, "b2:repo", 5) == (1, 5)
+        assert commands._next_subset(cache, "b2:other", 3) == (1, 3)
+
+
+def test_skip_unchanged_still_verifies(monkeypatch):
+
+    from . import commands
+
+    subsets = []
+
+    def _check(repository, subset=None, **kwargs):
+        subsets.append(subset)
+        if len(subsets) == 4:
+            raise RuntimeError("corrupted pack")
+
+    monkeypatch.setattr(commands.restic, "check", _check)
+
+    with tempfile.TemporaryDirectory() as cache:
+        dire = os.path.join(os.path.dirname(__file__), "data", "dir1")
+        utils.write_state(
+            commands._manifest_path(cache, dire, "/repo", "host"),
+            dict(utils.tree_signature(dire)._asdict(), snapshot="0123abcd"),
+        )
+
+        def _update():
+            return commands._update_if_changed(
+                dire,
+                "/repo",
+                "password",
+                cache,
+                "host",
+                {"condition": "never"},
+                {"last": 1},
+                2,
+                skip_unchanged=True,
+                verify=3,
+            )
+
+        for k in range(3):
+            error, log, summary, unchanged = _update()
+            assert (error, summary, unchanged) == (False, None, "0123abcd")
+        assert subsets == [(1, 3), (2, 3), (3, 3)]
+
+        # failures are reported, and the same subset is verified next time
+        path = commands._manifest_path(cache, dire, "/repo", "host")
+        confirmed = utils.read_state(path)["confirmed"]
+        assert _update()[0] is True
+        assert utils.read_state(path)["confirmed"] == confirmed
+        assert _update()[0] is False
+        assert utils.read_state(path)["confirmed"] > confirmed
+        assert subsets[3:] == [(1, 3), (1, 3)]
+
+
+def test_alarm_counts_skipped_backups():
+
+    from . import commands
+
+    now = datetime.datetime.now()
+    snapshot = dict(
+        id="a" * 64,
+        hostname="host",
+        time=now - datetime.timedelta(days=10),
+        paths=["/data"],
+    )
+
+    with tempfile.TemporaryDirectory() as cache, index.SnapshotIndex(
+        ":memory:"
+    ) as idx:
+
+        def _last():
+            return commands._last_backup(idx, cache, "/data", "/repo", "host")
+
+        assert _last() is None
+        idx.add("/repo", [snapshot])
+        assert _last() == snapshot["time"]
+
+        path = commands._manifest_path(cache, "/data", "/repo", "host")
+        utils.write_state(path, dict(snapshot="a" * 64, confirmed=time.time()))
+        assert (now - _last()).total_seconds() < 60
+
+        # the skipped back-up refers to a snapshot that is gone
+        utils.write_state(path, dict(snapshot="b" * 64, confirmed=time.time()))
+        assert _last() == snapshot["time"]
+
+
+def test_prune_policy():
+
+    from . import commands
+
+    summary = restic.BackupSummary(*(["0" * 64] + [0] * 6 + [100, 0, 0, 0.0]))
+    policy = dict(every=7, after=250)
+
+    with tempfile.TemporaryDirectory() as cache:
+        assert commands._prune_due(cache, "repo", summary, policy)  # unknown
+        commands._pruned(cache, "repo")
+        assert not commands._prune_due(cache, "repo", summary, policy)  # 100
+        assert not commands._prune_due(cache, "repo", summary, policy)  # 200
+        assert commands._prune_due(cache, "repo", summary, policy)  # 300
+        # the prune failed: still due, and the data added is not lost
+        assert commands._prune_due(cache, "repo", summary, policy)  # 400
+        state = utils.read_state(utils.state_path(cache, "pruning", "repo"))
+        assert state["added"] == 400
+        commands._pruned(cache, "repo")
+        assert not commands._prune_due(cache, "repo", None, policy)
+
+        # every run, if no condition is set
+        assert commands._prune_due(cache, "repo", None, {})
+
+        state = utils.state_path(cache, "pruning", "repo")
+        utils.write_state(state, dict(time=time.time() - 8 * 86400, added=0))
+        assert commands._prune_due(cache, "repo", None, policy)
+
+    assert utils.parse_size("2G") == 2 * 1024**3
+    assert utils.parse_size("1.5k") == 1536
+    assert utils.parse_size(42) == 42
+
+
+def test_bucket_size_accounting(monkeypatch):
+
+    from . import b2
+    from . import commands
+
+    queries = []
+
+    def _get_bucket(name):
+        queries.append(name)
+        return dict(totalSize=1000)
+
+    monkeypatch.setattr(b2, "get_bucket", _get_bucket)
+    summary = restic.BackupSummary(*(["0" * 64] + [0] * 6 + [100, 0, 0, 0.0]))
+
+    with tempfile.TemporaryDirectory() as cache:
+        commands._account_size(cache, "b2:bucket", summary)  # unknown yet
+        assert commands._bucket_size("b2:bucket", cache, 7) == 1000
+        commands._account_size(cache, "b2:bucket", summary)
+        commands._account_size(cache, "b2:bucket", summary)
+        assert commands._bucket_size("b2:bucket", cache, 7) == 1200
+        assert len(queries) == 1
+
+        # always computed without a period
+        assert commands._bucket_size("b2:bucket", cache, 0) == 1000
+        assert len(queries) == 2
+
+        state = utils.state_path(cache, "bucket-sizes", "b2:bucket")
+        utils.write_state(state, dict(size=0, time=time.time() - 8 * 86400))
+        assert commands._bucket_size("b2:bucket", cache, 7) == 1000
+        assert len(queries) == 3
+
+
+def test_tool_version_is_cached(monkeypatch):
+
+    with tempfile.TemporaryDirectory() as d:
+        tool = os.path.join(d, "tool")
+        with open(tool, "wt") as f:
+            f.write("#!/bin/sh\necho tool 1.0\n")
+        os.chmod(tool, 0o755)
+        monkeypatch.setitem(utils._which, "tool", tool)
+
+        calls = []
+        run_cmdline = utils.run_cmdline
+        monkeypatch.setattr(
+            utils, "run_cmdline", lambda c: calls.append(c) or run_cmdline(c)
+        )
+
+        assert utils.tool_version("tool", cache=d).strip() == "tool 1.0"
+        assert utils.tool_version("tool", cache=d).strip() == "tool 1.0"
+        assert len(calls) == 1
+
+        # updating the executable invalidates the cached output
+        with open(tool, "at") as f:
+            f.write("echo updated\n")
+        assert "updated" in utils.tool_version("tool", cache=d)
+        assert len(calls) == 2
+
+
+def test_which_is_cached_on_disk(monkeypatch):
+
+    with tempfile.TemporaryDirectory() as d:
+        tool = os.path.join(d, "tool")
+        with open(tool, "wt") as f:
+            f.write("#!/bin/sh\necho tool 1.0\n")
+        os.chmod(tool, 0o755)
+        monkeypatch.setenv("PATH", d)
+
+        searches = []
+        search = shutil.which
+        monkeypatch.setattr(
+            shutil, "which", lambda n: searches.append(n) or search(n)
+        )
+
+        def _which():
+            monkeypatch.setattr(utils, "_which", {})  # a new process
+            return utils.which("tool", cache=d)
+
+        assert _which() == tool
+        assert utils.which("tool", cache=d) == tool  # in memory
+        assert _which() == tool  # on disk
+        assert len(searches) == 1
+
+        # updating the executable, or the search path, invalidates the path
+        os.utime(tool, ns=(0, 0))
+        assert _which() == tool
+        assert len(searches) == 2
+        monkeypatch.setenv("PATH", os.pathsep.join([d, d]))
+        assert _which() == tool
+        assert len(searches) == 3
+
+        # the version is kept on the same state file
+        assert utils.tool_version("tool", cache=d).strip() == "tool 1.0"
+        assert _which() == tool
+        assert len(searches) == 3
+
+
+def test_notifier_reuses_connection(monkeypatch):
+
+    from . import reporter
+
+    connections = []
+
+    class Connection(object):
+        def __init__(self):
+            self.sent = []
+            connections.append(self)
+
+        def sendmail(self, sender, to, data):
+            if self is connections[0]:
+                raise OSError("connection reset")  # the first one is broken
+            self.sent.append(data)
+
+        def quit(self):
+            pass
+
+    monkeypatch.setattr(reporter, "_connect", lambda *args: Connection())
+
+    notifier = reporter.Notifier("server", 25, "user", "pass", backoff=0.01)
+    for k in range(3):
+        msg = reporter.Email("subject %d" % k, "body", None, "me", ["a", "b"])
+        notifier.submit(msg)
+    assert notifier.flush(timeout=10)
+    notifier.close(timeout=10)
+
+    # first attempt failed, then all messages went through a new connection
+    assert len(connections) == 2
+    assert len(connections[1].sent) == 3
+
+
+def test_b2_native_backend(monkeypatch):
+
+    b2sdk = pytest.importorskip("b2sdk.v2")
+
+    from . import b2
+    from . import b2api
+
+    api = b2sdk.B2Api(
+        b2sdk.InMemoryAccountInfo(),
+        api_config=b2sdk.B2HttpApiConfig(_raw_api_class=b2sdk.RawSimulator),
+    )
+    account_id, key = api.session.raw_api.create_account()
+    monkeypatch.setattr(b2api, "_api", api)
+    monkeypatch.setattr(b2, "_native", True)
+
+    assert b2.get_account_info() is None
+    b2.authorize_account(account_id, key)
+    assert b2.get_account_info()["applicationKey"] == key
+
+    b2.create_bucket("baker-test")
+    assert list(b2.list_buckets()) == ["baker-test"]
+
+    bucket = api.get_bucket_by_name("baker-test")
+    bucket.upload_bytes(b"hello", "data/file.txt")
+    bucket.upload_bytes(b"v1", "config")
+    bucket.upload_bytes(b"v2", "config")
+    assert b2.bucket_contents("baker-test") == ["config", "data/"]
+    assert b2.bucket_contents("baker-test", "data") == ["data/file.txt"]
+    assert b2.get_bucket("baker-test")["totalSize"] == 9  # all versions
+
+    entries = list(b2.iter_bucket_contents("baker-test", recursive=True))
+    assert [(k.name, k.size) for k in entries] == [
+        ("config", 2),
+        ("data/file.txt", 5),
+    ]
+    assert isinstance(entries[0].upload_time, datetime.datetime)
+    versions = b2.iter_bucket_contents("baker-test", "data", versions=True)
+    assert [k.name for k in versions] == ["data/file.txt"]
+    versions = b2.iter_bucket_contents("baker-test", versions=True)
+    assert [k.name for k in versions] == ["config", "config", "data/"]
+
+    assert b2.remove_bucket("baker-test")["bucketName"] == "baker-test"
+    assert b2.list_buckets() == {}
+
+
+def test_b2_authorization_and_buckets_are_cached(monkeypatch):
+
+    b2sdk = pytest.importorskip("b2sdk.v2")
+
+    from . import b2
+    from . import b2api
+
+    api = b2sdk.B2Api(
+        b2sdk.InMemoryAccountInfo(),
+        api_config=b2sdk.B2HttpApiConfig(_raw_api_class=b2sdk.RawSimulator),
+    )
+    account_id, key = api.session.raw_api.create_account()
+    monkeypatch.setattr(b2api, "_api", api)
+    monkeypatch.setattr(b2, "_native", True)
+    monkeypatch.setattr(b2, "_authorizations", {})
+    monkeypatch.setattr(b2, "_buckets", None)
+
+    calls = []
+    for name in ("authorize_account", "list_buckets"):
+        function = getattr(api, name)
+        monkeypatch.setattr(
+            api, name, lambda *a, f=function, n=name: calls.append(n) or f(*a)
+        )
+
+    with tempfile.TemporaryDirectory() as d:
+        monkeypatch.setenv("XDG_CACHE_HOME", d)
+
+        assert b2.authorize(account_id, key)
+        assert not b2.authorize(account_id, key)
+        monkeypatch.setattr(b2, "_authorizations", {})  # a new run
+        assert not b2.authorize(account_id, key)
+        assert calls.count("authorize_account") == 1
+
+        # expired tokens are renewed
+        state = b2._authorization_state(account_id, key)
+        utils.write_state(state, dict(time=time.time() - 86400))
+        monkeypatch.setattr(b2, "_authorizations", {})
+        assert b2.authorize(account_id, key)
+
+        # another account (or key) is on file
+        b2.clear_account()
+        assert b2.authorize(account_id, key)
+        assert calls.count("authorize_account") == 3
+
+        for k in range(3):
+            assert b2.list_buckets() == {}
+        b2.create_bucket("baker-test")
+        assert list(b2.list_buckets()) == ["baker-test"]
+        assert calls.count("list_buckets") == 2
+
+
+def test_b2_empty_bucket_retries(monkeypatch):
+
+    b2sdk = pytest.importorskip("b2sdk.v2")
+
+    from . import b2
+    from . import b2api
+
+    api = b2sdk.B2Api(
+        b2sdk.InMemoryAccountInfo(),
+        api_config=b2sdk.B2HttpApiConfig(_raw_api_class=b2sdk.RawSimulator),
+    )
+    api.authorize_account("production", *api.session.raw_api.create_account())
+    monkeypatch.setattr(b2api, "_api", api)
+    monkeypatch.setattr(b2, "_native", True)
+
+    bucket = api.create_bucket("baker-test", "allPrivate")
+    for k in range(50):
+        bucket.upload_bytes(b"data", "data/%02d" % k)
+        bucket.upload_bytes(b"index", "index/%02d" % (k % 10))
+
+    # the first deletion of some files is refused
+    delete = api.delete_file_version
+    refused = set()
+
+    def _delete(file_id, file_name):
+        if file_name.endswith("7") and file_id not in refused:
+            refused.add(file_id)
+            raise b2sdk.exception.TooManyRequests()
+        return delete(file_id, file_name)
+
+    monkeypatch.setattr(api, "delete_file_version", _delete)
+
+    assert b2api.empty_bucket("baker-test", jobs=4, backoff=0) == 100
+    assert len(refused) == 10
+    assert b2.bucket_contents("baker-test") == []
+
+    assert b2.remove_bucket("baker-test")["bucketName"] == "baker-test"
+
+
+def test_b2_parse_ls_entry():
+
+    from . import b2
+
+    line = "%83s  %6s  %10s  %8s  %9d  %s\n"
+    entry = b2._parse_ls_entry(
+        line % ("4_z1", "upload", "2021-06-01", "10:20:30", 42, "data/a b")
+    )
+    assert entry == b2.BucketEntry(
+        "data/a b",
+        42,
+        datetime.datetime(2021, 6, 1, 10, 20, 30),
+        "4_z1",
+        "upload",
+    )
+    entry = b2._parse_ls_entry(line % ("-", "-", "-", "-", 0, "keys/"))
+    assert entry == b2.BucketEntry("keys/", 0, None, None, "folder")
+
+
+def test_b2_cli_bucket_contents(monkeypatch):
+
+    from . import b2
+
+    monkeypatch.setattr(b2, "_native", False)
+    with tempfile.TemporaryDirectory() as d:
+        script = os.path.join(d, "b2")
+        with open(script, "wt") as f:
+            f.write("#!/bin/sh\n")
+            f.write('test "$2" = --long || exit 1\n')
+            f.write('echo "4_z1  upload  2021-06-01  10:20:30  6  config"\n')
+            f.write('echo "-  -  -  -  0  data/"\n')
+        os.chmod(script, 0o755)
+        monkeypatch.setenv("PATH", d, prepend=os.pathsep)
+        assert b2.bucket_contents("baker-test") == ["config", "data/"]
+
+
+def test_qnap_client_logs_in_lazily(monkeypatch):
+
+    import requests
+    import requests.adapters
+
+    from . import qnap
+
+    seen = []
+    expired = [False]
+
+    class _Adapter(requests.adapters.BaseAdapter):
+        def __init__(self, cookies):
+            super().__init__()
+            self.cookies = cookies
+
+        def send(self, request, **kwargs):
+            path = request.path_url.split("/api/v1", 1)[1]
+            seen.append(path)
+            response = requests.Response()
+            response.request = request
+            response.status_code = 200
+            response._content = b"[]"
+            if path == "/login":
+                response._content = b'{"username": "user"}'
+                self.cookies.set("NAS_SID", "abc")
+            elif expired[0]:
+                expired[0] = False
+                response.status_code = 401
+            return response
+
+        def close(self):
+            pass
+
+    with tempfile.TemporaryDirectory() as d:
+        monkeypatch.setattr(qnap, "SESSION_FILE", os.path.join(d, "auth"))
+
+        with qnap.QnapClient("https://nas", "user", "pass") as client:
+            client.session.mount("https://", _Adapter(client.session.cookies))
+            assert client.get_containers() == []  # logs-in first
+            assert client.get_containers() == []
+        assert seen == ["/login", "/container", "/container"]
+
+        # reuses the saved cookies, logs-in again once they expire
+        del seen[:]
+        expired[0] = True
+        with qnap.QnapClient("https://nas", "user", "pass") as client:
+            assert client.session.cookies.get("NAS_SID") == "abc"
+            client.session.mount("https://", _Adapter(client.session.cookies))
+            assert client.get_containers() == []
+        assert seen == ["/container", "/login", "/container"]
+
+
+def test_deploy_only_recreates_changed_containers():
+
+    from . import deploy
+
+    volumes = dict(new=["cache:/cache"], host={"/p": dict(bind="/p", ro=True)})
+    desired = {
+        "same": dict(volume=volumes, autostart=True, command="-v update a"),
+        "changed": dict(volume=volumes, autostart=False, command="-v check"),
+        "stopped": dict(volume=volumes, autostart=True, command="-v update"),
+        "new": dict(volume=volumes, autostart=False, command="-v check"),
+    }
+
+    class _Client(object):
+        def __init__(self):
+            self.calls = []
+
+        def get_containers(self):
+            return [
+                dict(name=k, id=k, state=s)
+                for k, s in (
+                    ("same", "running"),
+                    ("changed", "stopped"),
+                    ("stopped", "stopped"),
+                )
+            ]
+
+        def inspect_container(self, id_):
+            command = desired[id_]["command"]
+            if id_ == "changed":
+                command += " --email=always"
+            return dict(
+                Config=dict(
+                    Image="%s:%s" % (deploy.IMAGE, deploy.TAG),
+                    Cmd=command.split(),
+                ),
+                Mounts=[
+                    dict(Destination="/cache", RW=True),
+                    dict(Destination="/p", RW=False),
+                ],
+            )
+
+        def __getattr__(self, name):  # any action
+            return lambda *args: self.calls.append((name,) + args) or {}
+
+    client = _Client()
+    results = deploy.deploy(client, desired)
+    actions = [(step.name, step.action) for step, elapsed in results]
+    assert actions == [
+        ("same", "keep"),
+        ("changed", "recreate"),
+        ("stopped", "start"),
+        ("new", "create"),
+    ]
+    assert sorted(k[:2] for k in client.calls) == [
+        ("create_container", "changed"),
+        ("create_container", "new"),
+        ("remove_container", "changed"),
+        ("start_container", "stopped"),
+    ]
+
+
+def test_logs_follow_prints_new_lines_only(capsys):
+
+    import threading
+
+    from . import logs
+
+    batches = [
+        "2021-06-01T10:00:00.5Z first\n2021-06-01T10:00:01Z second\n",
+        # the second in which the last line was logged is repeated
+        "2021-06-01T10:00:01Z second\n2021-06-01T10:00:01.25Z third\n",
+        "",
+    ]
+    calls = []
+    stop = threading.Event()
+
+    class _Client(object):
+        def retrieve_logs(self, id_, tail, since=None, timestamps=False):
+            calls.append((tail, since, timestamps))
+            if len(calls) == len(batches):
+                stop.set()
+            return dict(logs=batches[len(calls) - 1])
+
+    logs.stream(_Client(), "id", "c | ", follow=True, interval=0, stop=stop)
+    assert capsys.readouterr().out == "c | first\nc | second\nc | third\n"
+    assert calls == [
+        (1000, None, True),
+        (None, 1622541601, True),
+        (None, 1622541601, True),
+    ]
@@ -25,6 +25,16 @@ SAMPLE_DIR2 = pkg_resources.resource_filename(
 )
 
 
+def _saved(messages):
+    """Returns the index of the (first) "snapshot ... saved" message"""
+
+    return [
+        k
+        for k, m in enumerate(messages)
+        if m.startswith("snapshot") and m.endswith("saved")
+    ][0]
+
+
 def test_help():
 
     with pytest.raises(SystemExit), StdoutCapture():
@@ -211,12 +221,12 @@ def run_update(repo, b2):
 
     messages = log2.split("\n")[:-1]  # removes last end-of-line
 
-    assert messages[7].startswith("snapshot")
-    assert messages[7].endswith("saved")
+    saved = _saved(messages)
+    assert messages[saved - 5].startswith("Files:")
 
-    assert messages[8].startswith("Applying Policy: keep")
+    assert messages[saved + 1].startswith("Applying Policy: keep")
 
-    assert SAMPLE_DIR1 in messages[12]
+    assert SAMPLE_DIR1 in messages[saved + 5]
 
 
 def test_update_local():
@@ -259,13 +269,13 @@ def run_update_recover(repo, b2):
 
     assert messages[0] == "successfully removed locks"
     assert messages[1] == "loading indexes..."
-    assert messages[17].startswith("snapshot")
-    assert messages[17].endswith("saved")
-    assert messages[18] == "loading indexes..."
-    assert messages[19] == "loading all snapshots..."
-    assert messages[35] == "done"
-    assert messages[36].startswith("Applying Policy: keep")
-    assert SAMPLE_DIR1 in messages[40]
+    saved = _saved(messages)
+    assert messages[saved - 5].startswith("Files:")
+    assert messages[saved + 1] == "loading indexes..."
+    assert messages[saved + 2] == "loading all snapshots..."
+    assert messages[saved + 18] == "done"
+    assert messages[saved + 19].startswith("Applying Policy: keep")
+    assert SAMPLE_DIR1 in messages[saved + 23]
 
 
 def test_update_recover():
@@ -274,7 +284,7 @@ def test_update_recover():
         run_update_recover(d, {})
 
 
-def run_update_multiple(repo1, repo2, b2):
+def run_update_multiple(repo1, repo2, b2, jobs=1):
 
     from collections import OrderedDict
 
@@ -306,6 +316,7 @@ def run_update_multiple(repo1, repo2, b2):
             period=None,
             max_recoveries=0,
             force_recovery=False,
+            jobs=jobs,
         )
 
     assert len(sizes1) == 2
@@ -319,13 +330,13 @@ def run_update_multiple(repo1, repo2, b2):
     messages1 = log2[:split_index].split("\n")
     messages2 = log2[split_index:].split("\n")
 
-    assert messages1[7].startswith("snapshot")
-    assert messages1[7].endswith("saved")
-    assert SAMPLE_DIR1 in messages1[12]
+    saved = _saved(messages1)
+    assert messages1[saved - 5].startswith("Files:")
+    assert SAMPLE_DIR1 in messages1[saved + 5]
 
-    assert messages2[6].startswith("snapshot")
-    assert messages2[6].endswith("saved")
-    assert SAMPLE_DIR2 in messages2[11]
+    saved = _saved(messages2)
+    assert messages2[saved - 5].startswith("Files:")
+    assert SAMPLE_DIR2 in messages2[saved + 5]
 
 
 def test_update_local_multiple():
@@ -334,6 +345,12 @@ def test_update_local_multiple():
         run_update_multiple(d1, d2, {})
 
 
+def test_update_local_multiple_parallel():
+
+    with tempfile.TemporaryDirectory() as d1, tempfile.TemporaryDirectory() as d2:
+        run_update_multiple(d1, d2, {}, jobs=2)
+
+
 def run_update_error(repo1, repo2, b2):
 
     with LogCapture("baker") as buf, tempfile.TemporaryDirectory() as cache:
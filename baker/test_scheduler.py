@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Tests for our scheduler"""
+
+import datetime
+import threading
+
+import pytest
+
+from . import scheduler
+
+
+def test_cron_daily():
+
+    cron = scheduler.Cron("30 2 * * *")
+    start = datetime.datetime(2021, 12, 31, 2, 30)
+    assert cron.next_after(start) == datetime.datetime(2022, 1, 1, 2, 30)
+    assert cron.next_after(start - datetime.timedelta(seconds=1)) == start
+
+
+def test_cron_steps_ranges_and_lists():
+
+    cron = scheduler.Cron("*/15 8-10,20 * * *")
+    dt = datetime.datetime(2021, 6, 1, 10, 50)
+    assert cron.next_after(dt) == datetime.datetime(2021, 6, 1, 20, 0)
+    assert cron.next_after(datetime.datetime(2021, 6, 1, 20, 45)) == (
+        datetime.datetime(2021, 6, 2, 8, 0)
+    )
+
+
+def test_cron_days():
+
+    # 2021-06-01 was a Tuesday
+    weekdays = scheduler.Cron("0 0 * * 1-5")
+    saturday = datetime.datetime(2021, 6, 5, 12, 0)
+    assert weekdays.next_after(saturday) == datetime.datetime(2021, 6, 7)
+
+    sunday = scheduler.Cron("0 0 * * 7")
+    assert sunday.next_after(saturday) == datetime.datetime(2021, 6, 6)
+
+    # both day fields restricted: either matches
+    either = scheduler.Cron("0 0 13 * 5")
+    assert either.next_after(saturday) == datetime.datetime(2021, 6, 11)
+    assert either.next_after(datetime.datetime(2021, 6, 11)) == (
+        datetime.datetime(2021, 6, 13)
+    )
+
+    leap = scheduler.Cron("0 0 29 2 *")
+    assert leap.next_after(saturday) == datetime.datetime(2024, 2, 29)
+
+    with pytest.raises(ValueError):
+        scheduler.Cron("0 0 30 2 *").next_after(saturday)
+
+
+def test_parse():
+
+    crons = scheduler.parse("1:00, 13:30;0 */6 * * 6")
+    assert len(crons) == 3
+    dt = datetime.datetime(2021, 6, 4, 12, 0)  # Friday
+    assert scheduler.next_after(crons, dt) == datetime.datetime(
+        2021, 6, 4, 13, 30
+    )
+    dt = datetime.datetime(2021, 6, 5, 1, 0)  # Saturday
+    assert scheduler.next_after(crons, dt) == datetime.datetime(2021, 6, 5, 6)
+
+    for invalid in ("", "25:00", "* * *", "60 * * * *", "*/0 * * * *"):
+        with pytest.raises(ValueError):
+            scheduler.parse(invalid)
+
+
+@pytest.mark.parametrize(
+    "overlap,expected", [("skip", 1), ("queue", 3), ("coalesce", 2)]
+)
+def test_overlap(overlap, expected):
+
+    release = threading.Event()
+    runs = []
+
+    def job():
+        runs.append(datetime.datetime.now())
+        release.wait(10)
+
+    s = scheduler.Scheduler(job, "0 0 * * *", overlap=overlap)
+    for k in range(3):  # the first run blocks, others are due meanwhile
+        s._fire()
+    release.set()
+
+    worker = s._worker
+    if worker is not None:
+        worker.join(10)
+    assert len(runs) == expected
+    assert s.last_run <= runs[-1]
+    assert s.last_duration is not None
+    assert s.last_lag is not None and s.last_lag >= 0
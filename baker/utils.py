@@ -7,12 +7,22 @@ import sys
 import json
 import time
 import copy
+import shutil
+import codecs
+import signal
+import asyncio
+import hashlib
+import threading
+import tempfile
 import subprocess
+import collections
+import concurrent.futures
 
 import logging
 
 logger = logging.getLogger(__name__)
 
+from . import spans
 from .reporter import human_time
 
 
@@ -26,9 +36,103 @@ def retrieve_json_secret(key):
     return json.loads(p.communicate()[0].strip())
 
 
-def run_cmdline(cmd, env=None, mask=None):
+class OutputBuffer(object):
+    """A line-oriented, bounded, capture of command output
+
+    Keeps the first ``head`` and the last ``tail`` lines written to it, and
+    only counts the lines in between, so memory usage does not depend on how
+    much output commands produce.  Optionally, all lines can be spilled to an
+    anonymous temporary file, so the complete output remains available without
+    being held in memory.
+
+    Objects of this class may be shared by many commands (e.g. all commands
+    run for one repository), and appended to each other with ``+=``.
+
+
+    Parameters:
+
+      head (int, Optional): The number of lines to keep from the start of the
+        output. If set to ``None``, then keep all lines in memory (unbounded).
+
+      tail (int, Optional): The number of lines to keep from the end of the
+        output
+
+      spill (bool, Optional): If set to ``True``, then write all lines to a
+        temporary file, which is used when this object is converted to a
+        string
+
+    """
+
+    def __init__(self, head=1000, tail=1000, spill=False):
+
+        self.head = []
+        self.tail = collections.deque(maxlen=tail)
+        self.lines = 0
+        self.omitted = 0
+        self._head_size = head
+        self._partial = ""
+        self._spill = None
+        if spill:
+            self._spill = tempfile.TemporaryFile("w+t", encoding="utf-8")
+
+    def _append(self, line):
+
+        self.lines += 1
+        if self._spill is not None:
+            self._spill.write(line)
+        if self._head_size is None or len(self.head) < self._head_size:
+            self.head.append(line)
+        else:
+            if len(self.tail) == self.tail.maxlen:
+                self.omitted += 1
+            self.tail.append(line)
+
+    def write(self, text):
+        """Appends text to the buffer.  Text may end on a partial line"""
+
+        if not text:
+            return
+        *lines, self._partial = (self._partial + text).split("\n")
+        for line in lines:
+            self._append(line + "\n")
+
+    def __iadd__(self, other):
+
+        self.write(str(other))
+        return self
+
+    def __bool__(self):
+
+        return bool(self.lines or self._partial)
+
+    def __str__(self):
+
+        if self._spill is not None:
+            self._spill.seek(0)
+            retval = self._spill.read()
+            self._spill.seek(0, os.SEEK_END)
+            return retval + self._partial
+
+        retval = "".join(self.head)
+        if self.omitted:
+            retval += "[... %d lines omitted ...]\n" % self.omitted
+        return retval + "".join(self.tail) + self._partial
+
+    def close(self):
+        """Releases the spill file, if one is used"""
+
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+
+def run_cmdline(cmd, env=None, mask=None, output=None, callback=None):
     """Runs a command on a environment, logs output and reports status
 
+    Output is decoded and processed incrementally, line by line, as it is
+    produced by the command.  This is a synchronous wrapper around
+    :py:func:`run_cmdline_async`.
+
 
     Parameters:
 
@@ -42,11 +146,68 @@ def run_cmdline(cmd, env=None, mask=None):
         asterisks.  This may be imoprtant to avoid passwords or keys to be shown
         on the screen or sent via email.
 
+      output (OutputBuffer, Optional): If set, append the output of the command
+        to this buffer, and return it, instead of returning a string
+
+      callback (callable, Optional): If set, it is called with each complete
+        line of output (without the end-of-line character), as soon as it is
+        available.  The callback returns the text to capture instead of the
+        line, or ``None``, if nothing is to be captured for this line.
+
 
     Returns:
 
-      str: The standard output and error of the command being executed
+      str: The standard output and error of the command being executed, if
+      ``output`` is not set.  Otherwise, ``output`` itself.
+
+    """
+
+    return asyncio.run(run_cmdline_async(cmd, env, mask, output, callback))
+
+
+def exit_code(status):
+    """Converts a wait status into an exit code, as in :py:mod:`subprocess`
+
+    Processes killed by a signal get the negated signal number.
+    """
+
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
 
+def _wait4(process, lock):
+    """Waits for a process to finish, returns its resource usage
+
+    Sets :py:attr:`subprocess.Popen.returncode`, as :py:meth:`Popen.wait
+    <subprocess.Popen.wait>` would.  The process is only reaped while holding
+    ``lock``: whoever sends it signals holding the same lock, after checking
+    ``returncode`` is unset, cannot hit a recycled process identifier.
+    """
+
+    if hasattr(os, "waitid"):
+        # waits for the process to exit without reaping it (yet)
+        os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+        with lock:
+            _, status, rusage = os.wait4(process.pid, 0)
+            process.returncode = exit_code(status)
+    else:  # cannot wait without reaping: holding the lock would block it
+        _, status, rusage = os.wait4(process.pid, 0)
+        with lock:
+            process.returncode = exit_code(status)
+    return rusage
+
+
+async def run_cmdline_async(
+    cmd, env=None, mask=None, output=None, callback=None
+):
+    """Asynchronous version of :py:func:`run_cmdline`
+
+    Many commands may run concurrently on the same event loop.  If the
+    coroutine is cancelled, the running process is killed.  Processes are
+    reaped with :py:func:`os.wait4` (on a worker thread, waiting from the
+    start), and only there, and their resource usage is recorded on the
+    active span (see :py:func:`.spans.record`).
     """
 
     if env is None:
@@ -60,25 +221,74 @@ def run_cmdline(cmd, env=None, mask=None):
     logger.info("$ %s" % " ".join(cmd_log))
 
     start = time.time()
-    out = b""
+    capture = output if output is not None else OutputBuffer(head=None)
+    last = collections.deque(maxlen=200)  # only used for error reporting
 
+    loop = asyncio.get_running_loop()
     p = subprocess.Popen(
         cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env
     )
+    stdout = asyncio.StreamReader()
+    lock = threading.Lock()
+    reaped = loop.run_in_executor(None, _wait4, p, lock)
+    transport = None
 
+    # multibyte characters may be split between chunks
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
     chunk_size = 1 << 13
     lineno = 0
-    for chunk in iter(lambda: p.stdout.read(chunk_size), b""):
-        decoded = chunk.decode()
-        while "\n" in decoded:
-            pos = decoded.index("\n")
-            logger.debug("%03d: %s" % (lineno, decoded[:pos]))
-            decoded = decoded[pos + 1 :]
-            lineno += 1
-        out += chunk
-
-    if p.wait() != 0:
-        logger.error("Command output is:\n%s", out.decode())
+    partial = ""
+
+    try:
+        transport, _ = await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(stdout), p.stdout
+        )
+        while True:
+            chunk = await stdout.read(chunk_size)
+            if not chunk:
+                break
+            *lines, partial = (partial + decoder.decode(chunk)).split("\n")
+            for line in lines:
+                last.append(line)
+                if callback is not None:
+                    line = callback(line)
+                    if line is None:
+                        continue
+                logger.debug("%03d: %s" % (lineno, line))
+                capture.write(line + "\n")
+                lineno += 1
+        rusage = await asyncio.shield(reaped)
+    except asyncio.CancelledError:
+        logger.warning("Cancelled - killing `%s'", " ".join(cmd_log))
+        with lock:  # not while reaping (Popen.kill() would also reap)
+            if not reaped.done() and p.returncode is None:
+                try:
+                    os.kill(p.pid, signal.SIGKILL)
+                except ProcessLookupError:  # without os.waitid()
+                    pass
+        spans.record(await reaped)
+        raise
+    finally:
+        if transport is not None:
+            transport.close()
+        else:
+            p.stdout.close()
+
+    spans.record(rusage)
+
+    partial += decoder.decode(b"", final=True)
+    if partial:
+        last.append(partial)
+        if callback is not None:
+            partial = callback(partial)
+        if partial is not None:
+            logger.debug("%03d: %s" % (lineno, partial))
+            capture.write(partial)
+
+    if p.returncode != 0:
+        logger.error(
+            "Command output (last %d lines) is:\n%s", len(last), "\n".join(last)
+        )
         raise RuntimeError(
             "command `%s' exited with error state (%d)"
             % (" ".join(cmd_log), p.returncode)
@@ -88,18 +298,462 @@ def run_cmdline(cmd, env=None, mask=None):
 
     logger.info("command took %s" % human_time(total))
 
-    out = out.decode()
+    if output is not None:
+        return output
+
+    return str(capture)
+
+
+async def gather(coroutines, jobs=1):
+    """Runs coroutines concurrently, but at most ``jobs`` at a time
+
+    If one of the coroutines fails, all others are cancelled (killing any
+    running commands) before the exception is re-raised.
+
+
+    Parameters:
+
+      coroutines (list): The coroutines to run
+
+      jobs (int, Optional): The maximum number of coroutines to run at the
+        same time
+
+
+    Returns:
+
+      list: The results of each coroutine, in the same order as ``coroutines``
+
+    """
+
+    semaphore = asyncio.Semaphore(max(1, jobs))
+
+    async def _bounded(coroutine):
+        try:
+            async with semaphore:
+                return await coroutine
+        finally:
+            coroutine.close()  # in case it was cancelled before starting
+
+    tasks = [asyncio.ensure_future(_bounded(k)) for k in coroutines]
+
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+def parse_size(value):
+    """Parses a size, in bytes, with an optional K, M, G or T suffix
+
+    Suffixes are powers of 1024, like for restic.  Returns an integer.
+    """
+
+    value = str(value).strip()
+    suffixes = "KMGT"
+    if value and value[-1].upper() in suffixes:
+        power = 1024 ** (suffixes.index(value[-1].upper()) + 1)
+        return int(float(value[:-1]) * power)
+    return int(value)
+
+
+def baker_cache(cache):
+    """Returns the directory where baker keeps its own state, creating it
+
+    This is a sub-directory called ``baker`` inside the restic cache directory,
+    if that is set, or ``${XDG_CACHE_HOME}/baker`` (typically
+    ``~/.cache/baker``), otherwise.
+
+
+    Parameters:
+
+      cache (str): The path to the cache directory used for restic, or
+        ``None``, if restic uses its defaults
+
+
+    Returns:
+
+      str: The path to baker's own cache directory
+
+    """
+
+    if not cache:
+        cache = os.environ.get(
+            "XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")
+        )
+    path = os.path.join(cache, "baker")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def state_path(cache, kind, key):
+    """Returns the path of a file keeping state for a given object
+
+    State files live inside :py:func:`baker_cache`, on a sub-directory named
+    after the kind of state kept.  File names are derived from a hash of the
+    key (e.g. a repository name), so any string can be used.
+
+
+    Parameters:
+
+      cache (str): The path to the cache directory used for restic, or
+        ``None``, if restic uses its defaults
+
+      kind (str): The kind of state (e.g. ``sizes``)
+
+      key (str): The object the state refers to (e.g. a repository)
+
+
+    Returns:
+
+      str: The path to the state file, that may not exist yet
+
+    """
+
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+    directory = os.path.join(baker_cache(cache), kind)
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, digest + ".json")
+
+
+def read_state(path, default=None):
+    """Reads a JSON state file, returning ``default`` if it cannot be read"""
+
+    try:
+        with open(path, "rt") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+    except ValueError:
+        logger.warning("Ignoring corrupted state file `%s'", path)
+        return default
 
-    return out
 
+def write_state(path, data):
+    """Writes a JSON state file atomically"""
 
-def get_size(path="."):
-    """Returns the total size (in bytes) of contents of the provided directory"""
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "wt") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
 
-    total_size = 0
-    for dirpath, dirnames, filenames in os.walk(path):
-        for f in filenames:
-            fp = os.path.join(dirpath, f)
-            total_size += os.path.getsize(fp)
 
-    return total_size
+def _walk_parallel(path, scan, jobs):
+    """Calls ``scan`` on every directory under ``path``, on a pool of threads
+
+    ``scan`` is called with the path of a directory and must return a list,
+    whose last element contains the names of the sub-directories to visit.
+    Directories that cannot be scanned are ignored, like :py:func:`os.walk`
+    does.  Returns a dictionary mapping each directory to its scan result.
+    """
+
+    scanned = {}
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=jobs, thread_name_prefix="walk"
+    ) as pool:
+
+        pending = {pool.submit(scan, path): path}
+        while pending:
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                directory = pending.pop(future)
+                try:
+                    scanned[directory] = future.result()
+                except OSError:
+                    continue
+                for name in scanned[directory][-1]:
+                    subdir = os.path.join(directory, name)
+                    pending[pool.submit(scan, subdir)] = subdir
+
+    return scanned
+
+
+_RACY_INTERVAL = 2 * 10**9
+"""Directories modified less than this (in ns) before a scan are not cached"""
+
+
+def _scan_directory(path, cached):
+    """Scans a single directory, for :py:func:`get_size`
+
+    Returns a tuple containing the inode number and modification time (in
+    nanoseconds) of the directory, the total size of files directly inside it
+    and the names of its sub-directories.  If the inode and modification time
+    match those of the ``cached`` entry, then the directory is not scanned and
+    the cached entry is returned instead.
+    """
+
+    st = os.stat(path)
+    if cached is not None and cached[:2] == [st.st_ino, st.st_mtime_ns]:
+        return cached
+
+    total = 0
+    subdirs = []
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                if entry.is_dir():
+                    if not entry.is_symlink():  # like os.walk()
+                        subdirs.append(entry.name)
+                else:
+                    total += entry.stat().st_size
+            except FileNotFoundError:  # broken link or removed meanwhile
+                continue
+
+    return [st.st_ino, st.st_mtime_ns, total, subdirs]
+
+
+_which = {}
+"""Paths of executables already looked-up, see :py:func:`which`"""
+
+
+def which(name, cache=None):
+    """Returns the path of an executable on the ``${PATH}``, or ``None``
+
+    The look-up is done on the first call, and cached afterwards.  The path
+    found is also kept on the state file of :py:func:`tool_version`, keyed on
+    ``${PATH}`` and on the modification time of the executable, so that
+    following runs only search for it again once either changes.  Missing
+    executables are not kept.
+
+
+    Parameters:
+
+      name (str): The name of the executable (e.g. ``restic``)
+
+      cache (str, Optional): The path to the cache directory used for restic,
+        or ``None``, if restic uses its defaults
+
+    """
+
+    if name in _which:
+        return _which[name]
+
+    search = os.environ.get("PATH", os.defpath)
+    state = state_path(cache, "tools", name)
+    cached = read_state(state, {})
+    found = cached.get("which", {})
+
+    path = None
+    if found.get("search") == search:
+        try:
+            if os.stat(found["path"]).st_mtime_ns == found["mtime"]:
+                path = found["path"]
+        except OSError:  # removed since
+            pass
+
+    if path is None:
+        path = shutil.which(name)
+        if path is not None:
+            found = dict(
+                search=search, path=path, mtime=os.stat(path).st_mtime_ns
+            )
+            try:
+                write_state(state, dict(cached, which=found))
+            except OSError as e:
+                logger.debug("Cannot keep the path of %s: %s", name, e)
+
+    _which[name] = path
+    logger.debug("Using %s from `%s'", name, path)
+    return path
+
+
+def tool_version(name, cache=None):
+    """Returns the output of ``<name> version``, cached on disk
+
+    The output is kept on a state file (see :py:func:`state_path`), keyed on
+    the path, size and modification time of the executable, so the program is
+    only executed again after being updated.
+
+
+    Parameters:
+
+      name (str): The name of the executable (e.g. ``restic``)
+
+      cache (str, Optional): The path to the cache directory used for restic,
+        or ``None``, if restic uses its defaults
+
+
+    Returns:
+
+      str: The output of the version command
+
+    """
+
+    path = which(name, cache)
+    if not path:
+        raise RuntimeError(
+            "The executable `%s' must be available on your ${PATH}" % name
+        )
+
+    st = os.stat(path)
+    key = [path, st.st_size, st.st_mtime_ns]
+    state = state_path(cache, "tools", name)
+    cached = read_state(state, {})
+    if cached.get("key") == key:
+        return cached["version"]
+
+    version = run_cmdline([path, "version"])
+    write_state(state, dict(cached, key=key, version=version))
+    return version
+
+
+def get_size(path=".", state=None, jobs=8):
+    """Returns the total size (in bytes) of contents of the provided directory
+
+    Directories are scanned in parallel, on a pool of threads.  If ``state`` is
+    set, the size of files directly inside each directory is kept on that file,
+    along with the directory inode number and modification time.  On the next
+    call, directories whose inode and modification time did not change are not
+    scanned again.  Only the directories themselves are checked.
+
+    The modification time of a directory only changes when entries are added,
+    removed or renamed in it.  A file that is modified in place does not change
+    it.  This is safe for restic repositories and caches, whose files are never
+    modified after being written.
+
+
+    Parameters:
+
+      path (str): The directory to measure
+
+      state (str, Optional): Path to a JSON file used for keeping the size of
+        each scanned directory across calls.  If not set, scan all directories.
+
+      jobs (int, Optional): Number of directories to scan in parallel
+
+
+    Returns:
+
+      int: The total size, in bytes, of all files under ``path``
+
+    """
+
+    cache = read_state(state, {}) if state else {}
+    start = time.time_ns()
+
+    scanned = _walk_parallel(
+        path, lambda k: _scan_directory(k, cache.get(k)), jobs
+    )
+
+    if state:
+        # like git's "racily clean" entries: a directory modified on the same
+        # timestamp tick as it was scanned may have changed after the scan
+        limit = start - _RACY_INTERVAL
+        write_state(
+            state, dict((k, v) for k, v in scanned.items() if v[1] < limit)
+        )
+
+    hits = sum(1 for k, v in scanned.items() if cache.get(k) == v)
+    logger.debug(
+        "Sized `%s': %d directories (%d unchanged since the last scan)",
+        path,
+        len(scanned),
+        hits,
+    )
+
+    return sum(k[2] for k in scanned.values())
+
+
+TreeSignature = collections.namedtuple(
+    "TreeSignature", ["digest", "directories", "files", "size", "newest"]
+)
+TreeSignature.__doc__ = """Metadata signature of a directory tree
+
+``digest`` is a hexadecimal string, while all other fields are integers.
+``size`` is the total size of all files in the tree, in bytes.  ``newest`` is
+the most recent modification or inode change time (in nanoseconds since the
+epoch) of all entries in the tree.
+"""
+
+
+def _digest_directory(path):
+    """Digests the metadata of one directory, for :py:func:`tree_signature`
+
+    Returns a list containing the hexadecimal digest of the directory
+    metadata, the number of files directly inside it, their total size, the
+    most recent modification time of all entries and the names of its
+    sub-directories.
+    """
+
+    st = os.stat(path)
+    items = []
+    files = 0
+    size = 0
+    newest = max(st.st_mtime_ns, st.st_ctime_ns)
+    subdirs = []
+
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                info = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:  # removed meanwhile
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.name)
+            else:
+                files += 1
+                size += info.st_size
+            newest = max(newest, info.st_mtime_ns, info.st_ctime_ns)
+            items.append(
+                "%s\0%d\0%d\0%d\0%d\0%d"
+                % (
+                    entry.name,
+                    info.st_mode,
+                    info.st_ino,
+                    info.st_size,
+                    info.st_mtime_ns,
+                    info.st_ctime_ns,
+                )
+            )
+
+    digest = hashlib.sha1(
+        ("%d\0%d\n" % (st.st_mode, st.st_mtime_ns)).encode("utf-8")
+    )
+    for k in sorted(items):
+        digest.update(k.encode("utf-8", "surrogateescape") + b"\n")
+
+    return [digest.hexdigest(), files, size, newest, subdirs]
+
+
+def tree_signature(path, jobs=8):
+    """Computes a signature of the metadata of all entries in a tree
+
+    The signature changes if any file or directory under ``path`` is added,
+    removed, renamed or modified (including changes of size, modification
+    time, permissions and ownership, that update the inode change time).  File
+    contents are not read: only local metadata is used, on a pool of threads.
+
+
+    Parameters:
+
+      path (str): The directory to compute the signature for
+
+      jobs (int, Optional): Number of directories to scan in parallel
+
+
+    Returns:
+
+      TreeSignature: The signature and some statistics about the tree
+
+    """
+
+    scanned = _walk_parallel(path, _digest_directory, jobs)
+
+    digest = hashlib.sha1()
+    for directory in sorted(scanned):
+        relative = os.path.relpath(directory, path)
+        digest.update(relative.encode("utf-8", "surrogateescape") + b"\0")
+        digest.update(scanned[directory][0].encode("ascii") + b"\n")
+
+    return TreeSignature(
+        digest=digest.hexdigest(),
+        directories=len(scanned),
+        files=sum(k[1] for k in scanned.values()),
+        size=sum(k[2] for k in scanned.values()),
+        newest=max((k[3] for k in scanned.values()), default=0),
+    )
@@ -21,15 +21,16 @@ setup(
     install_requires=[
       'setuptools',
       'b2',
+      'b2sdk',
       'docopt',
       'jinja2',
-      'schedule',
       'requests',
       ],
 
     entry_points = {
       'console_scripts': [
         'bake = baker.bake:main',
+        'bake-benchmark = baker.benchmark:main',
         'deploy = baker.deploy:main',
         'logs = baker.logs:main',
         'remove-test-buckets = baker.remove_test_buckets:main',